@@ -0,0 +1,235 @@
+"""
+利用者ごとの貸出・予約の件数
+貸出中・延滞中・待機中の予約・順番待ちの件数と最終利用日時を user_activity の1行に保持し、
+予約・キャンセル・貸出・返却・繰り上げ・定期ジョブの各処理と同じトランザクションで増減させます。
+- 予約の上限の確認: 主キーを条件にした1回のUPDATEで、上限内なら件数を増やす（claim_reservation）
+- 貸出の上限の確認: 利用者の行をロックして残りの冊数を読む（loans_remaining。1件ずつ・一括の貸出で共通）
+- 一覧の表示: 利用者の予約・貸出を数えずに、この行を読むだけ
+取りこぼしや手動のデータ修正によるずれは、定期ジョブ（reconcile_user_activity）が実データから数え直して修正します。
+"""
+
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import and_, case, func, insert, select, update
+
+from database import engine
+from models import Loan, LoanStatus, Reservation, ReservationStatus, User, UserActivity
+
+# 利用者ごとの上限（貸出中＋延滞中 / 待機中の予約＋順番待ち）
+MAX_LOANS = int(os.getenv('USER_MAX_LOANS', 10))
+MAX_RESERVATIONS = int(os.getenv('USER_MAX_RESERVATIONS', 10))
+# 再集計で1回のトランザクションで処理する利用者数
+RECONCILE_BATCH_SIZE = int(os.getenv('USER_ACTIVITY_RECONCILE_BATCH_SIZE', 1000))
+
+ACTIVITY_COLUMNS = ('active_loans', 'overdue_loans', 'pending_reservations', 'waiting_reservations')
+_RESERVATION_COLUMNS = {ReservationStatus.PENDING: 'pending_reservations',
+                        ReservationStatus.WAITING: 'waiting_reservations'}
+_LOAN_COLUMNS = {LoanStatus.ACTIVE: 'active_loans', LoanStatus.OVERDUE: 'overdue_loans'}
+
+
+class LimitExceeded(Exception):
+    """利用者の貸出・予約の件数が上限に達している"""
+
+
+def adjust_user(db, user_id: int, record_activity=True, **deltas):
+    """
+    利用者の件数を増減（例: adjust_user(db, user_id, pending_reservations=-1, active_loans=1)）
+    record_activity の場合は最終利用日時も更新します（定期ジョブによる変更では False）。
+    呼び出し側のトランザクション内で実行し、コミットは呼び出し側で行います。
+    """
+    adjust_users(db, {user_id: 1}, record_activity, **deltas)
+
+
+def adjust_users(db, counts, record_activity=True, **per_item):
+    """
+    利用者ごとの件数（counts: 利用者ID -> 件数）に per_item の増減を掛けて、1回のUPDATEでまとめて反映
+    例: 延滞の更新 adjust_users(conn, {3: 2, 8: 1}, False, active_loans=-1, overdue_loans=1)
+    """
+    counts = {user_id: count for user_id, count in counts.items() if count}
+    per_item = {name: delta for name, delta in per_item.items() if delta}
+    if not counts or not (per_item or record_activity):
+        return
+    weight = case(counts, value=UserActivity.user_id, else_=0)
+    values = {name: getattr(UserActivity, name) + weight * delta for name, delta in per_item.items()}
+    if record_activity:
+        values['last_activity_at'] = datetime.utcnow()
+    # 行がまだない場合は何もしない（再集計で正しい値が入る）
+    db.execute(
+        update(UserActivity)
+        .where(UserActivity.user_id.in_(counts))
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _within_limits():
+    return and_(UserActivity.pending_reservations + UserActivity.waiting_reservations < MAX_RESERVATIONS,
+                UserActivity.active_loans + UserActivity.overdue_loans < MAX_LOANS)
+
+
+def claim_reservation(db, user_id: int, waiting=False):
+    """
+    予約（waiting なら順番待ち）1件分を数える。上限に達している場合は更新せずにLimitExceededを送出
+    上限の確認と増加を1回のUPDATEで行うため、同じ利用者の予約が同時に来ても上限を超えません。
+    """
+    column = 'waiting_reservations' if waiting else 'pending_reservations'
+    for attempt in range(2):
+        claimed = db.execute(
+            update(UserActivity)
+            .where(UserActivity.user_id == user_id, _within_limits())
+            .values(**{column: getattr(UserActivity, column) + 1}, last_activity_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        if claimed:
+            return
+        activity = db.execute(
+            select(UserActivity.active_loans, UserActivity.overdue_loans).where(UserActivity.user_id == user_id)
+        ).first()
+        if activity is not None or attempt:
+            break
+        # 行のない利用者（直接登録したデータなど）は実データから作成してやり直す
+        reconcile_users(db, [user_id])
+    if activity is not None and activity.active_loans + activity.overdue_loans >= MAX_LOANS:
+        raise LimitExceeded(f'貸出中の書籍が上限（{MAX_LOANS}冊）に達しているため、予約できません。')
+    raise LimitExceeded(f'予約できる件数の上限（{MAX_RESERVATIONS}件）に達しています。')
+
+
+def loans_remaining(db, user_ids):
+    """
+    利用者ごとにあと何冊貸し出せるか（{利用者ID: 冊数}）
+    利用者の行をロックして読むため、同じ利用者の貸出が同時に来ても、呼び出し側が同じトランザクションで
+    件数を増やすまで他の貸出は待ち、上限を超えません。
+    """
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return {}
+    query = (select(UserActivity.user_id, UserActivity.active_loans + UserActivity.overdue_loans)
+             .where(UserActivity.user_id.in_(user_ids))
+             .order_by(UserActivity.user_id)
+             .with_for_update())
+    loans = dict(db.execute(query).all())
+    missing = [user_id for user_id in user_ids if user_id not in loans]
+    if missing:
+        # 行のない利用者（直接登録したデータなど）は実データから作成して読み直す
+        reconcile_users(db, missing)
+        loans.update(db.execute(query.where(UserActivity.user_id.in_(missing))).all())
+    return {user_id: max(0, MAX_LOANS - loans.get(user_id, 0)) for user_id in user_ids}
+
+
+def get_activity(db, user_id: int):
+    """利用者の件数の1行を主キーで取得（まだなければNone）"""
+    return db.get(UserActivity, user_id)
+
+
+# ==================== 再集計 ====================
+
+def _actual_activity(conn, user_ids):
+    """利用者ごとの件数と最終利用日時を実データから数える（利用者IDの列が先頭のインデックスを使う）"""
+    actual = {user_id: {**dict.fromkeys(ACTIVITY_COLUMNS, 0), 'last_activity_at': None} for user_id in user_ids}
+    for user_id, status, count in conn.execute(
+        select(Reservation.user_id, Reservation.status, func.count(Reservation.id))
+        .where(Reservation.user_id.in_(user_ids), Reservation.status.in_(list(_RESERVATION_COLUMNS)))
+        .group_by(Reservation.user_id, Reservation.status)
+    ):
+        actual[user_id][_RESERVATION_COLUMNS[status]] = count
+    for user_id, status, count in conn.execute(
+        select(Loan.user_id, Loan.status, func.count(Loan.id))
+        .where(Loan.user_id.in_(user_ids), Loan.status.in_(list(_LOAN_COLUMNS)))
+        .group_by(Loan.user_id, Loan.status)
+    ):
+        actual[user_id][_LOAN_COLUMNS[status]] = count
+    for model, column in ((Reservation, Reservation.reservation_date), (Loan, Loan.loan_date)):
+        for user_id, latest in conn.execute(
+            select(model.user_id, func.max(column)).where(model.user_id.in_(user_ids)).group_by(model.user_id)
+        ):
+            current = actual[user_id]['last_activity_at']
+            actual[user_id]['last_activity_at'] = max(filter(None, (current, latest)), default=None)
+    return actual
+
+
+def reconcile_users(conn, user_ids):
+    """
+    利用者の行を実データで修正し、(作成した行数, 修正した行数, ずれの合計) を返す
+    先に行をロックしてから数えるため、実行中の予約・貸出による増減を取りこぼしません。
+    """
+    columns = [getattr(UserActivity, name) for name in ACTIVITY_COLUMNS]
+    stored = {row.user_id: row for row in conn.execute(
+        select(UserActivity.user_id, UserActivity.last_activity_at, *columns)
+        .where(UserActivity.user_id.in_(user_ids))
+        .with_for_update()
+    )}
+    actual = _actual_activity(conn, user_ids)
+    now = datetime.utcnow()
+    missing = [{'user_id': user_id, 'reconciled_at': now, **values}
+               for user_id, values in actual.items() if user_id not in stored]
+    if missing:
+        # 同時に作成された行があれば、そちらを残す
+        conn.execute(insert(UserActivity).prefix_with('IGNORE', dialect='mysql')
+                     .prefix_with('OR IGNORE', dialect='sqlite'), missing)
+    fixed = drift = 0
+    for user_id, row in stored.items():
+        values = actual[user_id]
+        diff = sum(abs(getattr(row, name) - values[name]) for name in ACTIVITY_COLUMNS)
+        # 最終利用日時は各処理で記録するため、まだ記録がない場合だけ予約日・貸出日から補う
+        latest = row.last_activity_at or values['last_activity_at']
+        if diff or latest != row.last_activity_at:
+            conn.execute(
+                update(UserActivity)
+                .where(UserActivity.user_id == user_id)
+                .values(reconciled_at=now, last_activity_at=latest,
+                        **{name: values[name] for name in ACTIVITY_COLUMNS})
+                .execution_options(synchronize_session=False)
+            )
+            fixed += 1
+            drift += diff
+    return len(missing), fixed, drift
+
+
+def user_batches(conn, batch_size=None):
+    """利用者IDをID順に batch_size 人ずつ返す"""
+    batch_size = batch_size or RECONCILE_BATCH_SIZE
+    last_id = 0
+    while True:
+        user_ids = conn.execute(
+            select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)
+        ).scalars().all()
+        if not user_ids:
+            return
+        yield user_ids
+        last_id = user_ids[-1]
+
+
+class ActivityReconcileReport:
+    """利用者ごとの件数の再集計の結果（driftは修正した差分の合計）"""
+    def __init__(self):
+        self.users = self.created = self.fixed = self.drift = 0
+        self.seconds = 0.0
+
+    def add(self, users, created, fixed, drift):
+        self.users += users
+        self.created += created
+        self.fixed += fixed
+        self.drift += drift
+
+    def __str__(self):
+        return (f'利用者 {self.users} 人 / 作成 {self.created} 行 / 修正 {self.fixed} 行 / '
+                f'ずれ {self.drift} 件 ({self.seconds:.3f}秒)')
+
+
+def reconcile_user_activity(bind=None, batch_size=None) -> ActivityReconcileReport:
+    """
+    全利用者の件数を実データから数え直して修正
+    利用者 batch_size 人ごとに短いトランザクションで処理し、予約・貸出の処理を長く待たせません。
+    """
+    bind = bind or engine
+    report = ActivityReconcileReport()
+    start = time.perf_counter()
+    with bind.connect() as reader:
+        batches = list(user_batches(reader, batch_size))
+    for user_ids in batches:
+        with bind.begin() as conn:
+            report.add(len(user_ids), *reconcile_users(conn, user_ids))
+    report.seconds = time.perf_counter() - start
+    return report
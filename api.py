@@ -0,0 +1,337 @@
+"""
+JSON API（/api/v1）
+書籍カタログ・予約・貸出を、必要な列だけを選んだ簡潔なJSONで返します。
+レスポンスには版番号（versions.py）から作った強いETagを付け、If-None-Match が一致すれば
+行データを読まずに304を返すため、クライアントやCDNは安く再検証できます。
+
+- GET /api/v1/books?cursor=&per_page=&q=   書籍一覧（qは全文検索）
+- GET /api/v1/books/<id>                   書籍詳細
+- GET /api/v1/reservations?cursor=         予約一覧（要ログイン。管理者は全件。アーカイブ分を含む）
+- GET /api/v1/loans?cursor=                貸出一覧（要ログイン。管理者は全件。アーカイブ分を含む）
+- POST /api/v1/circulation/checkouts       予約の一括貸出（管理者のみ。circulation.py）
+- POST /api/v1/circulation/returns         貸出の一括返却（管理者のみ）
+"""
+
+import hashlib
+from datetime import date, datetime
+from functools import wraps
+
+from flask import Blueprint, Response, jsonify, request
+from flask_login import current_user
+
+from cache import invalidate_availability
+from circulation import (MAX_BATCH_ITEMS, ConcurrentUpdate, checkout_isbns, checkout_reservations,
+                         return_isbns, return_loans)
+from database import get_session, query_budget, read_only
+from models import Book, Loan, LoanArchive, Reservation, ReservationArchive, ReservationStatus
+from pagination import keyset_paginate, keyset_paginate_union, offset_cursor, offset_page
+from search import get_search_backend
+from versions import book_version, collection_version
+
+API_VERSION = 'v1'
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+
+api = Blueprint('api', __name__, url_prefix=f'/api/{API_VERSION}')
+
+# 各リソースで取得する列（テンプレート用のORMオブジェクト全体は読み込まない）
+BOOK_COLUMNS = (Book.id, Book.title, Book.author, Book.isbn, Book.publisher, Book.publication_date,
+                Book.total_copies, Book.available_copies, Book.hold_queue_head, Book.hold_queue_tail,
+                Book.created_at)
+
+
+def reservation_columns(model):
+    """予約一覧の列（現行のテーブルとアーカイブで共通）"""
+    return (model.id, model.user_id, model.book_id, Book.title, model.status, model.reservation_date,
+            model.expiry_date, model.queue_position, Book.hold_queue_head)
+
+
+def loan_columns(model):
+    """貸出一覧の列（現行のテーブルとアーカイブで共通）"""
+    return (model.id, model.user_id, model.book_id, Book.title, model.status,
+            model.loan_date, model.due_date, model.return_date)
+
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+
+def serialize_book(row):
+    return {
+        'id': row.id,
+        'title': row.title,
+        'author': row.author,
+        'isbn': row.isbn,
+        'publisher': row.publisher,
+        'publication_date': _iso(row.publication_date),
+        'total_copies': row.total_copies,
+        'available_copies': row.available_copies,
+        'waiting': max(0, row.hold_queue_tail - row.hold_queue_head),
+    }
+
+
+def serialize_reservation(row):
+    # 順番待ちの場合は現在の順番（Reservation.hold_position と同じ計算）
+    position = None
+    if row.status == ReservationStatus.WAITING and row.queue_position is not None:
+        position = max(1, row.queue_position - row.hold_queue_head)
+    return {
+        'id': row.id,
+        'user_id': row.user_id,
+        'book_id': row.book_id,
+        'title': row.title,
+        'status': row.status.value,
+        'reservation_date': _iso(row.reservation_date),
+        'expiry_date': _iso(row.expiry_date),
+        'hold_position': position,
+    }
+
+
+def serialize_loan(row):
+    return {
+        'id': row.id,
+        'user_id': row.user_id,
+        'book_id': row.book_id,
+        'title': row.title,
+        'status': row.status.value,
+        'loan_date': _iso(row.loan_date),
+        'due_date': _iso(row.due_date),
+        'return_date': _iso(row.return_date),
+    }
+
+
+def _page_json(page, serializer):
+    return {
+        'items': [serializer(row) for row in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    }
+
+
+def _per_page():
+    per_page = request.args.get('per_page', DEFAULT_PER_PAGE, type=int)
+    return min(max(per_page, 1), MAX_PER_PAGE)
+
+
+def _error(message, status):
+    return jsonify({'error': message}), status
+
+
+def json_login_required(view):
+    """未ログインの場合はログイン画面へのリダイレクトではなく401を返す"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return _error('ログインが必要です。', 401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def json_admin_required(view):
+    """管理者以外は401 / 403を返す"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return _error('ログインが必要です。', 401)
+        if not current_user.is_admin():
+            return _error('管理者権限が必要です。', 403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def make_etag(name, version, variant=''):
+    """
+    版番号とリクエストの種類（URL・利用者など）から強いETagを作る
+    versionは行データより先に読むこと（後に読むと、読んだ内容より新しい番号を付けてしまう）
+    """
+    digest = hashlib.sha1(f'{API_VERSION}:{variant}'.encode('utf-8')).hexdigest()[:16]
+    return f'{name}-{version}-{digest}'
+
+
+def conditional(etag, build, private=False):
+    """
+    If-None-Match がETagと一致すれば304を返し、一致しなければbuild()の結果をJSONで返す
+    etagがNone（版番号がまだない）の場合はETagを付けずに返します。
+    """
+    if etag is not None and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    if etag is not None:
+        response.set_etag(etag)
+    # 毎回再検証させる（利用者ごとの一覧は共有キャッシュに保存させない）
+    response.headers['Cache-Control'] = 'private, no-cache' if private else 'public, no-cache'
+    if private:
+        response.vary.add('Cookie')
+    return response
+
+
+def _versioned(name, version, variant):
+    return make_etag(name, version, variant) if version is not None else None
+
+
+def _user_variant():
+    return f'{request.full_path}:{current_user.id}:{current_user.is_admin()}'
+
+
+# ==================== 書籍 ====================
+
+@api.route('/books')
+@query_budget(4)
+@read_only
+def books():
+    """書籍一覧"""
+    db = get_session()
+    etag = _versioned('books', collection_version(db, 'books'), request.full_path)
+    cursor = request.args.get('cursor')
+    per_page = _per_page()
+    search_query = request.args.get('q', '')
+
+    def build():
+        if search_query:
+            offset = offset_cursor(cursor)
+            result = get_search_backend().search(db, search_query, limit=per_page, offset=offset)
+            return _page_json(offset_page(result.books, offset, per_page, result.total), serialize_book)
+        page = keyset_paginate(db.query(*BOOK_COLUMNS), Book.created_at, Book.id,
+                               cursor=cursor, per_page=per_page)
+        return _page_json(page, serialize_book)
+
+    return conditional(etag, build)
+
+
+@api.route('/books/<int:book_id>')
+@query_budget(2)
+@read_only
+def book(book_id):
+    """書籍詳細"""
+    db = get_session()
+    version = book_version(db, book_id)
+    if version is None:
+        return _error('書籍が見つかりません。', 404)
+
+    def build():
+        row = db.query(*BOOK_COLUMNS).filter(Book.id == book_id).first()
+        return serialize_book(row)
+
+    return conditional(make_etag(f'book-{book_id}', version), build)
+
+
+# ==================== 予約・貸出 ====================
+
+def _own_rows(query, model):
+    """本人の分に絞る（管理者は全件）"""
+    if current_user.is_admin():
+        return query
+    return query.filter(model.user_id == current_user.id)
+
+
+@api.route('/reservations')
+@query_budget(4)
+@read_only
+@json_login_required
+def reservations():
+    """予約一覧（本人の分。管理者は全件）"""
+    db = get_session()
+    etag = _versioned('reservations', collection_version(db, 'reservations'), _user_variant())
+
+    def build():
+        # アーカイブへの移動では一覧の内容が変わらないため、版番号（ETag）はそのまま使える
+        page = keyset_paginate_union(
+            [(_own_rows(db.query(*reservation_columns(model)).select_from(model).join(model.book), model),
+              model.reservation_date, model.id) for model in (Reservation, ReservationArchive)],
+            cursor=request.args.get('cursor'), per_page=_per_page())
+        return _page_json(page, serialize_reservation)
+
+    return conditional(etag, build, private=True)
+
+
+@api.route('/loans')
+@query_budget(4)
+@read_only
+@json_login_required
+def loans():
+    """貸出一覧（本人の分。管理者は全件）"""
+    db = get_session()
+    etag = _versioned('loans', collection_version(db, 'loans'), _user_variant())
+
+    def build():
+        page = keyset_paginate_union(
+            [(_own_rows(db.query(*loan_columns(model)).select_from(model).join(model.book), model),
+              model.loan_date, model.id) for model in (Loan, LoanArchive)],
+            cursor=request.args.get('cursor'), per_page=_per_page())
+        return _page_json(page, serialize_loan)
+
+    return conditional(etag, build, private=True)
+
+
+# ==================== 貸出・返却（一括） ====================
+
+class BadBatch(ValueError):
+    """一括処理のリクエストの形式が正しくない"""
+
+
+def _batch_list(payload, key, item_type):
+    values = payload.get(key)
+    if values is None:
+        return None
+    if not isinstance(values, list) or not all(isinstance(v, item_type) and not isinstance(v, bool)
+                                                for v in values):
+        raise BadBatch(f'{key} は{"整数" if item_type is int else "文字列"}の配列で指定してください。')
+    if len(values) > MAX_BATCH_ITEMS:
+        raise BadBatch(f'1回に処理できるのは {MAX_BATCH_ITEMS} 件までです。')
+    return values
+
+
+def _run_batch(process):
+    """一括処理を実行し、在庫が変わった書籍のキャッシュを無効化して結果を返す"""
+    try:
+        result = process()
+    except BadBatch as e:
+        return _error(str(e), 400)
+    except ConcurrentUpdate:
+        return _error('他の処理と競合しました。もう一度お試しください。', 409)
+    for book_id in result.book_ids:
+        invalidate_availability(book_id)
+    return jsonify(result.as_dict())
+
+
+@api.route('/circulation/checkouts', methods=['POST'])
+@json_admin_required
+def batch_checkout():
+    """
+    予約の一括貸出
+    {"reservation_ids": [1, 2]} または {"user_id": 3, "isbns": ["978..."]}（利用者の待機中の予約をISBNで指定）
+    """
+    payload = request.get_json(silent=True) or {}
+    db = get_session()
+
+    def process():
+        reservation_ids = _batch_list(payload, 'reservation_ids', int)
+        if reservation_ids is not None:
+            return checkout_reservations(db, reservation_ids)
+        isbns = _batch_list(payload, 'isbns', str)
+        user_id = payload.get('user_id')
+        if isbns is None or not isinstance(user_id, int):
+            raise BadBatch('reservation_ids、または user_id と isbns を指定してください。')
+        return checkout_isbns(db, user_id, isbns)
+
+    return _run_batch(process)
+
+
+@api.route('/circulation/returns', methods=['POST'])
+@json_admin_required
+def batch_return():
+    """貸出の一括返却 {"loan_ids": [1, 2]} または {"isbns": ["978..."]}（返却ボックスのバーコード）"""
+    payload = request.get_json(silent=True) or {}
+    db = get_session()
+
+    def process():
+        loan_ids = _batch_list(payload, 'loan_ids', int)
+        if loan_ids is not None:
+            return return_loans(db, loan_ids)
+        isbns = _batch_list(payload, 'isbns', str)
+        if isbns is None:
+            raise BadBatch('loan_ids または isbns を指定してください。')
+        return return_isbns(db, isbns)
+
+    return _run_batch(process)
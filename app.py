@@ -1,10 +1,30 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, Response, jsonify, render_template, request, redirect, url_for, flash, session
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from sqlalchemy import or_, func
+from sqlalchemy import or_, func, update
+from sqlalchemy.orm import joinedload
 from datetime import datetime, timedelta
-from database import init_db, get_db, SessionLocal
-from models import User, Book, Reservation, Loan, UserRole, ReservationStatus, LoanStatus
-from auth import UserLogin, hash_password, verify_password, get_user_by_username, get_user_by_email, get_user_by_id
+from database import (init_db, get_session, read_only, read_from_primary, init_request_session, query_budget,
+                      pool_status, replicas, init_replica_routing, ping_database)
+from models import (User, Book, Reservation, Loan, UserRole, ReservationStatus, LoanStatus, ImportJob, UserActivity,
+                    ReservationArchive, LoanArchive)
+from auth import (UserLogin, hash_password, verify_password, get_user_by_username, get_user_by_email,
+                  get_user_by_id, get_cached_login, login_from_user, parse_session_id, needs_rehash)
+from passwords import hasher, PasswordHashBusy
+from search import get_search_backend
+from pagination import Page, keyset_paginate, keyset_paginate_union, offset_cursor, offset_page, count_cache
+from jobs import scheduler, start_scheduler
+from inventory import take_copy, put_back_copy, change_total_copies, lock_book, run_with_retry
+from holds import (enqueue_hold, promote_next_hold, promote_holds, has_waiting_holds, waiting_count, holds_copy,
+                   release_held_copies)
+from cache import cache, get_book, get_books, get_page, remember_books, invalidate_book, invalidate_availability
+from stats import adjust, record_loan, forget_book, get_stats, loans_per_day, top_borrowed
+from activity import (adjust_user, claim_reservation, LimitExceeded, MAX_LOANS, MAX_RESERVATIONS,
+                      get_activity, loans_remaining)
+from versions import touch
+from metrics import init_metrics, request_metrics
+from api import api
+from importer import FORMATS, create_job, detect_format, save_upload, start_background_import
+from exports import EXPORTS, FORMATS as EXPORT_FORMATS, ExportFilter, export_filename, generate_export
 import os
 
 app = Flask(__name__)
@@ -17,18 +37,57 @@ login_manager.login_view = 'login'
 login_manager.login_message = 'ログインが必要です。'
 login_manager.login_message_category = 'info'
 
+# ルートごとの応答時間・SQL数の計測と /metrics（セッションのコミットまで含めるよう先に登録する）
+init_metrics(app)
+
+# 1リクエストで1つのセッションを使い、リクエストの終わりにコミット（エラー時はロールバック）して閉じる
+init_request_session(app)
+
+# 読み取り専用のルートをレプリカに振り分け、書き込み直後はプライマリから読む
+init_replica_routing(app)
+
+# JSON API（/api/v1）
+app.register_blueprint(api)
+
+# 予約・貸出・管理画面の一覧の1ページあたりの件数
+LIST_PER_PAGE = 50
+
 @login_manager.user_loader
-def load_user(user_id):
-    db = next(get_db())
-    user = get_user_by_id(db, int(user_id))
-    db.close()
-    if user:
-        return UserLogin(user)
-    return None
-
-# データベース初期化
+def load_user(session_id):
+    # キャッシュにあればDBは読まない（役割・パスワードの変更時はキャッシュから削除される）
+    login = get_cached_login(session_id)
+    if login:
+        return login
+    user_id, version = parse_session_id(session_id)
+    if version is None:
+        return None
+    # ルートと同じセッションを使う（読み込んだユーザーはリクエスト内で再利用される）
+    # 降格・パスワード変更の直後に遅れているレプリカの古い行をキャッシュしないよう、プライマリから読む
+    with read_from_primary():
+        user = get_user_by_id(get_session(), user_id)
+    return login_from_user(user, session_id)
+
+# スキーマのバージョン確認（マイグレーションは python migrations.py upgrade で適用）
 init_db(app)
 
+# 定期ジョブ（延滞の更新など）を開始
+start_scheduler()
+
+# ==================== 稼働確認 ====================
+
+@app.route('/healthz')
+def healthz():
+    """死活確認（プロセスが応答できるか。DBには接続しない）"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """受付可能か（プライマリDBに接続できるか）。ロードバランサーの振り分けに使う"""
+    error = ping_database()
+    if error:
+        return jsonify({'status': 'unavailable', 'error': error}), 503
+    return jsonify({'status': 'ok', 'pid': os.getpid()})
+
 # ==================== 認証関連 ====================
 
 @app.route('/')
@@ -53,7 +112,7 @@ def register():
             flash('パスワードが一致しません。', 'error')
             return render_template('auth/register.html')
         
-        db = SessionLocal()
+        db = get_session()
         try:
             # ユーザー名とメールアドレスの重複チェック
             if get_user_by_username(db, username):
@@ -69,18 +128,23 @@ def register():
                 username=username,
                 email=email,
                 password_hash=hash_password(password),
-                role=UserRole.USER
+                role=UserRole.USER,
+                activity=UserActivity()
             )
             db.add(new_user)
+            adjust(db, total_users=1)
             db.commit()
+            count_cache.invalidate('users')
             
             flash('登録が完了しました。ログインしてください。', 'success')
             return redirect(url_for('login'))
+        except PasswordHashBusy:
+            db.rollback()
+            flash('現在混雑しています。しばらくしてから再度お試しください。', 'error')
+            return render_template('auth/register.html'), 503
         except Exception as e:
             db.rollback()
             flash(f'登録中にエラーが発生しました: {str(e)}', 'error')
-        finally:
-            db.close()
     
     return render_template('auth/register.html')
 
@@ -95,18 +159,25 @@ def login():
             flash('ユーザー名とパスワードを入力してください。', 'error')
             return render_template('auth/login.html')
         
-        db = SessionLocal()
+        db = get_session()
         try:
             user = get_user_by_username(db, username)
             if user and verify_password(user.password_hash, password):
+                # KDFのパラメータが変わっていればハッシュを再計算
+                # （パスワード自体は変わらないため、認証バージョンを上げないようSQLで直接更新）
+                if needs_rehash(user.password_hash):
+                    db.execute(update(User).where(User.id == user.id)
+                               .values(password_hash=hash_password(password)))
+                    db.commit()
                 login_user(UserLogin(user))
                 flash('ログインしました。', 'success')
                 next_page = request.args.get('next')
                 return redirect(next_page or url_for('book_list'))
             else:
                 flash('ユーザー名またはパスワードが正しくありません。', 'error')
-        finally:
-            db.close()
+        except PasswordHashBusy:
+            flash('現在ログインが混雑しています。しばらくしてから再度お試しください。', 'error')
+            return render_template('auth/login.html'), 503
     
     return render_template('auth/login.html')
 
@@ -121,126 +192,181 @@ def logout():
 # ==================== 書籍関連 ====================
 
 @app.route('/books')
+@query_budget(4)
+@read_only
 def book_list():
     """書籍一覧"""
-    db = SessionLocal()
-    try:
-        page = request.args.get('page', 1, type=int)
-        per_page = 20
-        search_query = request.args.get('q', '')
-        
-        query = db.query(Book)
-        
-        if search_query:
-            query = query.filter(
-                or_(
-                    Book.title.like(f'%{search_query}%'),
-                    Book.author.like(f'%{search_query}%'),
-                    Book.isbn.like(f'%{search_query}%')
-                )
-            )
-        
-        books = query.order_by(Book.created_at.desc()).offset((page - 1) * per_page).limit(per_page).all()
-        total = query.count()
-        
-        return render_template('books/list.html', books=books, page=page, 
-                             per_page=per_page, total=total, search_query=search_query)
-    finally:
-        db.close()
+    db = get_session()
+    cursor = request.args.get('cursor')
+    per_page = 20
+    search_query = request.args.get('q', '')
+    
+    if search_query:
+        # 全文検索インデックスを使って関連度順に取得（書籍IDと件数をキャッシュ）
+        offset = offset_cursor(cursor)
+        
+        def search_page():
+            result = get_search_backend().search(db, search_query, limit=per_page, offset=offset)
+            remember_books(result.books)
+            return [book.id for book in result.books], result.total
+        
+        book_ids, total = get_page(f'search:{search_query}:{offset}', search_page)
+        page = offset_page(get_books(db, book_ids), offset, per_page, total)
+    else:
+        total = count_cache.get('books', lambda: db.query(func.count(Book.id)).scalar())
+        
+        def list_page():
+            result = keyset_paginate(db.query(Book), Book.created_at, Book.id,
+                                     cursor=cursor, per_page=per_page)
+            remember_books(result.items)
+            return [book.id for book in result.items], result.next_cursor, result.prev_cursor
+        
+        book_ids, next_cursor, prev_cursor = get_page(f'list:{cursor}', list_page)
+        page = Page(get_books(db, book_ids), per_page,
+                    next_cursor=next_cursor, prev_cursor=prev_cursor, total=total)
+    
+    return render_template('books/list.html', books=page.items, page=page, search_query=search_query)
 
 @app.route('/books/<int:book_id>')
+@query_budget(4)
+@read_only
 def book_detail(book_id):
     """書籍詳細"""
-    db = SessionLocal()
-    try:
-        book = db.query(Book).filter_by(id=book_id).first()
-        if not book:
-            flash('書籍が見つかりません。', 'error')
-            return redirect(url_for('book_list'))
-        
-        # ユーザーが既に予約しているかチェック
-        has_reservation = False
-        if current_user.is_authenticated:
-            reservation = db.query(Reservation).filter_by(
-                user_id=current_user.id,
-                book_id=book_id,
-                status=ReservationStatus.PENDING
-            ).first()
-            has_reservation = reservation is not None
-        
-        return render_template('books/detail.html', book=book, has_reservation=has_reservation)
-    finally:
-        db.close()
+    db = get_session()
+    book = get_book(db, book_id)
+    if not book:
+        flash('書籍が見つかりません。', 'error')
+        return redirect(url_for('book_list'))
+    
+    # ユーザーが既に予約（または順番待ち）しているかチェック
+    reservation = None
+    if current_user.is_authenticated:
+        reservation = db.query(Reservation).filter(
+            Reservation.user_id == current_user.id,
+            Reservation.book_id == book_id,
+            Reservation.status.in_([ReservationStatus.PENDING, ReservationStatus.WAITING])
+        ).first()
+    
+    return render_template('books/detail.html', book=book,
+                         has_reservation=reservation is not None,
+                         hold_position=reservation.hold_position() if reservation else None,
+                         can_reserve=book.is_available() and not has_waiting_holds(book),
+                         waiting_count=waiting_count(book))
 
 @app.route('/books/<int:book_id>/reserve', methods=['POST'])
 @login_required
 def reserve_book(book_id):
     """書籍を予約"""
-    db = SessionLocal()
+    db = get_session()
     try:
-        book = db.query(Book).filter_by(id=book_id).first()
-        if not book:
+        def reserve():
+            # 在庫・順番待ちの判定と順番待ちへの追加が同時の予約と競合しないよう、書籍の行を先に排他ロックする
+            # キャッシュは使わず、常にDBの最新の値で判定する
+            book = lock_book(db, book_id)
+            if not book:
+                db.rollback()
+                return 'not_found', None
+            
+            # 既に予約（または順番待ち）していないかチェック
+            existing_reservation = db.query(Reservation).filter(
+                Reservation.user_id == current_user.id,
+                Reservation.book_id == book_id,
+                Reservation.status.in_([ReservationStatus.PENDING, ReservationStatus.WAITING])
+            ).first()
+            if existing_reservation:
+                db.rollback()
+                return 'duplicate', None
+            
+            # 在庫がない、または順番待ちの利用者がいる場合は順番待ちに登録
+            waiting = has_waiting_holds(book) or book.available_copies <= 0
+            
+            # 利用者の上限（利用者ごとの件数の1行を主キーで更新するだけで、予約・貸出は数えない）
+            try:
+                claim_reservation(db, current_user.id, waiting=waiting)
+            except LimitExceeded as e:
+                db.rollback()
+                return 'limit', str(e)
+            
+            if waiting:
+                reservation = enqueue_hold(db, current_user.id, book_id)
+                touch(db, 'books', 'reservations')
+                db.commit()
+                return 'waiting', reservation.hold_position()
+            
+            # 予約作成
+            db.add(Reservation(
+                user_id=current_user.id,
+                book_id=book_id,
+                status=ReservationStatus.PENDING
+            ))
+            adjust(db, pending_reservations=1)
+            touch(db, 'reservations')
+            db.commit()
+            return 'ok', None
+        
+        result, detail = run_with_retry(db, reserve)
+        if result == 'not_found':
             flash('書籍が見つかりません。', 'error')
             return redirect(url_for('book_list'))
-        
-        if not book.is_available():
-            flash('この書籍は現在利用できません。', 'error')
-            return redirect(url_for('book_detail', book_id=book_id))
-        
-        # 既に予約していないかチェック
-        existing_reservation = db.query(Reservation).filter_by(
-            user_id=current_user.id,
-            book_id=book_id,
-            status=ReservationStatus.PENDING
-        ).first()
-        
-        if existing_reservation:
+        if result == 'duplicate':
             flash('既にこの書籍を予約しています。', 'error')
-            return redirect(url_for('book_detail', book_id=book_id))
-        
-        # 予約作成
-        reservation = Reservation(
-            user_id=current_user.id,
-            book_id=book_id,
-            status=ReservationStatus.PENDING
-        )
-        db.add(reservation)
-        db.commit()
-        
-        flash('予約が完了しました。', 'success')
+        elif result == 'limit':
+            flash(detail, 'error')
+        elif result == 'waiting':
+            invalidate_availability(book_id)
+            flash(f'順番待ちに登録しました（{detail}番目）。', 'success')
+        else:
+            flash('予約が完了しました。', 'success')
         return redirect(url_for('book_detail', book_id=book_id))
     except Exception as e:
         db.rollback()
         flash(f'予約中にエラーが発生しました: {str(e)}', 'error')
-    finally:
-        db.close()
     
     return redirect(url_for('book_detail', book_id=book_id))
 
 # ==================== 予約関連 ====================
 
+def _activity_summary(db):
+    """一覧画面に表示する利用者自身の件数と上限（管理者は表示しない）"""
+    if current_user.is_admin():
+        return {}
+    return {'activity': get_activity(db, current_user.id),
+            'max_loans': MAX_LOANS, 'max_reservations': MAX_RESERVATIONS}
+
+def _history_query(db, model, *book_columns):
+    """一覧に表示する行（本人の分。管理者は全件）。現行のテーブルとアーカイブで同じ形のクエリを作る"""
+    # テンプレートで使う列だけを1回のJOINで取得（N+1クエリの回避）
+    # （外部キーの削除連動がないSQLiteでも、削除済みの書籍のアーカイブの行は内部結合で除く）
+    query = db.query(model).options(
+        joinedload(model.user).load_only(User.username),
+        joinedload(model.book, innerjoin=True).load_only(*book_columns),
+    )
+    if not current_user.is_admin():
+        query = query.filter(model.user_id == current_user.id)
+    return query
+
 @app.route('/reservations')
+@query_budget(4)
+@read_only
 @login_required
 def reservation_list():
-    """予約一覧"""
-    db = SessionLocal()
-    try:
-        if current_user.is_admin():
-            reservations = db.query(Reservation).order_by(Reservation.reservation_date.desc()).all()
-        else:
-            reservations = db.query(Reservation).filter_by(
-                user_id=current_user.id
-            ).order_by(Reservation.reservation_date.desc()).all()
-        
-        return render_template('reservations/list.html', reservations=reservations)
-    finally:
-        db.close()
+    """予約一覧（アーカイブに移動した古い予約も合わせて表示）"""
+    db = get_session()
+    book_columns = (Book.title, Book.author, Book.hold_queue_head)
+    page = keyset_paginate_union(
+        [(_history_query(db, Reservation, *book_columns), Reservation.reservation_date, Reservation.id),
+         (_history_query(db, ReservationArchive, *book_columns), ReservationArchive.reservation_date,
+          ReservationArchive.id)],
+        cursor=request.args.get('cursor'), per_page=LIST_PER_PAGE)
+    
+    return render_template('reservations/list.html', reservations=page.items, page=page,
+                         **_activity_summary(db))
 
 @app.route('/reservations/<int:reservation_id>/cancel', methods=['POST'])
 @login_required
 def cancel_reservation(reservation_id):
     """予約をキャンセル"""
-    db = SessionLocal()
+    db = get_session()
     try:
         reservation = db.query(Reservation).filter_by(id=reservation_id).first()
         if not reservation:
@@ -256,43 +382,62 @@ def cancel_reservation(reservation_id):
             flash('この予約は既にキャンセルされています。', 'error')
             return redirect(url_for('reservation_list'))
         
-        reservation.status = ReservationStatus.CANCELLED
+        if reservation.status == ReservationStatus.EXPIRED:
+            flash('この予約は有効期限が切れています。', 'error')
+            return redirect(url_for('reservation_list'))
+        
+        # 期限切れ処理などと同時に更新された場合は取り消さない（集計値の二重計上を防ぐ）
+        previous_status = reservation.status
+        held, book_id = holds_copy(reservation), reservation.book_id
+        cancelled = db.execute(
+            update(Reservation)
+            .where(Reservation.id == reservation_id, Reservation.status == previous_status)
+            .values(status=ReservationStatus.CANCELLED),
+            execution_options={'synchronize_session': False},
+        ).rowcount == 1
+        if not cancelled:
+            db.rollback()
+            flash('この予約は既に処理されています。', 'error')
+            return redirect(url_for('reservation_list'))
+        if previous_status == ReservationStatus.PENDING:
+            adjust(db, pending_reservations=-1)
+            adjust_user(db, reservation.user_id, pending_reservations=-1)
+        elif previous_status == ReservationStatus.WAITING:
+            adjust_user(db, reservation.user_id, waiting_reservations=-1)
+        if held:
+            # 繰り上げで確保していた1冊を次の順番待ちに回す（いなければ在庫に戻す）
+            release_held_copies(db, {book_id: 1})
+            touch(db, 'books')
+        touch(db, 'reservations')
         db.commit()
+        if held:
+            invalidate_availability(book_id)
         
         flash('予約をキャンセルしました。', 'success')
         return redirect(url_for('reservation_list'))
     except Exception as e:
         db.rollback()
         flash(f'キャンセル中にエラーが発生しました: {str(e)}', 'error')
-    finally:
-        db.close()
     
     return redirect(url_for('reservation_list'))
 
 # ==================== 貸出関連 ====================
 
 @app.route('/loans')
+@query_budget(4)
+@read_only
 @login_required
 def loan_list():
-    """貸出一覧"""
-    db = SessionLocal()
-    try:
-        if current_user.is_admin():
-            loans = db.query(Loan).order_by(Loan.loan_date.desc()).all()
-        else:
-            loans = db.query(Loan).filter_by(
-                user_id=current_user.id
-            ).order_by(Loan.loan_date.desc()).all()
-        
-        # 延滞チェック
-        for loan in loans:
-            if loan.is_overdue() and loan.status == LoanStatus.ACTIVE:
-                loan.status = LoanStatus.OVERDUE
-                db.commit()
-        
-        return render_template('loans/list.html', loans=loans)
-    finally:
-        db.close()
+    """貸出一覧（アーカイブに移動した古い貸出も合わせて表示）"""
+    db = get_session()
+    book_columns = (Book.title, Book.author)
+    page = keyset_paginate_union(
+        [(_history_query(db, Loan, *book_columns), Loan.loan_date, Loan.id),
+         (_history_query(db, LoanArchive, *book_columns), LoanArchive.loan_date, LoanArchive.id)],
+        cursor=request.args.get('cursor'), per_page=LIST_PER_PAGE)
+    
+    # 延滞ステータスの更新は定期ジョブ（jobs.sweep_overdue_loans）が行うため、ここでは読み取りのみ
+    return render_template('loans/list.html', loans=page.items, page=page, **_activity_summary(db))
 
 @app.route('/reservations/<int:reservation_id>/loan', methods=['POST'])
 @login_required
@@ -302,7 +447,7 @@ def create_loan(reservation_id):
         flash('この操作は管理者のみ実行できます。', 'error')
         return redirect(url_for('reservation_list'))
     
-    db = SessionLocal()
+    db = get_session()
     try:
         reservation = db.query(Reservation).filter_by(id=reservation_id).first()
         if not reservation:
@@ -313,33 +458,58 @@ def create_loan(reservation_id):
             flash('この予約は貸出できません。', 'error')
             return redirect(url_for('reservation_list'))
         
-        book = reservation.book
-        if not book.is_available():
+        user_id, book_id = reservation.user_id, reservation.book_id
+        # 順番待ちから繰り上げた予約は、繰り上げ時に確保した1冊を貸し出す
+        held = holds_copy(reservation)
+        
+        def checkout():
+            # 予約を確認済みに（他の管理者が先に処理した場合は更新されない）
+            claimed = db.execute(
+                update(Reservation)
+                .where(Reservation.id == reservation_id, Reservation.status == ReservationStatus.PENDING)
+                .values(status=ReservationStatus.CONFIRMED),
+                execution_options={'synchronize_session': False},
+            ).rowcount == 1
+            if not claimed:
+                db.rollback()
+                return 'not_pending'
+            
+            # 在庫を減らす（在庫がなければ予約の更新も取り消す）
+            if not held and not take_copy(db, book_id):
+                db.rollback()
+                return 'unavailable'
+            
+            # 利用者の貸出の上限（一括貸出と同じ確認。利用者の行をロックして読む）
+            if loans_remaining(db, [user_id])[user_id] <= 0:
+                db.rollback()
+                return 'limit'
+            
+            # 貸出作成（集計値も同じトランザクションで更新）
+            db.add(Loan(user_id=user_id, book_id=book_id, reservation_id=reservation_id))
+            adjust(db, pending_reservations=-1, active_loans=1)
+            adjust_user(db, user_id, pending_reservations=-1, active_loans=1)
+            record_loan(db, book_id)
+            touch(db, 'books', 'reservations', 'loans')
+            db.commit()
+            return 'ok'
+        
+        result = run_with_retry(db, checkout)
+        invalidate_availability(book_id)
+        if result == 'not_pending':
+            flash('この予約は貸出できません。', 'error')
+            return redirect(url_for('reservation_list'))
+        if result == 'unavailable':
             flash('この書籍は現在利用できません。', 'error')
             return redirect(url_for('reservation_list'))
-        
-        # 貸出作成
-        loan = Loan(
-            user_id=reservation.user_id,
-            book_id=reservation.book_id
-        )
-        db.add(loan)
-        
-        # 予約を確認済みに
-        reservation.status = ReservationStatus.CONFIRMED
-        
-        # 在庫を減らす
-        book.available_copies -= 1
-        
-        db.commit()
+        if result == 'limit':
+            flash(f'貸出中の書籍が上限（{MAX_LOANS}冊）に達しています。', 'error')
+            return redirect(url_for('reservation_list'))
         
         flash('貸出手続きが完了しました。', 'success')
         return redirect(url_for('loan_list'))
     except Exception as e:
         db.rollback()
         flash(f'貸出手続き中にエラーが発生しました: {str(e)}', 'error')
-    finally:
-        db.close()
     
     return redirect(url_for('reservation_list'))
 
@@ -351,7 +521,7 @@ def return_loan(loan_id):
         flash('この操作は管理者のみ実行できます。', 'error')
         return redirect(url_for('loan_list'))
     
-    db = SessionLocal()
+    db = get_session()
     try:
         loan = db.query(Loan).filter_by(id=loan_id).first()
         if not loan:
@@ -362,29 +532,51 @@ def return_loan(loan_id):
             flash('この貸出は既に返却されています。', 'error')
             return redirect(url_for('loan_list'))
         
-        # 返却処理
-        loan.return_date = datetime.utcnow()
-        loan.status = LoanStatus.RETURNED
-        
-        # 在庫を戻す
-        book = loan.book
-        book.available_copies += 1
+        user_id, book_id = loan.user_id, loan.book_id
+        
+        def check_in():
+            # 返却処理（他の管理者が先に返却した場合は更新されない）
+            # 延滞の更新と競合しても集計値がずれないよう、返却前の状態ごとに条件付きで更新する
+            for status, counter in ((LoanStatus.ACTIVE, 'active_loans'), (LoanStatus.OVERDUE, 'overdue_loans')):
+                returned = db.execute(
+                    update(Loan)
+                    .where(Loan.id == loan_id, Loan.status == status)
+                    .values(status=LoanStatus.RETURNED, return_date=datetime.utcnow()),
+                    execution_options={'synchronize_session': False},
+                ).rowcount == 1
+                if returned:
+                    adjust(db, **{counter: -1})
+                    adjust_user(db, user_id, **{counter: -1})
+                    break
+            else:
+                db.rollback()
+                return False
+            
+            # 在庫を戻し、順番待ちの先頭を予約に繰り上げる
+            put_back_copy(db, book_id)
+            promote_next_hold(db, book_id)
+            touch(db, 'books', 'reservations', 'loans')
+            db.commit()
+            return True
         
-        db.commit()
+        returned = run_with_retry(db, check_in)
+        invalidate_availability(book_id)
+        if not returned:
+            flash('この貸出は既に返却されています。', 'error')
+            return redirect(url_for('loan_list'))
         
         flash('返却処理が完了しました。', 'success')
         return redirect(url_for('loan_list'))
     except Exception as e:
         db.rollback()
         flash(f'返却処理中にエラーが発生しました: {str(e)}', 'error')
-    finally:
-        db.close()
     
     return redirect(url_for('loan_list'))
 
 # ==================== 管理画面 ====================
 
 @app.route('/admin')
+@query_budget(5)
 @login_required
 def admin_dashboard():
     """管理画面ダッシュボード"""
@@ -392,23 +584,28 @@ def admin_dashboard():
         flash('管理者権限が必要です。', 'error')
         return redirect(url_for('book_list'))
     
-    db = SessionLocal()
-    try:
-        # 統計情報
-        total_books = db.query(Book).count()
-        total_users = db.query(User).count()
-        total_reservations = db.query(Reservation).filter_by(status=ReservationStatus.PENDING).count()
-        active_loans = db.query(Loan).filter_by(status=LoanStatus.ACTIVE).count()
-        overdue_loans = db.query(Loan).filter_by(status=LoanStatus.OVERDUE).count()
-        
-        return render_template('admin/dashboard.html',
-                             total_books=total_books,
-                             total_users=total_users,
-                             total_reservations=total_reservations,
-                             active_loans=active_loans,
-                             overdue_loans=overdue_loans)
-    finally:
-        db.close()
+    db = get_session()
+    # 統計情報（各処理で更新している集計値のスロットを合計して読むだけ）
+    stats = get_stats(db)
+    
+    return render_template('admin/dashboard.html',
+                         total_books=stats.total_books,
+                         total_users=stats.total_users,
+                         total_reservations=stats.pending_reservations,
+                         active_loans=stats.active_loans,
+                         overdue_loans=stats.overdue_loans,
+                         stats_reconciled_at=stats.reconciled_at,
+                         loans_per_day=loans_per_day(db),
+                         top_books=top_borrowed(db),
+                         export_formats=EXPORT_FORMATS,
+                         jobs=scheduler.status(db),
+                         cache_backend=cache.name,
+                         cache_stats=cache.stats.as_dict(),
+                         password_stats=hasher.stats(),
+                         pool_stats=pool_status(),
+                         replica_stats=replicas.status(),
+                         route_stats=request_metrics.route_summary(),
+                         slow_queries=request_metrics.slow_query_summary())
 
 @app.route('/admin/books', methods=['GET', 'POST'])
 @login_required
@@ -418,7 +615,7 @@ def admin_books():
         flash('管理者権限が必要です。', 'error')
         return redirect(url_for('book_list'))
     
-    db = SessionLocal()
+    db = get_session()
     try:
         if request.method == 'POST':
             action = request.form.get('action')
@@ -435,7 +632,12 @@ def admin_books():
                     available_copies=int(request.form.get('total_copies', 1))
                 )
                 db.add(book)
+                adjust(db, total_books=1)
+                touch(db, 'books', 'catalog')
                 db.commit()
+                get_search_backend().index_book(book)
+                invalidate_book(book.id)
+                count_cache.invalidate('books')
                 flash('書籍を追加しました。', 'success')
             
             elif action == 'edit':
@@ -449,12 +651,16 @@ def admin_books():
                     book.publisher = request.form.get('publisher') or None
                     if request.form.get('publication_date'):
                         book.publication_date = datetime.strptime(request.form.get('publication_date'), '%Y-%m-%d').date()
-                    # 総冊数の変更時、利用可能冊数も調整
+                    # 総冊数の変更時、利用可能冊数も差分だけ調整（貸出・返却と競合しないようSQLで更新）
                     new_total = int(request.form.get('total_copies', 1))
-                    diff = new_total - book.total_copies
-                    book.total_copies = new_total
-                    book.available_copies = max(0, book.available_copies + diff)
+                    added_copies = new_total - book.total_copies
+                    change_total_copies(db, book_id, new_total)
+                    # 増えた冊数分だけ順番待ちを繰り上げる
+                    promote_holds(db, book_id, added_copies)
+                    touch(db, 'books', 'reservations', 'catalog')
                     db.commit()
+                    get_search_backend().index_book(book)
+                    invalidate_book(book_id)
                     flash('書籍を更新しました。', 'success')
             
             elif action == 'delete':
@@ -462,21 +668,93 @@ def admin_books():
                 book_id = int(request.form.get('book_id'))
                 book = db.query(Book).filter_by(id=book_id).first()
                 if book:
+                    forget_book(db, book_id)
                     db.delete(book)
+                    touch(db, 'books', 'reservations', 'loans', 'catalog')
                     db.commit()
+                    get_search_backend().remove_book(book_id)
+                    invalidate_book(book_id)
+                    count_cache.invalidate('books')
                     flash('書籍を削除しました。', 'success')
         
-        books = db.query(Book).order_by(Book.created_at.desc()).all()
-        return render_template('admin/books.html', books=books)
+        total = count_cache.get('books', lambda: db.query(func.count(Book.id)).scalar())
+        page = keyset_paginate(db.query(Book), Book.created_at, Book.id,
+                               cursor=request.args.get('cursor'), per_page=LIST_PER_PAGE, total=total)
+        return render_template('admin/books.html', books=page.items, page=page)
     except Exception as e:
         db.rollback()
         flash(f'エラーが発生しました: {str(e)}', 'error')
-    finally:
-        db.close()
     
-    return render_template('admin/books.html', books=[])
+    return render_template('admin/books.html', books=[], page=None)
+
+@app.route('/admin/books/import', methods=['GET', 'POST'])
+@login_required
+def admin_import_books():
+    """書籍の一括インポート（CSV / JSONL / MARC）"""
+    if not current_user.is_admin():
+        flash('管理者権限が必要です。', 'error')
+        return redirect(url_for('book_list'))
+    
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('ファイルを選択してください。', 'error')
+            return redirect(url_for('admin_import_books'))
+        try:
+            fmt = request.form.get('format') or detect_format(upload.filename)
+            job_id = create_job(save_upload(upload), fmt)
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('admin_import_books'))
+        # 大きなファイルでもリクエストを待たせないよう、バックグラウンドで取り込む
+        start_background_import(job_id)
+        flash(f'インポートを開始しました（ジョブ {job_id}）。', 'success')
+        return redirect(url_for('admin_import_books'))
+    
+    db = get_session()
+    jobs = db.query(ImportJob).order_by(ImportJob.id.desc()).limit(20).all()
+    return render_template('admin/import.html', jobs=jobs, formats=FORMATS)
+
+@app.route('/admin/books/import/<int:job_id>/resume', methods=['POST'])
+@login_required
+def resume_import(job_id):
+    """中断したインポートを続きから再開"""
+    if not current_user.is_admin():
+        flash('管理者権限が必要です。', 'error')
+        return redirect(url_for('book_list'))
+    
+    # 実行中のジョブはロックを取得できないため、二重には実行されない
+    start_background_import(job_id)
+    flash(f'インポートを再開しました（ジョブ {job_id}）。', 'success')
+    return redirect(url_for('admin_import_books'))
+
+@app.route('/admin/export')
+@login_required
+def admin_export():
+    """貸出・予約・ユーザーのエクスポート（全件を読み込まずにチャンク転送で返す）"""
+    if not current_user.is_admin():
+        flash('管理者権限が必要です。', 'error')
+        return redirect(url_for('book_list'))
+    
+    kind = request.args.get('kind', 'loans')
+    fmt = request.args.get('format', 'csv')
+    if kind not in EXPORTS or fmt not in EXPORT_FORMATS:
+        flash('エクスポートの種類または形式が正しくありません。', 'error')
+        return redirect(url_for('admin_dashboard'))
+    try:
+        export_filter = ExportFilter.parse(EXPORTS[kind], request.args.get('start'),
+                                           request.args.get('end'), request.args.get('status'))
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin_dashboard'))
+    
+    return Response(generate_export(kind, fmt, export_filter),
+                    mimetype=EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={export_filename(kind, fmt, export_filter)}'})
 
 @app.route('/admin/users')
+@query_budget(3)
+@read_only
 @login_required
 def admin_users():
     """ユーザー管理"""
@@ -484,14 +762,15 @@ def admin_users():
         flash('管理者権限が必要です。', 'error')
         return redirect(url_for('book_list'))
     
-    db = SessionLocal()
-    try:
-        users = db.query(User).order_by(User.created_at.desc()).all()
-        return render_template('admin/users.html', users=users)
-    finally:
-        db.close()
+    db = get_session()
+    total = count_cache.get('users', lambda: db.query(func.count(User.id)).scalar())
+    # 貸出・予約の件数は利用者ごとの集計値を同じクエリでJOINして読む（利用者ごとに数えない）
+    page = keyset_paginate(db.query(User).options(joinedload(User.activity)), User.created_at, User.id,
+                           cursor=request.args.get('cursor'), per_page=LIST_PER_PAGE, total=total)
+    return render_template('admin/users.html', users=page.items, page=page)
 
 if __name__ == '__main__':
+    # 開発用サーバー（本番は gunicorn -c gunicorn.conf.py app:app）
     # Docker環境では0.0.0.0でリッスン
     host = os.getenv('FLASK_HOST', '127.0.0.1')
     port = int(os.getenv('FLASK_PORT', 5001))
@@ -0,0 +1,131 @@
+"""
+貸出・予約の履歴のアーカイブ
+返却済みの貸出と終了した予約（確認済み・キャンセル・期限切れ）のうち、一定の日数より古いものを
+アーカイブ用のテーブル（loans_archive / reservations_archive）へ一定件数ずつ移動し、
+一覧・延滞の更新・集計が読む現行のテーブルを小さく保ちます（よく使う行がバッファプールに収まるように）。
+
+- 各バッチは短いトランザクションで「INSERT ... SELECT してから DELETE」し、バッチの間に休止を入れます
+- 対象の行は FOR UPDATE SKIP LOCKED でロックするため、返却などの処理や他のワーカーと奪い合いません
+- 一覧（pagination.keyset_paginate_union）とエクスポートは現行とアーカイブを合わせて読むため、
+  移動しても表示される内容は変わりません
+
+MySQLのパーティションは外部キーと併用できないため、パーティションではなく別テーブルに移動します。
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select
+
+from database import engine
+from models import Loan, LoanArchive, LoanStatus, Reservation, ReservationArchive, ReservationStatus
+
+# この日数より前の貸出日・予約日の行を移動する
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 365))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+# バッチの間の休止（秒）と、1回の実行で対象（貸出・予約）ごとに処理するバッチ数の上限（0は無制限。残りは次回の実行で移動する）
+ARCHIVE_PAUSE_SECONDS = float(os.getenv('ARCHIVE_PAUSE_SECONDS', 0.1))
+ARCHIVE_MAX_BATCHES = int(os.getenv('ARCHIVE_MAX_BATCHES', 100))
+
+
+class ArchiveTarget:
+    """アーカイブの対象（現行のテーブル、移動先、並び順の日付の列、終了した状態）"""
+    def __init__(self, name, model, archive_model, date_column, closed_statuses):
+        self.name = name
+        self.model = model
+        self.archive_model = archive_model
+        self.date_column = date_column
+        self.closed_statuses = closed_statuses
+        # 移動先と同じ名前の列（archived_at は移動先の既定値）
+        self.columns = [column.name for column in archive_model.__table__.columns
+                        if column.name in model.__table__.columns]
+
+    def closed(self, cutoff):
+        return (self.model.status.in_(self.closed_statuses), self.date_column < cutoff)
+
+
+TARGETS = {
+    'loans': ArchiveTarget('loans', Loan, LoanArchive, Loan.loan_date, [LoanStatus.RETURNED]),
+    'reservations': ArchiveTarget(
+        'reservations', Reservation, ReservationArchive, Reservation.reservation_date,
+        [ReservationStatus.CONFIRMED, ReservationStatus.CANCELLED, ReservationStatus.EXPIRED]),
+}
+
+
+def archive_batch(conn, target, cutoff, batch_size) -> int:
+    """古い順に batch_size 件を移動し、移動した件数を返す（コミットは呼び出し側で行う）"""
+    model = target.model
+    # IDの最大の行は残す（SQLiteや再起動後のMySQL 5.7では、最大のIDを削除すると同じIDが再び使われるため）
+    max_id = conn.execute(select(func.max(model.id))).scalar()
+    ids = conn.execute(
+        select(model.id)
+        .where(*target.closed(cutoff), model.id < max_id)
+        .order_by(target.date_column, model.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).scalars().all() if max_id else []
+    if not ids:
+        return 0
+    table = model.__table__
+    conn.execute(insert(target.archive_model).from_select(
+        target.columns,
+        select(*[table.c[name] for name in target.columns]).where(model.id.in_(ids)),
+    ))
+    return conn.execute(delete(model).where(model.id.in_(ids))).rowcount
+
+
+class ArchiveReport:
+    """アーカイブの結果（対象ごとの移動件数）"""
+    def __init__(self):
+        self.moved = {}
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rows(self):
+        return sum(self.moved.values())
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        moved = ' / '.join(f'{name} {rows} 件' for name, rows in self.moved.items())
+        return (f'{moved} / {self.batches} バッチ / {self.seconds:.3f}秒 '
+                f'({self.rows_per_second:,.0f} rows/s)')
+
+
+def archive_history(older_than_days=None, batch_size=None, pause=None, max_batches=None,
+                    targets=None, bind=None) -> ArchiveReport:
+    """
+    古い終了済みの貸出・予約をアーカイブ用のテーブルへ移動
+    対象ごとに max_batches に達した場合はその対象を途中で終わり、残りは次回の実行で移動します（何度実行しても結果は同じ）。
+    上限は対象ごとに数えるため、貸出の移動が多くても予約の移動が後回しになり続けることはありません。
+    """
+    bind = bind or engine
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    pause = ARCHIVE_PAUSE_SECONDS if pause is None else pause
+    max_batches = ARCHIVE_MAX_BATCHES if max_batches is None else max_batches
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    report = ArchiveReport()
+    start = time.perf_counter()
+    for name in targets or TARGETS:
+        target = TARGETS[name]
+        report.moved[name] = 0
+        batches = 0
+        while not max_batches or batches < max_batches:
+            with bind.begin() as conn:
+                moved = archive_batch(conn, target, cutoff, batch_size)
+            if not moved:
+                break
+            report.moved[name] += moved
+            report.batches += 1
+            batches += 1
+            if moved < batch_size:
+                break
+            # レプリケーションの遅延や他の処理への影響を抑えるため、バッチの間で休む
+            time.sleep(pause)
+    report.seconds = time.perf_counter() - start
+    return report
@@ -1,29 +1,118 @@
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
 from models import User, UserRole
+from cache import LRUCache, cache
+from passwords import hasher
+import os
+
+# ログイン中ユーザーのキャッシュ（ユーザーIDごと。認証バージョンが一致する場合だけ使う）
+# 全ワーカーで共有するキャッシュ（CACHE_BACKEND=redis）があればそこに IDENTITY_CACHE_TTL 秒置き、
+# 役割・パスワードの変更をコミットしたときに削除します（他のワーカーでも次のリクエストから無効）。
+# 共有するキャッシュがなければワーカーごとのキャッシュに IDENTITY_CACHE_LOCAL_TTL 秒だけ置きます
+# （他のワーカーでの変更は、この秒数が過ぎるまで反映されません）。
+IDENTITY_CACHE_TTL = int(os.getenv('IDENTITY_CACHE_TTL', 60))
+IDENTITY_CACHE_LOCAL_TTL = int(os.getenv('IDENTITY_CACHE_LOCAL_TTL', 5))
+identity_cache = LRUCache(max_entries=int(os.getenv('IDENTITY_CACHE_MAX_ENTRIES', 10000)),
+                          default_ttl=IDENTITY_CACHE_LOCAL_TTL)
+
+def _identity_store():
+    """ログインユーザーのキャッシュと有効期間（秒）"""
+    if cache.shared:
+        return cache, IDENTITY_CACHE_TTL
+    return identity_cache, min(IDENTITY_CACHE_TTL, IDENTITY_CACHE_LOCAL_TTL)
+
+def _identity_key(user_id):
+    return f'login:{user_id}'
 
 class UserLogin(UserMixin):
-    """Flask-Login用のユーザークラス"""
+    """Flask-Login用のユーザークラス（DBセッションに依存しない値だけを保持）"""
     def __init__(self, user: User):
         self.id = user.id
         self.username = user.username
         self.email = user.email
         self.role = user.role
-        self._user = user
-    
+        self.auth_version = user.auth_version
+
+    def get_id(self):
+        # 役割・パスワードの変更でバージョンが変わると、古いセッションは無効になる
+        return f'{self.id}:{self.auth_version}'
+
     def is_admin(self):
         return self.role == UserRole.ADMIN
-    
-    def get_user(self):
-        return self._user
+
+    def get_user(self, db):
+        return get_user_by_id(db, self.id)
+
+def parse_session_id(session_id: str):
+    """セッションに保存されたIDを (ユーザーID, 認証バージョン) に分解（バージョンのない古い形式はNone）"""
+    user_id, _, version = str(session_id).partition(':')
+    return int(user_id), (int(version) if version else None)
+
+def get_cached_login(session_id: str):
+    """キャッシュ済みのログインユーザーを取得（なければ、または認証バージョンが変わっていればNone）"""
+    store, ttl = _identity_store()
+    if not ttl:
+        return None
+    user_id, version = parse_session_id(session_id)
+    if version is None:
+        return None
+    login = store.get(_identity_key(user_id))
+    if login is None or login.auth_version != version:
+        return None
+    return login
+
+def login_from_user(user, session_id: str):
+    """
+    DBから取得したユーザーをログインユーザーに変換してキャッシュ
+    認証バージョンのないセッション（バージョン導入前の形式）は、降格・パスワード変更を確認できないため受け付けません。
+    """
+    if user is None:
+        return None
+    _, version = parse_session_id(session_id)
+    if version is None or version != user.auth_version:
+        return None
+    login = UserLogin(user)
+    store, ttl = _identity_store()
+    if ttl:
+        store.set(_identity_key(login.id), login, ttl=ttl)
+    return login
+
+def forget_logins(user_ids):
+    """ログインユーザーのキャッシュを削除（共有するキャッシュでは全ワーカー分）"""
+    if user_ids:
+        store, _ = _identity_store()
+        store.delete(*[_identity_key(user_id) for user_id in user_ids])
+
+@event.listens_for(User, 'before_update')
+def _bump_auth_version(mapper, connection, target):
+    """役割・パスワードの変更時に認証バージョンを上げ、コミット後にキャッシュを削除する"""
+    state = inspect(target)
+    if state.attrs.role.history.has_changes() or state.attrs.password_hash.history.has_changes():
+        target.auth_version = (target.auth_version or 0) + 1
+        forget_logins([target.id])
+        # コミット前に他のリクエストが古い行を読んでキャッシュし直す場合に備え、コミット後にもう一度削除する
+        object_session(target).info.setdefault('auth_changed', set()).add(target.id)
+
+@event.listens_for(Session, 'after_commit')
+def _forget_changed_logins(session):
+    forget_logins(session.info.pop('auth_changed', ()))
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_logins(session):
+    session.info.pop('auth_changed', None)
 
 def hash_password(password: str) -> str:
-    """パスワードをハッシュ化"""
-    return generate_password_hash(password, method='pbkdf2:sha256')
+    """パスワードをハッシュ化（プロセスプールで計算）"""
+    return hasher.hash(password)
 
 def verify_password(password_hash: str, password: str) -> bool:
-    """パスワードを検証"""
-    return check_password_hash(password_hash, password)
+    """パスワードを検証（プロセスプールで計算）"""
+    return hasher.verify(password_hash, password)
+
+def needs_rehash(password_hash: str) -> bool:
+    """KDFのパラメータが変わっていて再計算が必要か"""
+    return hasher.needs_rehash(password_hash)
 
 def get_user_by_username(db, username: str):
     """ユーザー名でユーザーを取得"""
@@ -36,4 +125,3 @@ def get_user_by_email(db, email: str):
 def get_user_by_id(db, user_id: int):
     """IDでユーザーを取得"""
     return db.query(User).filter_by(id=user_id).first()
-
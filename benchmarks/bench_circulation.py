@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+貸出・返却のベンチマーク（1件ずつのPOST と 一括API の比較）
+待機中の予約を作成し、同じ件数を次の2通りで貸出・返却して items/s を表示します。
+- 1件ずつ: POST /reservations/<id>/loan、POST /loans/<id>/return（1件ごとにコミット）
+- 一括:    POST /api/v1/circulation/checkouts、POST /api/v1/circulation/returns（--batch 件ごとに1トランザクション）
+
+使い方:
+  python benchmarks/bench_circulation.py [--items 1000] [--batch 100] [--books 200]
+  BENCH_DATABASE_URL=mysql+pymysql://... python benchmarks/bench_circulation.py
+
+注意: 対象データベースのテーブルは作り直されます。必ずベンチマーク専用のDBを指定してください。
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ADMIN = ('admin', 'admin123')
+
+
+def prepare_database(engine, items, books):
+    """テーブルを作り直し、書籍・利用者と待機中の予約を items × 2 件作成する"""
+    from sqlalchemy import insert, select
+
+    import migrations
+    from activity import reconcile_user_activity
+    from database import Base
+    from models import Book, Reservation, ReservationStatus, User, UserRole
+    from stats import reconcile_stats
+
+    Base.metadata.drop_all(bind=engine)
+    migrations.upgrade(bind=engine, log=lambda message: None)
+    now = datetime.utcnow()
+    # 予約は「利用者 × 書籍」の組が重複しないように割り当てる
+    users = (items * 2) // books + 1
+    with engine.begin() as conn:
+        conn.execute(insert(Book), [{'title': f'書籍{i}', 'author': f'著者{i % 50}', 'isbn': f'978{i:010d}',
+                                     'total_copies': users, 'available_copies': users} for i in range(books)])
+        conn.execute(insert(User), [{'username': f'reader{i}', 'email': f'reader{i}@example.com',
+                                     'password_hash': '-', 'role': UserRole.USER} for i in range(users)])
+        book_ids = conn.execute(select(Book.id).order_by(Book.id)).scalars().all()
+        user_ids = conn.execute(select(User.id).where(User.role == UserRole.USER).order_by(User.id)).scalars().all()
+        conn.execute(insert(Reservation), [{
+            'user_id': user_ids[i // books], 'book_id': book_ids[i % books], 'status': ReservationStatus.PENDING,
+            'reservation_date': now, 'expiry_date': now + timedelta(days=7),
+        } for i in range(items * 2)])
+        reservation_ids = conn.execute(select(Reservation.id).order_by(Reservation.id)).scalars().all()
+    reconcile_stats(bind=engine)
+    reconcile_user_activity(bind=engine)
+    return reservation_ids
+
+
+def active_loan_ids(engine, reservation_ids):
+    """指定した予約から作成された貸出のID"""
+    from sqlalchemy import select
+
+    from models import Loan, LoanStatus, Reservation
+    with engine.connect() as conn:
+        return conn.execute(
+            select(Loan.id)
+            .join(Reservation, (Reservation.user_id == Loan.user_id) & (Reservation.book_id == Loan.book_id))
+            .where(Reservation.id.in_(reservation_ids), Loan.status == LoanStatus.ACTIVE)
+            .order_by(Loan.id)
+        ).scalars().all()
+
+
+def run_single(client, path, ids):
+    start = time.perf_counter()
+    errors = 0
+    for item_id in ids:
+        response = client.post(path.format(item_id))
+        if response.status_code != 302:
+            errors += 1
+    return time.perf_counter() - start, errors
+
+
+def run_batch(client, path, key, ids, batch):
+    start = time.perf_counter()
+    errors = 0
+    for offset in range(0, len(ids), batch):
+        response = client.post(path, json={key: ids[offset:offset + batch]})
+        if response.status_code != 200:
+            errors += len(ids[offset:offset + batch])
+        else:
+            errors += response.get_json()['failed']
+    return time.perf_counter() - start, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='貸出・返却の1件ずつの処理と一括処理の比較')
+    parser.add_argument('--items', type=int, default=1000, help='それぞれの方法で処理する件数')
+    parser.add_argument('--batch', type=int, default=100, help='一括APIの1リクエストあたりの件数')
+    parser.add_argument('--books', type=int, default=200)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/bench.db')
+    os.environ['ENABLE_SCHEDULER'] = 'false'
+
+    from circulation import MAX_BATCH_ITEMS
+    from database import engine
+    if not 0 < args.batch <= MAX_BATCH_ITEMS:
+        parser.error(f'--batch は 1〜{MAX_BATCH_ITEMS} で指定してください。')
+    reservation_ids = prepare_database(engine, args.items, args.books)
+    single_ids, batch_ids = reservation_ids[:args.items], reservation_ids[args.items:]
+
+    from app import app
+    client = app.test_client()
+    response = client.post('/login', data={'username': ADMIN[0], 'password': ADMIN[1]})
+    assert response.status_code == 302, '管理者でログインできませんでした。'
+
+    print(f'{args.items:,} 件（一括は {args.batch} 件ずつ）、{engine.dialect.name}')
+    results = {}
+    for operation in ('貸出', '返却'):
+        if operation == '貸出':
+            single = run_single(client, '/reservations/{}/loan', single_ids)
+            batch = run_batch(client, '/api/v1/circulation/checkouts', 'reservation_ids', batch_ids, args.batch)
+        else:
+            single = run_single(client, '/loans/{}/return', active_loan_ids(engine, single_ids))
+            batch = run_batch(client, '/api/v1/circulation/returns', 'loan_ids',
+                              active_loan_ids(engine, batch_ids), args.batch)
+        for name, (seconds, errors) in (('1件ずつ', single), ('一括', batch)):
+            results[operation, name] = args.items / seconds
+            print(f'{operation} {name:<5} {args.items / seconds:10,.0f} items/s  {seconds:7.2f}秒  エラー {errors}')
+        print(f'{operation} 一括 / 1件ずつ: {results[operation, "一括"] / results[operation, "1件ずつ"]:.1f} 倍')
+
+
+if __name__ == '__main__':
+    main()
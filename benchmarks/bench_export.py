@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+貸出のエクスポートのベンチマーク
+貸出データを投入して exports.py でCSVを書き出し、rows/sec とメモリ使用量（最大RSS）を表示します。
+件数を増やしても最大RSSがほぼ変わらない（全件を読み込んでいない）ことを確認します。
+
+使い方:
+  python benchmarks/bench_export.py [--sizes 100000 1000000] [--chunk-size 10000]
+  BENCH_DATABASE_URL=mysql+pymysql://... python benchmarks/bench_export.py
+
+注意: 対象データベースのテーブルは作り直されます。必ずベンチマーク専用のDBを指定してください。
+"""
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def populate(engine, size, start_id):
+    """貸出をsize件追加（利用者100人・書籍1000冊に分散）"""
+    from sqlalchemy import insert
+    from models import Loan, LoanStatus
+    base = datetime(2020, 1, 1)
+    with engine.begin() as conn:
+        for offset in range(0, size, 10000):
+            conn.execute(insert(Loan), [{
+                'id': start_id + i,
+                'user_id': i % 100 + 1,
+                'book_id': i % 1000 + 1,
+                'loan_date': base + timedelta(minutes=start_id + i),
+                'due_date': base + timedelta(minutes=start_id + i, days=14),
+                'status': LoanStatus.RETURNED,
+            } for i in range(offset, min(size, offset + 10000))])
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='貸出のエクスポートのベンチマーク')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--chunk-size', type=int, default=None)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f'sqlite:///{tmpdir}/bench.db')
+    if args.chunk_size:
+        os.environ['EXPORT_CHUNK_SIZE'] = str(args.chunk_size)
+
+    import exports
+    from database import Base, engine
+    from models import Book, User
+    from sqlalchemy import insert
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com',
+                                     'password_hash': 'x'} for i in range(1, 101)])
+        conn.execute(insert(Book), [{'id': i, 'title': f'書籍{i}', 'author': '著者', 'total_copies': 1,
+                                     'available_copies': 1} for i in range(1, 1001)])
+
+    loaded = 0
+    for size in sorted(args.sizes):
+        populate(engine, size - loaded, loaded + 1)
+        loaded = size
+        with open(os.devnull, 'w') as out:
+            start = time.perf_counter()
+            written = 0
+            for piece in exports.generate_export('loans', 'csv'):
+                out.write(piece)
+                written += len(piece)
+            elapsed = time.perf_counter() - start
+        print(f'{size:>10,} 件  {size / elapsed:10,.0f} rows/s  {written / 1024 / 1024:7.1f}MB  '
+              f'最大RSS {max_rss_mb():7.1f}MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+書籍の一括インポートのベンチマーク
+ISBN付きのCSVを生成して importer.py で取り込み、rows/sec とメモリ使用量（最大RSS）を表示します。
+ファイルサイズを変えて実行し、最大RSSがほぼ変わらない（メモリが一定）ことを確認します。
+2回目の取り込みでは同じISBNの既存書籍を更新します（ON DUPLICATE KEY UPDATE）。
+
+使い方:
+  python benchmarks/bench_import.py [--sizes 10000 100000] [--batch-size 1000]
+  BENCH_DATABASE_URL=mysql+pymysql://... python benchmarks/bench_import.py
+
+注意: 対象データベースのテーブルは作り直されます。必ずベンチマーク専用のDBを指定してください。
+"""
+
+import argparse
+import csv
+import os
+import random
+import resource
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TITLE_WORDS = ['Python', 'Flask', 'データベース', '設計', '入門', '実践', '図書館', '歴史',
+               '物語', '科学', '数学', 'Web', '開発', '料理', '旅行', '経済', '心理学', '宇宙']
+
+
+def make_isbn(i):
+    """連番から正しいチェックディジットのISBN-13を作る"""
+    body = f'9784{i:08d}'
+    check = (10 - sum((3 if n % 2 else 1) * int(c) for n, c in enumerate(body)) % 10) % 10
+    return body + str(check)
+
+
+def write_csv(path, size):
+    rng = random.Random(size)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['title', 'author', 'isbn', 'publisher', 'publication_date', 'total_copies'])
+        for i in range(size):
+            writer.writerow([' '.join(rng.sample(TITLE_WORDS, 3)), f'著者{i % 5000}', make_isbn(i),
+                             '図書館出版', f'{1990 + i % 30}-01-01', 1 + i % 3])
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='書籍の一括インポートのベンチマーク')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f'sqlite:///{tmpdir}/bench.db')
+
+    import importer
+    from database import Base, engine
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+    for size in args.sizes:
+        path = os.path.join(tmpdir, f'books_{size}.csv')
+        write_csv(path, size)
+        file_mb = os.path.getsize(path) / 1024 / 1024
+        for label in ('追加', '更新'):
+            report = importer.run_import(importer.create_job(path), batch_size=args.batch_size)
+            print(f'{size:>9,} 件 {label}  ({file_mb:6.1f}MB)  {report.rows_per_second:10,.0f} rows/s  '
+                  f'最大RSS {max_rss_mb():7.1f}MB  [{report}]')
+
+
+if __name__ == '__main__':
+    main()
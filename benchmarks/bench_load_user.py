@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+ログインユーザーのキャッシュ（load_user）のベンチマーク
+ログイン済みのクライアントで同じページに繰り返しアクセスし、
+キャッシュなし（毎リクエストでユーザーの行を読む）とキャッシュあり（DBを読まない）の
+1リクエストあたりのレイテンシを比較します。
+
+使い方:
+  python benchmarks/bench_load_user.py [--requests 2000] [--threads 8]
+  BENCH_DATABASE_URL=mysql+pymysql://... python benchmarks/bench_load_user.py
+
+注意: 対象データベースのテーブルは作り直されます。必ずベンチマーク専用のDBを指定してください。
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run_load(app, requests, threads, path):
+    """threads本のクライアントから合計requests回アクセスし、各リクエストの所要時間を返す"""
+    timings = []
+    lock = threading.Lock()
+
+    def worker(count):
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        local = []
+        for _ in range(count):
+            start = time.perf_counter()
+            response = client.get(path)
+            local.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 200, response.status_code
+        with lock:
+            timings.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(requests // threads,)) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return timings, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load_userのキャッシュのベンチマーク')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--path', default='/loans')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f'sqlite:///{tmpdir}/bench.db')
+    os.environ['ENABLE_SCHEDULER'] = 'false'
+
+    import migrations
+    from database import Base, engine
+    Base.metadata.drop_all(bind=engine)
+    migrations.upgrade(log=lambda message: None)
+
+    import auth
+    from app import app
+
+    results = {}
+    for label, ttl in (('キャッシュなし', 0), ('キャッシュあり', 60)):
+        auth.IDENTITY_CACHE_TTL = ttl
+        auth.identity_cache.clear()
+        timings, elapsed = run_load(app, args.requests, args.threads, args.path)
+        results[label] = timings
+        print(f'{label:<10} mean={statistics.mean(timings):7.3f}ms  p50={percentile(timings, 50):7.3f}ms  '
+              f'p99={percentile(timings, 99):7.3f}ms  {len(timings) / elapsed:8.1f} req/s')
+
+    saved = statistics.mean(results['キャッシュなし']) - statistics.mean(results['キャッシュあり'])
+    print(f'1リクエストあたりの短縮: {saved:.3f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+パスワード検証（ログイン）のベンチマーク
+複数スレッドから同時にパスワードを検証し、logins/sec と1コアあたりの値を表示します。
+リクエストスレッドで計算する場合（workers=0）とプロセスプールを使う場合を比較します。
+
+使い方:
+  python benchmarks/bench_password.py [--logins 64] [--threads 16] [--method pbkdf2:sha256:600000]
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PASSWORD_HASH_METHOD, PasswordHasher  # noqa: E402
+
+
+def run(hasher, password_hash, logins, threads):
+    remaining = [logins]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            assert hasher.verify(password_hash, 'password')
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='パスワード検証のベンチマーク')
+    parser.add_argument('--logins', type=int, default=64)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--method', default=PASSWORD_HASH_METHOD)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    print(f'method={args.method}  cores={cores}  threads={args.threads}')
+    for label, workers in (('リクエストスレッド', 0), ('プロセスプール', cores)):
+        hasher = PasswordHasher(method=args.method, workers=workers,
+                                max_pending=args.threads, queue_timeout=60)
+        password_hash = hasher.hash('password')
+        elapsed = run(hasher, password_hash, args.logins, args.threads)
+        used_cores = max(1, min(workers, cores)) if workers else 1
+        rate = args.logins / elapsed
+        print(f'{label:<12} {rate:8.2f} logins/s  {rate / used_cores:8.2f} logins/s/core  '
+              f'平均 {hasher.stats()["avg_ms"]:.1f}ms')
+        hasher.shutdown()
+
+
+if __name__ == '__main__':
+    main()
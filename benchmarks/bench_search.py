@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+書籍検索のベンチマーク
+LIKEによる従来の検索（before）と検索バックエンド（after）のp50/p99レイテンシを比較します。
+
+使い方:
+  python benchmarks/bench_search.py                     # 10k / 100k / 1M 冊（SQLite）
+  python benchmarks/bench_search.py --sizes 10000 100000
+  BENCH_DATABASE_URL=mysql+pymysql://... python benchmarks/bench_search.py
+
+注意: 対象データベースのテーブルは作り直されます。必ずベンチマーク専用のDBを指定してください。
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TITLE_WORDS = ['Python', 'Flask', 'データベース', '設計', '入門', '実践', '図書館', '歴史',
+               '物語', '科学', '数学', 'Web', '開発', '料理', '旅行', '経済', '心理学', '宇宙']
+AUTHOR_NAMES = ['山田太郎', '佐藤花子', '鈴木一郎', '田中次郎', '高橋美咲', '伊藤健', '渡辺翔']
+QUERIES = ['Python', 'データベース', '設計 入門', '宇宙', '佐藤', '歴史 物語', 'Web開発', '科', '978-4-0000-1234']
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def populate(engine, size):
+    """ランダムな書籍データを投入"""
+    from sqlalchemy import insert
+    from models import Book
+    rng = random.Random(size)
+    batch = []
+    with engine.begin() as conn:
+        for i in range(size):
+            title = ' '.join(rng.sample(TITLE_WORDS, 3)) + f' 第{i % 9 + 1}巻'
+            batch.append({
+                'title': title,
+                'author': rng.choice(AUTHOR_NAMES),
+                'isbn': f'9784{i // 10000:04d}{i % 10000:04d}',
+                'total_copies': 1,
+                'available_copies': 1,
+            })
+            if len(batch) == 5000:
+                conn.execute(insert(Book), batch)
+                batch = []
+        if batch:
+            conn.execute(insert(Book), batch)
+
+
+def like_search(db, query, per_page=20):
+    """従来の実装（LIKE '%q%' の3条件＋COUNT）"""
+    from sqlalchemy import or_
+    from models import Book
+    q = db.query(Book).filter(or_(
+        Book.title.like(f'%{query}%'),
+        Book.author.like(f'%{query}%'),
+        Book.isbn.like(f'%{query}%'),
+    ))
+    q.order_by(Book.created_at.desc()).limit(per_page).all()
+    q.count()
+
+
+def measure(func, db, runs):
+    timings = []
+    for i in range(runs):
+        query = QUERIES[i % len(QUERIES)]
+        start = time.perf_counter()
+        func(db, query)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def run(size, runs):
+    from database import Base, engine, SessionLocal
+    from search import create_search_backend
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    populate(engine, size)
+
+    backend = create_search_backend(engine.dialect.name)
+    db = SessionLocal()
+    try:
+        # インデックス構築（インメモリの場合）はウォームアップとして計測対象外
+        backend.search(db, QUERIES[0], limit=20)
+        before = measure(like_search, db, runs)
+        after = measure(lambda session, q: backend.search(session, q, limit=20), db, runs)
+    finally:
+        db.close()
+
+    for label, timings in (('before (LIKE)', before), (f'after ({backend.name})', after)):
+        print(f'{size:>9,} books  {label:<16} p50={percentile(timings, 50):8.2f}ms  '
+              f'p99={percentile(timings, 99):8.2f}ms  mean={statistics.mean(timings):8.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='書籍検索のベンチマーク')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f'sqlite:///{tmpdir}/bench.db')
+
+    for size in args.sizes:
+        run(size, args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Webサーバーの負荷試験（Flask開発サーバー と gunicorn の比較）
+それぞれのサーバーを起動し、複数の接続（keep-alive）から一定時間リクエストを送り続けて
+req/s とレイテンシ（p50 / p95 / p99）を表示します。
+
+使い方:
+  python benchmarks/bench_serving.py [--servers dev gunicorn] [--concurrency 16] [--duration 10]
+                                     [--paths /books /api/v1/books /api/v1/books/1]
+  BENCH_DATABASE_URL=mysql+pymysql://... python benchmarks/bench_serving.py
+
+注意: 対象データベースのテーブルは作り直されます。必ずベンチマーク専用のDBを指定してください。
+"""
+
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SERVER_COMMANDS = {
+    'dev': [sys.executable, 'app.py'],
+    'gunicorn': [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def prepare_database(env, books):
+    """テーブルを作り直して書籍を登録（アプリの起動前に1回だけ実行）"""
+    script = f'''
+from sqlalchemy import insert
+from database import Base, engine
+import migrations, models
+Base.metadata.drop_all(bind=engine)
+migrations.upgrade(log=lambda message: None)
+with engine.begin() as conn:
+    conn.execute(insert(models.Book), [{{'title': f'書籍{{i}}', 'author': f'著者{{i % 100}}', 'total_copies': 2,
+                                        'available_copies': 2}} for i in range({books})])
+'''
+    subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, check=True)
+
+
+def start_server(name, env, port):
+    process = subprocess.Popen(SERVER_COMMANDS[name], cwd=ROOT, env={**env, 'FLASK_PORT': str(port)},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/readyz')
+            if conn.getresponse().status == 200:
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'{name} サーバーが起動しませんでした。')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def run_load(port, paths, concurrency, duration):
+    """concurrency本の接続から duration 秒間リクエストを送り、(件数, エラー数, レイテンシ一覧) を返す"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client(offset):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = []
+        local_errors = 0
+        i = offset
+        while time.monotonic() < stop_at:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 400:
+                    local_errors += 1
+                # 開発サーバーは接続を維持しないため、閉じられた場合は次のリクエストで接続し直す
+                if response.will_close:
+                    conn.close()
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                continue
+            local.append((time.perf_counter() - start) * 1000)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), errors[0], latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flask開発サーバーとgunicornの負荷試験')
+    parser.add_argument('--servers', nargs='+', choices=sorted(SERVER_COMMANDS), default=['dev', 'gunicorn'])
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--books', type=int, default=1000)
+    parser.add_argument('--paths', nargs='+', default=['/books', '/api/v1/books', '/api/v1/books/1', '/healthz'])
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    env = {**os.environ,
+           'DATABASE_URL': os.getenv('BENCH_DATABASE_URL', f'sqlite:///{tmpdir}/bench.db'),
+           'ENABLE_SCHEDULER': 'false', 'FLASK_DEBUG': 'False', 'FLASK_HOST': '127.0.0.1',
+           # 計測中にワーカーが入れ替わらないようにする
+           'GUNICORN_ACCESS_LOG': '/dev/null', 'GUNICORN_MAX_REQUESTS': '0'}
+    prepare_database(env, args.books)
+
+    print(f'同時接続 {args.concurrency}、{args.duration:.0f}秒、パス: {" ".join(args.paths)}')
+    results = {}
+    for name in args.servers:
+        port = free_port()
+        process = start_server(name, env, port)
+        try:
+            # ウォームアップ（キャッシュ・接続プールの準備）
+            run_load(port, args.paths, args.concurrency, min(2.0, args.duration))
+            count, errors, latencies = run_load(port, args.paths, args.concurrency, args.duration)
+        finally:
+            stop_server(process)
+        results[name] = count / args.duration
+        print(f'{name:>9}  {count / args.duration:9,.0f} req/s  p50 {percentile(latencies, 0.50):7.1f}ms  '
+              f'p95 {percentile(latencies, 0.95):7.1f}ms  p99 {percentile(latencies, 0.99):7.1f}ms  エラー {errors}')
+
+    if 'dev' in results and 'gunicorn' in results and results['dev']:
+        print(f'gunicorn / 開発サーバー: {results["gunicorn"] / results["dev"]:.2f} 倍')
+
+
+if __name__ == '__main__':
+    main()
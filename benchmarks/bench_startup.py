@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+起動時間のベンチマーク
+新しいプロセスで app を import するまでの時間と、最初のリクエスト（書籍一覧）の応答時間を計測します。
+ワーカーの起動ごとにかかる時間のため、毎回DDLや管理者の確認を行っていないかを確認できます。
+--history を指定すると結果を1行のJSONとして追記し、変更ごとの推移を比較できます。
+
+使い方:
+  python benchmarks/bench_startup.py [--runs 5] [--history benchmarks/startup_history.jsonl]
+  BENCH_DATABASE_URL=mysql+pymysql://... python benchmarks/bench_startup.py
+
+注意: 対象データベースにはマイグレーションが適用されます。必ずベンチマーク専用のDBを指定してください。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行する計測（import と最初のリクエストの時間を出力）
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+response = client.get('/books')
+first_request = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({'import_ms': (imported - start) * 1000, 'first_request_ms': (first_request - imported) * 1000}))
+'''
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def probe(env):
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, capture_output=True,
+                            text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='起動時間のベンチマーク')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--history', help='結果を追記するJSON Linesファイル')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    env = {**os.environ,
+           'DATABASE_URL': os.getenv('BENCH_DATABASE_URL', f'sqlite:///{tmpdir}/bench.db'),
+           'ENABLE_SCHEDULER': 'false'}
+    # スキーマを用意（デプロイ時のマイグレーションに相当し、計測には含めない）
+    subprocess.run([sys.executable, 'migrations.py', 'upgrade'], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+
+    runs = [probe(env) for _ in range(args.runs)]
+    result = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'runs': args.runs,
+        'import_ms': statistics.median(run['import_ms'] for run in runs),
+        'first_request_ms': statistics.median(run['first_request_ms'] for run in runs),
+    }
+    result['total_ms'] = result['import_ms'] + result['first_request_ms']
+    print(f'import {result["import_ms"]:8.1f}ms  最初のリクエスト {result["first_request_ms"]:8.1f}ms  '
+          f'合計 {result["total_ms"]:8.1f}ms  （{args.runs}回の中央値）')
+
+    if args.history:
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    main()
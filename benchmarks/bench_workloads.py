@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+シナリオ別の負荷試験（回帰の検出用）
+datagen.py で偏りのあるデータを生成し、利用者・管理者の操作を模したワークロードを
+アプリ（Flaskのテストクライアント）に対して複数スレッドから実行して、スループットとレイテンシを計測します。
+
+- browse:      書籍一覧・書籍詳細（人気の書籍に集中）・JSON API
+- search:      キーワード・著者名での検索（画面 / JSON API）
+- reserve:     利用者の予約（在庫のない人気書籍は順番待ち）と一部のキャンセル
+- circulation: 管理者の貸出（予約から）と返却
+- dashboard:   管理画面ダッシュボード・ユーザー管理・予約/貸出一覧
+
+結果はJSONで出力でき（--output）、保存したベースライン（--baseline）と比較して、スループットの低下や
+p95の悪化が許容範囲（--tolerance）を超えたワークロードがあれば終了コード1で終了します。
+同じ --seed・件数で実行すれば、同じデータ・同じ操作の列になります。
+
+使い方:
+  python benchmarks/bench_workloads.py --save-baseline benchmarks/baseline.json
+  python benchmarks/bench_workloads.py --baseline benchmarks/baseline.json [--tolerance 0.15]
+  python benchmarks/bench_workloads.py --workloads browse reserve --requests 2000 --threads 8 --output result.json
+  BENCH_DATABASE_URL=mysql+pymysql://... python benchmarks/bench_workloads.py
+
+注意: 対象データベースのテーブルは作り直されます。必ずベンチマーク専用のDBを指定してください。
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import datagen  # noqa: E402
+
+ADMIN = ('admin', 'admin123')
+
+
+def percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ==================== ワークロード ====================
+
+class WorkQueue:
+    """スレッド間で分け合う処理対象のID（貸出する予約・返却する貸出）"""
+    def __init__(self, ids):
+        self._ids = list(ids)
+        self._lock = threading.Lock()
+
+    def pop(self):
+        with self._lock:
+            return self._ids.pop() if self._ids else None
+
+
+class Context:
+    """ワークロードの実行中に共有するデータ"""
+    def __init__(self, dataset):
+        from init_db import SAMPLE_BOOKS
+        self.dataset = dataset
+        self.books = dataset.book_chooser()
+        self.users = dataset.user_chooser()
+        # 検索語（タイトルの単語と、ひな形の著者の姓）
+        self.terms = datagen.TITLE_WORDS + [book['author'][:2] for book in SAMPLE_BOOKS]
+        self.pending = None
+        self.loans = None
+
+    def load_queues(self):
+        """貸出できる予約と返却できる貸出を、古いものから処理されるように読み込む"""
+        from sqlalchemy import select
+        from database import engine
+        from models import Loan, LoanStatus, Reservation, ReservationStatus
+        with engine.connect() as conn:
+            self.pending = WorkQueue(conn.execute(
+                select(Reservation.id).where(Reservation.status == ReservationStatus.PENDING)
+                .order_by(Reservation.id.desc())).scalars())
+            self.loans = WorkQueue(conn.execute(
+                select(Loan.id).where(Loan.status.in_([LoanStatus.ACTIVE, LoanStatus.OVERDUE]))
+                .order_by(Loan.id.desc())).scalars())
+
+
+# 各操作は (client, ctx, rng) を受け取り、計測するリクエストを行う引数なしの関数を返す
+# （対象を選ぶためのDB参照などの準備は計測に含めない。対象がなければNoneを返して飛ばす）
+
+def _get(path, **query):
+    def operation(client, ctx, rng):
+        return lambda: client.get(path, query_string=query or None)
+    return operation
+
+
+def _browse_detail(client, ctx, rng):
+    book_id = ctx.books.pick(rng)
+    return lambda: client.get(f'/books/{book_id}')
+
+
+def _api_book(client, ctx, rng):
+    book_id = ctx.books.pick(rng)
+    return lambda: client.get(f'/api/v1/books/{book_id}')
+
+
+def _search(client, ctx, rng):
+    term = rng.choice(ctx.terms)
+    return lambda: client.get('/books', query_string={'q': term})
+
+
+def _api_search(client, ctx, rng):
+    term = rng.choice(ctx.terms)
+    return lambda: client.get('/api/v1/books', query_string={'q': term})
+
+
+def _reserve(client, ctx, rng):
+    book_id = ctx.books.pick(rng)
+    return lambda: client.post(f'/books/{book_id}/reserve')
+
+
+def _cancel(client, ctx, rng):
+    # 利用者の直近の予約（または順番待ち）をキャンセル
+    from sqlalchemy import select
+    from database import engine
+    from models import Reservation, ReservationStatus, User
+    with engine.connect() as conn:
+        reservation_id = conn.execute(
+            select(Reservation.id).join(User, User.id == Reservation.user_id)
+            .where(User.username == client.username,
+                   Reservation.status.in_([ReservationStatus.PENDING, ReservationStatus.WAITING]))
+            .order_by(Reservation.id.desc()).limit(1)).scalar()
+    if reservation_id is None:
+        return None
+    return lambda: client.post(f'/reservations/{reservation_id}/cancel')
+
+
+def _checkout(client, ctx, rng):
+    reservation_id = ctx.pending.pop()
+    if reservation_id is None:
+        return None
+    return lambda: client.post(f'/reservations/{reservation_id}/loan')
+
+
+def _check_in(client, ctx, rng):
+    loan_id = ctx.loans.pop()
+    if loan_id is None:
+        return None
+    return lambda: client.post(f'/loans/{loan_id}/return')
+
+
+# ワークロード名 -> (ログインするユーザー, [(操作名, 重み, 操作)])
+WORKLOADS = {
+    'browse': (None, [('book_list', 3, _get('/books')), ('book_detail', 4, _browse_detail),
+                      ('api_books', 2, _get('/api/v1/books')), ('api_book', 2, _api_book)]),
+    'search': (None, [('search', 3, _search), ('api_search', 1, _api_search)]),
+    'reserve': ('user', [('reserve', 3, _reserve), ('cancel', 1, _cancel)]),
+    'circulation': ('admin', [('checkout', 1, _checkout), ('return', 1, _check_in)]),
+    'dashboard': ('admin', [('admin_dashboard', 2, _get('/admin')), ('admin_users', 1, _get('/admin/users')),
+                            ('reservation_list', 1, _get('/reservations')), ('loan_list', 1, _get('/loans'))]),
+}
+
+
+def _login(app, ctx, who, rng):
+    client = app.test_client()
+    client.username = None
+    if who is None:
+        return client
+    username, password = ADMIN if who == 'admin' else (ctx.users.pick(rng), datagen.USER_PASSWORD)
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code == 302, f'{username} でログインできませんでした（{response.status_code}）'
+    client.username = username
+    return client
+
+
+def _latency_summary(timings):
+    return {
+        'requests': len(timings),
+        'mean_ms': statistics.mean(timings) if timings else 0.0,
+        'p50_ms': percentile(timings, 0.50),
+        'p95_ms': percentile(timings, 0.95),
+        'p99_ms': percentile(timings, 0.99),
+    }
+
+
+def run_workload(app, ctx, name, requests, threads, seed):
+    """1つのワークロードを threads 本のスレッドで合計 requests 回実行し、結果の辞書を返す"""
+    who, operations = WORKLOADS[name]
+    names = [op_name for op_name, _, _ in operations]
+    weights = [weight for _, weight, _ in operations]
+    prepare = {op_name: operation for op_name, _, operation in operations}
+    timings = {op_name: [] for op_name in names}
+    counters = {'errors': 0, 'skipped': 0}
+    lock = threading.Lock()
+
+    def worker(index, count):
+        rng = random.Random(f'{seed}:{name}:{index}')
+        client = _login(app, ctx, who, rng)
+        local = {op_name: [] for op_name in names}
+        errors = skipped = 0
+        for _ in range(count):
+            op_name = rng.choices(names, weights)[0]
+            call = prepare[op_name](client, ctx, rng)
+            if call is None:
+                skipped += 1
+                continue
+            start = time.perf_counter()
+            response = call()
+            local[op_name].append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+        with lock:
+            for op_name, values in local.items():
+                timings[op_name].extend(values)
+            counters['errors'] += errors
+            counters['skipped'] += skipped
+
+    per_thread = [requests // threads + (1 if i < requests % threads else 0) for i in range(threads)]
+    workers = [threading.Thread(target=worker, args=(i, count)) for i, count in enumerate(per_thread)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    all_timings = [value for values in timings.values() for value in values]
+    result = _latency_summary(all_timings)
+    result.update(counters, elapsed_s=elapsed,
+                  throughput_rps=len(all_timings) / elapsed if elapsed else 0.0,
+                  operations={op_name: _latency_summary(values) for op_name, values in timings.items()})
+    return result
+
+
+# ==================== ベースラインとの比較 ====================
+
+def compare(result, baseline, tolerance):
+    """
+    ベースラインと比べて悪化したワークロードの一覧を返す
+    スループットが (1 - tolerance) 倍を下回るか、p95 が (1 + tolerance) 倍を超えた場合を回帰とします。
+    """
+    regressions = []
+    for name, current in result['workloads'].items():
+        base = baseline['workloads'].get(name)
+        if base is None:
+            continue
+        if current['throughput_rps'] < base['throughput_rps'] * (1 - tolerance):
+            regressions.append(f'{name}: スループット {base["throughput_rps"]:.1f} -> {current["throughput_rps"]:.1f} req/s')
+        if current['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {base["p95_ms"]:.2f} -> {current["p95_ms"]:.2f}ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='シナリオ別の負荷試験')
+    parser.add_argument('--workloads', nargs='+', choices=list(WORKLOADS), default=list(WORKLOADS))
+    parser.add_argument('--requests', type=int, default=1000, help='ワークロードごとのリクエスト数')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=100, help='計測前に実行するリクエスト数（読み取りのみ）')
+    parser.add_argument('--output', help='結果を書き出すJSONファイル')
+    parser.add_argument('--baseline', help='比較するベースラインのJSONファイル')
+    parser.add_argument('--save-baseline', help='結果をベースラインとして保存するJSONファイル')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='回帰とみなす悪化の割合')
+    datagen.add_arguments(parser)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/bench.db')
+    os.environ['ENABLE_SCHEDULER'] = 'false'
+
+    from database import engine
+    dataset = datagen.generate(engine, books=args.books, users=args.users, loans=args.loans,
+                               reservations=args.reservations, skew=args.skew, seed=args.seed)
+    from app import app
+    ctx = Context(dataset)
+    ctx.load_queues()
+    if args.warmup:
+        # キャッシュ・接続プール・検索インデックスの準備
+        run_workload(app, ctx, 'browse', args.warmup, args.threads, args.seed - 1)
+        run_workload(app, ctx, 'search', args.warmup, args.threads, args.seed - 1)
+
+    result = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'database': engine.dialect.name,
+        'dataset': dataset.as_dict(),
+        'requests': args.requests,
+        'threads': args.threads,
+        'workloads': {},
+    }
+    print(f'{"":<14} {"req/s":>9} {"p50":>9} {"p95":>9} {"p99":>9}  エラー  スキップ')
+    for name in args.workloads:
+        summary = run_workload(app, ctx, name, args.requests, args.threads, args.seed)
+        result['workloads'][name] = summary
+        print(f'{name:<14} {summary["throughput_rps"]:9.1f} {summary["p50_ms"]:7.2f}ms {summary["p95_ms"]:7.2f}ms '
+              f'{summary["p99_ms"]:7.2f}ms {summary["errors"]:>7} {summary["skipped"]:>9}')
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('dataset') != result['dataset'] or baseline.get('database') != result['database']:
+            print('注意: ベースラインとデータの件数またはデータベースが異なります。')
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f'ベースライン（{baseline.get("revision")}）からの回帰:')
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print(f'ベースライン（{baseline.get("revision")}）からの回帰はありません（許容 {args.tolerance:.0%}）。')
+
+
+if __name__ == '__main__':
+    main()
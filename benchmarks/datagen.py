@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+ベンチマーク用のデータ生成
+init_db.py のサンプル書籍をひな形に、書籍・利用者・貸出・予約を指定した件数だけ作成します。
+実際の図書館に近づけるため、貸出・予約の対象は偏りを持たせます（Zipf分布）。
+- 人気の書籍: 上位の数%の書籍に貸出・予約が集中し、在庫がなくなった書籍には順番待ちができる
+- よく借りる利用者: 一部の利用者が貸出・予約の多くを占める
+同じ --seed で実行すれば同じデータ（日時は実行時刻からの相対値）になります。
+
+使い方:
+  python benchmarks/datagen.py [--books 10000] [--users 1000] [--loans 50000] [--reservations 20000] [--seed 1]
+  BENCH_DATABASE_URL=mysql+pymysql://... python benchmarks/datagen.py
+
+注意: 対象データベースのテーブルは作り直されます。必ずベンチマーク専用のDBを指定してください。
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_import import TITLE_WORDS, make_isbn  # noqa: E402
+
+# 生成した利用者のパスワード（ワークロードのログインに使用）
+USER_PASSWORD = 'password'
+BATCH_SIZE = 5000
+# 貸出期間（models.Loan の既定値と同じ）と予約の有効期限
+LOAN_DAYS = 14
+RESERVATION_DAYS = 7
+
+
+class SkewedChoice:
+    """順位 r（0始まり）の要素を 1 / (r + 1)^skew に比例した確率で選ぶ"""
+    def __init__(self, items, skew):
+        self.items = list(items)
+        self.cum_weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(len(self.items))))
+
+    def pick(self, rng):
+        return rng.choices(self.items, cum_weights=self.cum_weights)[0]
+
+
+class Dataset:
+    """生成したデータの概要（ワークロードが人気の書籍・よく借りる利用者を選ぶのに使う）"""
+    def __init__(self, books, users, skew, seed, counts):
+        self.books = books    # 人気順の書籍ID
+        self.users = users    # 貸出の多い順のユーザー名
+        self.skew = skew
+        self.seed = seed
+        self.counts = counts  # テーブルごとの件数
+
+    def book_chooser(self):
+        return SkewedChoice(self.books, self.skew)
+
+    def user_chooser(self):
+        return SkewedChoice(self.users, self.skew)
+
+    def as_dict(self):
+        return {'seed': self.seed, 'skew': self.skew, **self.counts}
+
+
+def _insert(conn, model, rows):
+    from sqlalchemy import insert
+    for offset in range(0, len(rows), BATCH_SIZE):
+        conn.execute(insert(model), rows[offset:offset + BATCH_SIZE])
+
+
+def generate(engine, books=10000, users=1000, loans=50000, reservations=20000, skew=1.1, seed=1,
+             log=print) -> Dataset:
+    """テーブルを作り直してデータを生成する"""
+    from werkzeug.security import generate_password_hash
+
+    import migrations
+    from database import Base
+    from init_db import SAMPLE_BOOKS
+    from models import Book, Loan, LoanStatus, Reservation, ReservationStatus, User, UserRole
+    from passwords import PASSWORD_HASH_METHOD
+    from activity import reconcile_user_activity
+    from stats import reconcile_stats
+
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    start = time.perf_counter()
+
+    Base.metadata.drop_all(bind=engine)
+    migrations.upgrade(bind=engine, log=lambda message: None)
+
+    # ---------- 書籍（人気の順位は書籍IDと無関係にする） ----------
+    book_ids = list(range(1, books + 1))
+    popularity = book_ids[:]
+    rng.shuffle(popularity)
+    hot = set(popularity[:max(1, books // 100)])
+    authors = SkewedChoice([f'{SAMPLE_BOOKS[i % len(SAMPLE_BOOKS)]["author"]}{i}' for i in range(books // 10 + 1)],
+                           skew)
+    total_copies = {}
+    book_rows = []
+    for book_id in book_ids:
+        template = SAMPLE_BOOKS[book_id % len(SAMPLE_BOOKS)]
+        copies = rng.randint(3, 8) if book_id in hot else rng.randint(1, template['total_copies'])
+        total_copies[book_id] = copies
+        book_rows.append({
+            'id': book_id,
+            'title': f'{template["title"]} {" ".join(rng.sample(TITLE_WORDS, 2))} 第{book_id}版',
+            'author': authors.pick(rng),
+            'isbn': make_isbn(book_id),
+            'publisher': template['publisher'],
+            'publication_date': (now - timedelta(days=rng.randint(0, 365 * 30))).date(),
+            'total_copies': copies,
+            'available_copies': copies,
+            'hold_queue_head': 0,
+            'hold_queue_tail': 0,
+            'version': 1,
+            'created_at': now - timedelta(days=365, seconds=books - book_id),
+        })
+
+    # ---------- 利用者（ID 1 はマイグレーションで作成した管理者） ----------
+    password_hash = generate_password_hash(USER_PASSWORD, method=PASSWORD_HASH_METHOD)
+    user_ids = list(range(2, users + 2))
+    user_rows = [{
+        'id': user_id,
+        'username': f'user{user_id}',
+        'email': f'user{user_id}@example.com',
+        'password_hash': password_hash,
+        'role': UserRole.USER,
+        'auth_version': 1,
+        'created_at': now - timedelta(days=400, seconds=users - user_id),
+    } for user_id in user_ids]
+    borrowers = user_ids[:]
+    rng.shuffle(borrowers)
+    pick_book = SkewedChoice(popularity, skew).pick
+    pick_user = SkewedChoice(borrowers, skew).pick
+
+    # ---------- 貸出（直近30日分の一部は貸出中。在庫を超えない） ----------
+    active = dict.fromkeys(book_ids, 0)
+    loan_rows = []
+    for loan_id in range(1, loans + 1):
+        book_id = pick_book(rng)
+        loan_date = now - timedelta(days=rng.uniform(0, 365))
+        due_date = loan_date + timedelta(days=LOAN_DAYS)
+        row = {'id': loan_id, 'user_id': pick_user(rng), 'book_id': book_id,
+               'loan_date': loan_date, 'due_date': due_date}
+        if now - loan_date < timedelta(days=30) and active[book_id] < total_copies[book_id] and rng.random() < 0.5:
+            active[book_id] += 1
+            row.update(status=LoanStatus.ACTIVE if due_date > now else LoanStatus.OVERDUE, return_date=None)
+        else:
+            row.update(status=LoanStatus.RETURNED,
+                       return_date=min(now, loan_date + timedelta(days=rng.uniform(1, LOAN_DAYS + 7))))
+        loan_rows.append(row)
+    for row in book_rows:
+        row['available_copies'] = row['total_copies'] - active[row['id']]
+
+    # ---------- 予約（過去の予約と、在庫のない人気書籍の順番待ち） ----------
+    queue_tail = dict.fromkeys(book_ids, 0)
+    open_pairs = set()
+    reservation_rows = []
+    for reservation_id in range(1, reservations + 1):
+        book_id, user_id = pick_book(rng), pick_user(rng)
+        row = {'id': reservation_id, 'user_id': user_id, 'book_id': book_id, 'queue_position': None}
+        if rng.random() < 0.6 or (user_id, book_id) in open_pairs:
+            reserved_at = now - timedelta(days=rng.uniform(RESERVATION_DAYS, 365))
+            row.update(status=rng.choice([ReservationStatus.CONFIRMED, ReservationStatus.CANCELLED,
+                                          ReservationStatus.EXPIRED]),
+                       reservation_date=reserved_at, expiry_date=reserved_at + timedelta(days=RESERVATION_DAYS))
+        elif queue_tail[book_id] == 0 and total_copies[book_id] > active[book_id]:
+            reserved_at = now - timedelta(days=rng.uniform(0, RESERVATION_DAYS))
+            row.update(status=ReservationStatus.PENDING, reservation_date=reserved_at,
+                       expiry_date=reserved_at + timedelta(days=RESERVATION_DAYS))
+            open_pairs.add((user_id, book_id))
+        else:
+            queue_tail[book_id] += 1
+            reserved_at = now - timedelta(days=rng.uniform(0, 30))
+            row.update(status=ReservationStatus.WAITING, reservation_date=reserved_at,
+                       expiry_date=now + timedelta(days=RESERVATION_DAYS), queue_position=queue_tail[book_id])
+            open_pairs.add((user_id, book_id))
+        reservation_rows.append(row)
+    for row in book_rows:
+        row['hold_queue_tail'] = queue_tail[row['id']]
+
+    with engine.begin() as conn:
+        _insert(conn, Book, book_rows)
+        _insert(conn, User, user_rows)
+        _insert(conn, Loan, loan_rows)
+        _insert(conn, Reservation, reservation_rows)
+    # ダッシュボードの集計値・日別の貸出件数・利用者ごとの件数を実データから作り直す
+    reconcile_stats(bind=engine, days=365)
+    reconcile_user_activity(bind=engine)
+
+    counts = {'books': books, 'users': users, 'loans': loans, 'reservations': reservations}
+    log(f'書籍 {books:,} / 利用者 {users:,} / 貸出 {loans:,}（貸出中 {sum(active.values()):,}）/ '
+        f'予約 {reservations:,}（順番待ち {sum(queue_tail.values()):,}）を作成しました '
+        f'({time.perf_counter() - start:.1f}秒)')
+    return Dataset(popularity, [f'user{user_id}' for user_id in borrowers], skew, seed, counts)
+
+
+def add_arguments(parser):
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--loans', type=int, default=50000)
+    parser.add_argument('--reservations', type=int, default=20000)
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf分布の指数（大きいほど偏る）')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ベンチマーク用のデータ生成')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    url = os.getenv('BENCH_DATABASE_URL', f'sqlite:///{tempfile.mkdtemp()}/bench.db')
+    os.environ['DATABASE_URL'] = url
+    from database import engine
+    generate(engine, books=args.books, users=args.users, loans=args.loans,
+             reservations=args.reservations, skew=args.skew, seed=args.seed)
+    print(f'DATABASE_URL={url}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+書籍カタログのリードスルーキャッシュ
+- バックエンド: プロセス内のLRU+TTL（既定）/ Redis互換サーバー
+- キャッシュ対象: 書籍詳細の行、検索・一覧ページの書籍ID、書籍ごとの在庫状況
+- 無効化: 書籍管理・貸出・返却・予約の各処理から明示的に行う
+
+キャッシュに格納する値は必ずプライマリから読みます（database.read_from_primary）。レプリカから読むと、
+無効化した直後に遅れているレプリカの古い値をキャッシュし直し、TTLの間そのまま返してしまうためです。
+
+在庫状況は表示用です。予約・貸出の可否は必ずデータベースで判定してください
+（inventory.py の条件付き更新）。キャッシュが古くても貸し出しすぎることはありません。
+
+プロセス内のキャッシュ（memory）では、無効化は同じワーカーにしか届きません。gunicornで複数のワーカーを
+起動した場合は、在庫状況を CACHE_LOCAL_AVAILABILITY_TTL 秒だけ置き、他のワーカーでの貸出・返却が
+数秒で表示に反映されるようにします（gunicorn.conf.py は起動時に警告します。複数ワーカーではredisを推奨）。
+"""
+
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+
+from database import read_from_primary
+from models import Book
+
+DEFAULT_TTL = int(os.getenv('CACHE_TTL', 300))
+AVAILABILITY_TTL = int(os.getenv('CACHE_AVAILABILITY_TTL', 30))
+# ワーカー間で共有しないキャッシュを複数ワーカーで使う場合の在庫状況の有効期間
+LOCAL_AVAILABILITY_TTL = int(os.getenv('CACHE_LOCAL_AVAILABILITY_TTL', 5))
+# gunicornのワーカー数（gunicorn.conf.py が設定。それ以外の起動方法では1プロセス）
+WEB_WORKERS = int(os.getenv('GUNICORN_WORKERS', 1))
+PAGE_TTL = int(os.getenv('CACHE_PAGE_TTL', 60))
+MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', 10000))
+
+# 書籍詳細としてキャッシュする列
+BOOK_COLUMNS = ('id', 'title', 'author', 'isbn', 'publisher', 'publication_date', 'created_at')
+# 在庫状況としてキャッシュする列（貸出・返却・予約で変わる）
+AVAILABILITY_COLUMNS = ('available_copies', 'total_copies', 'hold_queue_head', 'hold_queue_tail')
+
+
+class CacheStats:
+    """ヒット・ミス・追い出しの回数"""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def as_dict(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class CacheBackend:
+    """キャッシュバックエンドの基底クラス"""
+    name = 'base'
+    # 値を保持するか（保持しない場合は格納する値をプライマリから読む必要がない）
+    stores = True
+    # 全ワーカー（プロセス）で共有するか（共有する場合は削除が他のワーカーにも反映される）
+    shared = False
+
+    def __init__(self):
+        self.stats = CacheStats()
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        return {key: value for key in keys if (value := self.get(key)) is not None}
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, *keys):
+        raise NotImplementedError
+
+    def incr(self, key):
+        """カウンターを1増やして新しい値を返す"""
+        raise NotImplementedError
+
+    def counter(self, key):
+        """カウンターの現在値（追い出されない）"""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class NullCache(CacheBackend):
+    """キャッシュしない（CACHE_BACKEND=none）"""
+    name = 'none'
+    stores = False
+
+    def get(self, key):
+        self.stats.misses += 1
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def incr(self, key):
+        return 0
+
+    def counter(self, key):
+        return 0
+
+    def clear(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    """プロセス内のLRU+TTLキャッシュ（ワーカーごとに独立）"""
+    name = 'memory'
+
+    def __init__(self, max_entries=MAX_ENTRIES, default_ttl=DEFAULT_TTL):
+        super().__init__()
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                    self.stats.evictions += 1
+                self.stats.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.default_ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.stats.invalidations += 1
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache(CacheBackend):
+    """
+    Redis互換サーバーを使うキャッシュ（全ワーカーで共有）
+    clientには redis.Redis と同じ get/set/delete/incr/mget を持つオブジェクトを渡します。
+    """
+    name = 'redis'
+    shared = True
+
+    def __init__(self, client, prefix='library:', default_ttl=DEFAULT_TTL):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('CACHE_BACKEND=redis を使うには redis パッケージをインストールしてください。') from e
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        values = self.client.mget([self._key(key) for key in keys])
+        result = {}
+        for key, raw in zip(keys, values):
+            if raw is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+                result[key] = pickle.loads(raw)
+        return result
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._key(key), pickle.dumps(value), ex=ttl or self.default_ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.stats.invalidations += self.client.delete(*[self._key(key) for key in keys]) or 0
+
+    def incr(self, key):
+        return self.client.incr(self._key(key))
+
+    def counter(self, key):
+        return int(self.client.get(self._key(key)) or 0)
+
+    def clear(self):
+        pass
+
+
+def create_cache_backend():
+    """環境変数CACHE_BACKENDからバックエンドを生成"""
+    name = os.getenv('CACHE_BACKEND', 'memory')
+    if name == 'redis':
+        return RedisCache.from_url(os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0'))
+    if name == 'none':
+        return NullCache()
+    return LRUCache()
+
+
+cache = create_cache_backend()
+
+
+def availability_ttl():
+    """在庫状況の有効期間（無効化が他のワーカーに届かない場合は数秒に抑える）"""
+    if cache.shared or WEB_WORKERS <= 1:
+        return AVAILABILITY_TTL
+    return min(AVAILABILITY_TTL, LOCAL_AVAILABILITY_TTL)
+
+
+# ==================== 書籍カタログ ====================
+
+class BookSnapshot:
+    """キャッシュから復元した書籍（テンプレートではBookと同じように扱える）"""
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def is_available(self):
+        return self.available_copies > 0
+
+    def __repr__(self):
+        return f'<BookSnapshot {self.title}>'
+
+
+def _book_values(book):
+    return {column: getattr(book, column) for column in BOOK_COLUMNS}
+
+
+def _availability_values(book):
+    return {column: getattr(book, column) for column in AVAILABILITY_COLUMNS}
+
+
+def catalog_version():
+    """検索・一覧ページのキャッシュキーに含める世代番号"""
+    return cache.counter('catalog_version')
+
+
+def _filling():
+    """キャッシュに格納する値を読むブロック（読み取りをプライマリで行う）"""
+    return read_from_primary() if cache.stores else nullcontext()
+
+
+def remember_books(books):
+    """取得済みの書籍をキャッシュに格納"""
+    for book in books:
+        cache.set(f'book:{book.id}', _book_values(book))
+        cache.set(f'availability:{book.id}', _availability_values(book), ttl=availability_ttl())
+
+
+def get_books(db, book_ids):
+    """書籍IDの順にBookSnapshotを返す（キャッシュにないものだけプライマリから取得）"""
+    if not book_ids:
+        return []
+    keys = [f'book:{book_id}' for book_id in book_ids] + [f'availability:{book_id}' for book_id in book_ids]
+    cached = cache.get_many(keys)
+    missing = [book_id for book_id in book_ids
+               if f'book:{book_id}' not in cached or f'availability:{book_id}' not in cached]
+    if missing:
+        with _filling():
+            books = db.query(Book).filter(Book.id.in_(missing)).populate_existing().all()
+        remember_books(books)
+        for book in books:
+            cached[f'book:{book.id}'] = _book_values(book)
+            cached[f'availability:{book.id}'] = _availability_values(book)
+    snapshots = []
+    for book_id in book_ids:
+        values = cached.get(f'book:{book_id}')
+        availability = cached.get(f'availability:{book_id}')
+        if values is not None and availability is not None:
+            snapshots.append(BookSnapshot({**values, **availability}))
+    return snapshots
+
+
+def get_book(db, book_id):
+    """書籍詳細をキャッシュ経由で取得（存在しなければNone）"""
+    books = get_books(db, [book_id])
+    return books[0] if books else None
+
+
+def get_page(key, compute):
+    """
+    検索・一覧ページの書籍IDなどをキャッシュ経由で取得
+    keyには (検索語, カーソル) などページを特定する値を渡します。
+    computeの読み取り（computeの中でキャッシュに格納する書籍も含む）はプライマリで行います。
+    """
+    full_key = f'page:{catalog_version()}:{key}'
+    value = cache.get(full_key)
+    if value is None:
+        with _filling():
+            value = compute()
+        cache.set(full_key, value, ttl=PAGE_TTL)
+    return value
+
+
+def invalidate_availability(book_id):
+    """貸出・返却・予約で在庫状況が変わったとき"""
+    cache.delete(f'availability:{book_id}')
+
+
+def invalidate_book(book_id):
+    """書籍の追加・編集・削除のとき（検索・一覧ページもすべて無効化）"""
+    invalidate_books([book_id])
+
+
+def invalidate_books(book_ids):
+    """一括インポートなどで複数の書籍が変わったとき"""
+    keys = [key for book_id in book_ids for key in (f'book:{book_id}', f'availability:{book_id}')]
+    cache.delete(*keys)
+    cache.incr('catalog_version')
@@ -0,0 +1,337 @@
+"""
+貸出・返却の一括処理（カウンターでの返却ボックスの処理など）
+1件ずつPOSTしてコミットする代わりに、予約ID・貸出ID（またはISBN）の一覧を1つのトランザクションで処理します。
+- 対象の行は1回のSELECT ... FOR UPDATEでまとめてロック（書籍はデッドロックを避けるためID順）
+- 在庫はinventory.take_copies / put_back_copiesの1回のUPDATE、貸出は一括INSERTで作成
+- 処理できない項目（見つからない・在庫なしなど）は項目ごとの結果として返し、残りはそのまま処理する
+"""
+
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select, update
+
+from activity import adjust_users, loans_remaining
+from holds import holds_copy, promote_holds
+from inventory import put_back_copies, run_with_retry, take_copies
+from models import Book, Loan, LoanStatus, Reservation, ReservationStatus, normalize_isbn
+from stats import adjust, record_loans
+from versions import touch
+
+# 1回のリクエストで処理できる件数の上限
+MAX_BATCH_ITEMS = 500
+LOAN_DAYS = 14
+
+OK = 'ok'
+MESSAGES = {
+    OK: '処理しました。',
+    'duplicate': '同じ項目が一覧に重複しています。',
+    'not_found': '見つかりません。',
+    'not_pending': 'この予約は貸出できません。',
+    'unavailable': 'この書籍は現在利用できません。',
+    'limit': '貸出中の書籍が上限に達しています。',
+    'already_returned': 'この貸出は既に返却されています。',
+    'no_active_loan': 'このISBNの書籍で貸出中のものがありません。',
+}
+
+
+class ConcurrentUpdate(Exception):
+    """ロックした行が他のトランザクションで更新されていた（最初からやり直す）"""
+
+
+class BatchResult:
+    """一括処理の結果（項目ごとの結果を入力の順に保持）"""
+    def __init__(self, key):
+        self.key = key
+        self.items = []
+        self.seconds = 0.0
+        self.book_ids = []  # 在庫が変わった書籍（コミット後のキャッシュの無効化用）
+
+    def add(self, value, status, **extra):
+        self.items.append({self.key: value, 'status': status, 'message': MESSAGES[status], **extra})
+
+    @property
+    def succeeded(self):
+        return sum(1 for item in self.items if item['status'] == OK)
+
+    @property
+    def failed(self):
+        return len(self.items) - self.succeeded
+
+    @property
+    def items_per_second(self):
+        return len(self.items) / self.seconds if self.seconds > 0 else 0.0
+
+    def as_dict(self):
+        return {'results': self.items, 'succeeded': self.succeeded, 'failed': self.failed,
+                'seconds': round(self.seconds, 6)}
+
+    def __str__(self):
+        return (f'{len(self.items)} 件（成功 {self.succeeded} / 失敗 {self.failed}）/ {self.seconds:.3f}秒 '
+                f'({self.items_per_second:,.0f} items/s)')
+
+
+def _unique(values):
+    """重複を除いた一覧と、2回目以降に現れた位置の集合"""
+    seen, unique, duplicates = set(), [], set()
+    for i, value in enumerate(values):
+        if value in seen:
+            duplicates.add(i)
+        else:
+            seen.add(value)
+            unique.append(value)
+    return unique, duplicates
+
+
+def _lock_books(db, book_ids):
+    """書籍の行をID順にロックして {書籍ID: 行} を返す"""
+    rows = db.execute(
+        select(Book.id, Book.available_copies, Book.hold_queue_head, Book.hold_queue_tail)
+        .where(Book.id.in_(book_ids))
+        .order_by(Book.id)
+        .with_for_update()
+    ).all()
+    return {row.id: row for row in rows}
+
+
+def _insert_loans(db, rows):
+    """
+    貸出を1回の複数行INSERTで作成し、{予約ID: 貸出ID} を返す
+    RETURNING を複数行のINSERTで使えるデータベース（SQLite・PostgreSQL・MariaDB）はINSERTから受け取り、
+    使えないMySQLでは予約ID（loans.reservation_id）で読み直します（予約1件から作成する貸出は1件のため、
+    同じ秒に作成した他の貸出と取り違えることはありません。自動採番の連続性にも依存しません）。
+    """
+    statement = insert(Loan)
+    if db.get_bind(clause=statement).dialect.insert_executemany_returning_sort_by_parameter_order:
+        loan_ids = db.execute(statement.returning(Loan.id, sort_by_parameter_order=True), rows).scalars()
+        return {row['reservation_id']: loan_id for row, loan_id in zip(rows, loan_ids)}
+    db.execute(statement.values(rows))
+    return dict(db.execute(
+        select(Loan.reservation_id, Loan.id).where(Loan.reservation_id.in_([row['reservation_id'] for row in rows]))
+    ).all())
+
+
+def _run(db, func, attempts=3):
+    """ConcurrentUpdateの場合はロールバックしてやり直す（デッドロックはrun_with_retryがやり直す）"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return run_with_retry(db, func)
+        except ConcurrentUpdate:
+            db.rollback()
+            if attempt == attempts:
+                raise
+
+
+# ==================== 貸出 ====================
+
+def checkout_reservations(db, reservation_ids) -> BatchResult:
+    """
+    待機中の予約を一括で貸出にする（管理者のカウンター業務用）
+    在庫が足りない書籍は入力の順に割り当て、割り当てられなかった予約は 'unavailable' になります。
+    利用者ごとの貸出の上限も1件ずつの貸出と同じく確認し（loans_remaining）、超える分は 'limit' になります。
+    """
+    start = time.perf_counter()
+    unique_ids, duplicates = _unique(reservation_ids)
+
+    def checkout():
+        now = datetime.utcnow()
+        rows = {row.id: row for row in db.execute(
+            select(Reservation.id, Reservation.user_id, Reservation.book_id, Reservation.status,
+                   Reservation.queue_position)
+            .where(Reservation.id.in_(unique_ids))
+            .order_by(Reservation.id)
+            .with_for_update()
+        )} if unique_ids else {}
+        books = _lock_books(db, {row.book_id for row in rows.values()}) if rows else {}
+        allowance = loans_remaining(db, {row.user_id for row in rows.values()
+                                         if row.status == ReservationStatus.PENDING})
+
+        # 在庫を入力の順に割り当てる（順番待ちから繰り上げた予約は、確保済みの1冊を貸し出す）
+        remaining = {book_id: book.available_copies for book_id, book in books.items()}
+        statuses, claimed, counts, taken = {}, [], {}, {}
+        for reservation_id in unique_ids:
+            row = rows.get(reservation_id)
+            if row is None:
+                statuses[reservation_id] = 'not_found'
+            elif row.status != ReservationStatus.PENDING:
+                statuses[reservation_id] = 'not_pending'
+            elif not holds_copy(row) and remaining.get(row.book_id, 0) <= 0:
+                statuses[reservation_id] = 'unavailable'
+            elif allowance[row.user_id] <= 0:
+                statuses[reservation_id] = 'limit'
+            else:
+                allowance[row.user_id] -= 1
+                if not holds_copy(row):
+                    remaining[row.book_id] -= 1
+                    taken[row.book_id] = taken.get(row.book_id, 0) + 1
+                counts[row.book_id] = counts.get(row.book_id, 0) + 1
+                claimed.append(row)
+                statuses[reservation_id] = OK
+
+        loan_ids = {}
+        if claimed:
+            updated = db.execute(
+                update(Reservation)
+                .where(Reservation.id.in_([row.id for row in claimed]),
+                       Reservation.status == ReservationStatus.PENDING)
+                .values(status=ReservationStatus.CONFIRMED),
+                execution_options={'synchronize_session': False},
+            ).rowcount
+            if updated != len(claimed) or not take_copies(db, taken):
+                raise ConcurrentUpdate()
+            loan_ids = _insert_loans(db, [{
+                'user_id': row.user_id, 'book_id': row.book_id, 'reservation_id': row.id, 'loan_date': now,
+                'due_date': now + timedelta(days=LOAN_DAYS), 'status': LoanStatus.ACTIVE,
+            } for row in claimed])
+            adjust(db, pending_reservations=-len(claimed), active_loans=len(claimed))
+            adjust_users(db, Counter(row.user_id for row in claimed), pending_reservations=-1, active_loans=1)
+            record_loans(db, counts, now)
+            touch(db, 'books', 'reservations', 'loans')
+        db.commit()
+        return statuses, loan_ids, list(counts)
+
+    statuses, loan_ids, book_ids = _run(db, checkout)
+    result = BatchResult('reservation_id')
+    for i, reservation_id in enumerate(reservation_ids):
+        if i in duplicates:
+            result.add(reservation_id, 'duplicate')
+        elif statuses[reservation_id] == OK:
+            result.add(reservation_id, OK, loan_id=loan_ids.get(reservation_id))
+        else:
+            result.add(reservation_id, statuses[reservation_id])
+    result.seconds = time.perf_counter() - start
+    result.book_ids = book_ids
+    return result
+
+
+# ==================== 返却 ====================
+
+def return_loans(db, loan_ids) -> BatchResult:
+    """貸出を一括で返却し、在庫を戻して順番待ちを繰り上げる"""
+    start = time.perf_counter()
+    unique_ids, duplicates = _unique(loan_ids)
+
+    def check_in():
+        now = datetime.utcnow()
+        rows = {row.id: row for row in db.execute(
+            select(Loan.id, Loan.user_id, Loan.book_id, Loan.status)
+            .where(Loan.id.in_(unique_ids))
+            .order_by(Loan.id)
+            .with_for_update()
+        )} if unique_ids else {}
+        statuses, returning, counts = {}, [], {}
+        for loan_id in unique_ids:
+            row = rows.get(loan_id)
+            if row is None:
+                statuses[loan_id] = 'not_found'
+            elif row.status == LoanStatus.RETURNED:
+                statuses[loan_id] = 'already_returned'
+            else:
+                returning.append(row)
+                counts[row.book_id] = counts.get(row.book_id, 0) + 1
+                statuses[loan_id] = OK
+
+        if returning:
+            books = _lock_books(db, counts)
+            updated = db.execute(
+                update(Loan)
+                .where(Loan.id.in_([row.id for row in returning]),
+                       Loan.status.in_([LoanStatus.ACTIVE, LoanStatus.OVERDUE]))
+                .values(status=LoanStatus.RETURNED, return_date=now),
+                execution_options={'synchronize_session': False},
+            ).rowcount
+            if updated != len(returning):
+                raise ConcurrentUpdate()
+            overdue = Counter(row.user_id for row in returning if row.status == LoanStatus.OVERDUE)
+            active = Counter(row.user_id for row in returning if row.status != LoanStatus.OVERDUE)
+            adjust(db, active_loans=-active.total(), overdue_loans=-overdue.total())
+            adjust_users(db, active, active_loans=-1)
+            adjust_users(db, overdue, overdue_loans=-1)
+            put_back_copies(db, counts)
+            # 順番待ちのある書籍だけ、戻した冊数分を繰り上げる
+            for book_id, count in counts.items():
+                book = books.get(book_id)
+                if book is not None and book.hold_queue_head < book.hold_queue_tail:
+                    promote_holds(db, book_id, count)
+            touch(db, 'books', 'reservations', 'loans')
+        db.commit()
+        return statuses, list(counts)
+
+    statuses, book_ids = _run(db, check_in)
+    result = BatchResult('loan_id')
+    for i, loan_id in enumerate(loan_ids):
+        result.add(loan_id, 'duplicate' if i in duplicates else statuses[loan_id])
+    result.seconds = time.perf_counter() - start
+    result.book_ids = book_ids
+    return result
+
+
+# ==================== ISBNでの指定 ====================
+
+def _books_by_isbn(db, isbns):
+    """ISBN（正規化済み）-> 書籍ID（books.isbn は正規化して保存されているため、一意インデックスで照合できる）"""
+    wanted = {normalize_isbn(isbn) for isbn in isbns if isbn}
+    if not wanted:
+        return {}
+    return dict(db.execute(select(Book.isbn, Book.id).where(Book.isbn.in_(wanted))).all())
+
+
+def find_reservations_by_isbn(db, user_id, isbns):
+    """利用者の待機中の予約を、ISBNの一覧の順に予約IDへ変換（見つからなければNone）"""
+    books = _books_by_isbn(db, isbns)
+    rows = db.execute(
+        select(Reservation.id, Reservation.book_id)
+        .where(Reservation.user_id == user_id, Reservation.book_id.in_(set(books.values())),
+               Reservation.status == ReservationStatus.PENDING)
+    ).all() if books else []
+    by_book = {row.book_id: row.id for row in rows}
+    return [by_book.get(books.get(normalize_isbn(isbn))) for isbn in isbns]
+
+
+def find_loans_by_isbn(db, isbns):
+    """
+    ISBNの一覧を貸出IDに変換（見つからなければNone）
+    同じISBNが複数回ある場合は、その書籍の貸出中のものを貸出日の古い順に割り当てます。
+    """
+    books = _books_by_isbn(db, isbns)
+    rows = db.execute(
+        select(Loan.id, Loan.book_id)
+        .where(Loan.book_id.in_(set(books.values())),
+               Loan.status.in_([LoanStatus.ACTIVE, LoanStatus.OVERDUE]))
+        .order_by(Loan.loan_date, Loan.id)
+    ).all() if books else []
+    queues = {}
+    for row in rows:
+        queues.setdefault(row.book_id, []).append(row.id)
+    loan_ids = []
+    for isbn in isbns:
+        queue = queues.get(books.get(normalize_isbn(isbn)), [])
+        loan_ids.append(queue.pop(0) if queue else None)
+    return loan_ids
+
+
+def _with_isbns(isbns, ids, process, missing_status):
+    """ISBNから変換したIDを処理し、結果に入力のISBNを付ける（変換できなかったものは missing_status）"""
+    result = process([item_id for item_id in ids if item_id is not None])
+    processed = iter(result.items)
+    items = []
+    for isbn, item_id in zip(isbns, ids):
+        if item_id is None:
+            items.append({'isbn': isbn, 'status': missing_status, 'message': MESSAGES[missing_status]})
+        else:
+            items.append({'isbn': isbn, **next(processed)})
+    result.items = items
+    return result
+
+
+def checkout_isbns(db, user_id, isbns) -> BatchResult:
+    """利用者の待機中の予約を、ISBN（書籍のバーコード）の一覧で一括貸出"""
+    ids = find_reservations_by_isbn(db, user_id, isbns)
+    return _with_isbns(isbns, ids, lambda reservation_ids: checkout_reservations(db, reservation_ids), 'not_found')
+
+
+def return_isbns(db, isbns) -> BatchResult:
+    """ISBN（書籍のバーコード）の一覧で一括返却"""
+    ids = find_loans_by_isbn(db, isbns)
+    return _with_isbns(isbns, ids, lambda loan_ids: return_loans(db, loan_ids), 'no_active_loan')
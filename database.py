@@ -1,7 +1,13 @@
-from flask import Flask
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+from flask import Flask, current_app, g, has_request_context, session as flask_session
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 import os
 
 # データベース接続設定
@@ -11,51 +17,502 @@ DB_USER = os.getenv('DB_USER', 'root')
 DB_PASSWORD = os.getenv('DB_PASSWORD', '')
 DB_NAME = os.getenv('DB_NAME', 'library_system')
 
-DATABASE_URL = f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}?charset=utf8mb4'
-
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    pool_recycle=3600,
-    echo=False
+# DATABASE_URLが指定されていればそれを優先（SQLiteでのローカル検証・ベンチマーク用）
+DATABASE_URL = os.getenv(
+    'DATABASE_URL',
+    f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}?charset=utf8mb4'
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
 
-def init_db(app: Flask):
-    """データベースの初期化"""
-    from models import User, Book, Reservation, Loan, UserRole
-    
-    # テーブルを作成
-    Base.metadata.create_all(bind=engine)
-    
-    # 初期管理者ユーザーを作成（存在しない場合）
-    db = SessionLocal()
+# ==================== コネクションプール ====================
+# 配置ごとの既定値（環境変数 DB_POOL_PROFILE で選択し、個別の環境変数で上書き）
+#   web:    Webワーカー。接続を使い回すため、しばらく使われていない接続だけ生存確認する
+#   worker: 定期ジョブ・インポートなどの長時間処理
+#   cli:    1回だけ実行するコマンド
+# MySQLの max_connections は「プロセス数 ×（pool_size + max_overflow）」以上にしてください。
+POOL_PROFILES = {
+    'web': {'pool_size': 10, 'max_overflow': 10, 'pool_timeout': 10, 'ping': 'idle'},
+    'worker': {'pool_size': 2, 'max_overflow': 2, 'pool_timeout': 30, 'ping': 'always'},
+    'cli': {'pool_size': 1, 'max_overflow': 1, 'pool_timeout': 30, 'ping': 'always'},
+}
+DB_POOL_PROFILE = os.getenv('DB_POOL_PROFILE', 'web')
+_profile = POOL_PROFILES.get(DB_POOL_PROFILE, POOL_PROFILES['web'])
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', _profile['pool_size']))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', _profile['max_overflow']))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', _profile['pool_timeout']))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))
+# 生存確認: always（取り出すたびにping）/ idle（一定時間使われていない接続のみ）/ off
+DB_POOL_PING = os.getenv('DB_POOL_PING', _profile['ping'])
+DB_POOL_PING_IDLE = float(os.getenv('DB_POOL_PING_IDLE', 30))
+
+# 接続待ち時間のヒストグラムの区切り（ミリ秒）
+POOL_WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class PoolMetrics:
+    """コネクションプールの利用状況（接続待ち時間・エラー件数など）"""
+    def __init__(self, buckets=POOL_WAIT_BUCKETS_MS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.wait_counts = [0] * (len(self.buckets) + 1)  # 最後は上限なし
+            self.wait_sum_ms = 0.0
+            self.checkouts = 0
+            self.max_checked_out = 0
+            self.connects = 0
+            self.timeouts = 0
+            self.connection_errors = 0
+            self.invalidations = 0
+            self.pings = 0
+            self.ping_failures = 0
+
+    def observe_wait(self, elapsed_ms):
+        with self._lock:
+            self.wait_sum_ms += elapsed_ms
+            for i, bound in enumerate(self.buckets):
+                if elapsed_ms <= bound:
+                    self.wait_counts[i] += 1
+                    break
+            else:
+                self.wait_counts[-1] += 1
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def observe_checkout(self, checked_out):
+        with self._lock:
+            self.checkouts += 1
+            self.max_checked_out = max(self.max_checked_out, checked_out)
+
+    def histogram(self):
+        """(上限ms, 件数) の一覧（累積ではない。最後の上限はNone）"""
+        return list(zip(list(self.buckets) + [None], self.wait_counts))
+
+    def as_dict(self, pool=None):
+        waits = sum(self.wait_counts)
+        status = {
+            'profile': DB_POOL_PROFILE,
+            'ping': DB_POOL_PING,
+            'checkouts': self.checkouts,
+            'max_checked_out': self.max_checked_out,
+            'connects': self.connects,
+            'timeouts': self.timeouts,
+            'connection_errors': self.connection_errors,
+            'invalidations': self.invalidations,
+            'pings': self.pings,
+            'ping_failures': self.ping_failures,
+            'wait_histogram': self.histogram(),
+            'wait_count': waits,
+            'wait_avg_ms': self.wait_sum_ms / waits if waits else 0.0,
+        }
+        if isinstance(pool, QueuePool):
+            status.update(size=pool.size(), max_overflow=pool._max_overflow, timeout=pool.timeout(),
+                          checked_out=pool.checkedout(), checked_in=pool.checkedin(),
+                          overflow=max(0, pool.overflow()))
+        return status
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """接続を取り出すまでの待ち時間とタイムアウトを記録するQueuePool"""
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.increment('timeouts')
+            raise
+        finally:
+            pool_metrics.observe_wait((time.perf_counter() - start) * 1000)
+
+
+def _engine_options(url):
+    """プロファイルと環境変数からcreate_engineの引数を作成"""
+    options = {'pool_recycle': DB_POOL_RECYCLE, 'pool_pre_ping': DB_POOL_PING == 'always', 'echo': False}
+    # インメモリのSQLiteは1接続を共有するプールのため、サイズを指定しない
+    if not (url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')):
+        options.update(poolclass=InstrumentedQueuePool, pool_size=DB_POOL_SIZE,
+                       max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+
+def instrument_pool(target):
+    """プールのイベントで利用状況を記録し、idleモードの生存確認を行う"""
+    @event.listens_for(target, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        pool_metrics.increment('connects')
+
+    @event.listens_for(target, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        connection_record.info['checked_in_at'] = time.monotonic()
+
+    @event.listens_for(target, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool = target.pool if isinstance(target, Engine) else target
+        pool_metrics.observe_checkout(pool.checkedout() if isinstance(pool, QueuePool) else 1)
+        checked_in_at = connection_record.info.get('checked_in_at')
+        if DB_POOL_PING != 'idle' or checked_in_at is None:
+            return
+        if time.monotonic() - checked_in_at < DB_POOL_PING_IDLE:
+            return
+        # しばらく使われていない接続だけ確認（切れていればプールが新しい接続に取り替える）
+        pool_metrics.increment('pings')
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        except Exception:
+            pool_metrics.increment('ping_failures')
+            raise exc.DisconnectionError()
+        finally:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+
+    @event.listens_for(target, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        pool_metrics.increment('invalidations')
+
+
+engine = create_engine(DATABASE_URL, **_engine_options(make_url(DATABASE_URL)))
+instrument_pool(engine)
+
+
+@event.listens_for(engine, 'handle_error')
+def _count_connection_errors(context):
+    """接続の切断・接続失敗を数える"""
+    if context.is_disconnect or context.connection is None:
+        pool_metrics.increment('connection_errors')
+
+
+def pool_status():
+    """管理画面・メトリクス用のプールの状態"""
+    return pool_metrics.as_dict(engine.pool)
+
+
+
+# ==================== 読み取りレプリカ ====================
+# 読み取り専用のルート（書籍一覧・詳細、予約・貸出一覧、ユーザー管理）はレプリカに振り分け、
+# 書き込みと、書き込み直後のリダイレクト先の読み取りはプライマリで行う
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+# round_robin（順番に使う）/ least_loaded（使用中の接続が最も少ないもの）
+REPLICA_STRATEGY = os.getenv('REPLICA_STRATEGY', 'round_robin')
+REPLICA_HEALTH_INTERVAL = float(os.getenv('REPLICA_HEALTH_INTERVAL', 10))
+# レプリケーション遅延がこの秒数を超えたレプリカは使わない
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 30))
+# 書き込み後、この秒数は同じ利用者の読み取りもプライマリで行う（自分の書き込みを読めるように）
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', 5))
+
+
+class Replica:
+    """読み取りレプリカ（一定間隔で死活と遅延を確認）"""
+    def __init__(self, url):
+        self.url = make_url(url)
+        self.engine = create_engine(url, **_engine_options(self.url))
+        self.healthy = True
+        self.lag = None
+        self.last_error = None
+        self.checked_at = None
+        self.selections = 0
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.url.render_as_string(hide_password=True)
+
+    def load(self):
+        pool = self.engine.pool
+        return pool.checkedout() if isinstance(pool, QueuePool) else 0
+
+    def check(self):
+        """SELECT 1 と（MySQLでは）レプリケーション遅延を確認"""
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+                self.lag = self._replication_lag(conn)
+            self.healthy = self.lag is None or self.lag <= REPLICA_MAX_LAG
+            self.last_error = None if self.healthy else f'レプリケーション遅延 {self.lag}秒'
+        except Exception as e:
+            self.healthy = False
+            self.last_error = str(e)
+        self.checked_at = time.monotonic()
+        return self.healthy
+
+    def _replication_lag(self, conn):
+        if conn.dialect.name != 'mysql':
+            return None
+        try:
+            row = conn.execute(text('SHOW REPLICA STATUS')).mappings().first()
+        except Exception:
+            # 権限がない・古いバージョンなどで取得できない場合は遅延を確認しない
+            return None
+        if row is None:
+            return None
+        lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+        return None if lag is None else float(lag)
+
+    def is_healthy(self):
+        if self.checked_at is None or time.monotonic() - self.checked_at >= REPLICA_HEALTH_INTERVAL:
+            # 確認中の他のスレッドは前回の結果を使う
+            if self._lock.acquire(blocking=False):
+                try:
+                    self.check()
+                finally:
+                    self._lock.release()
+        return self.healthy
+
+    def status(self):
+        return {'name': self.name, 'healthy': self.healthy, 'lag': self.lag, 'load': self.load(),
+                'selections': self.selections, 'last_error': self.last_error}
+
+
+class ReplicaSet:
+    """レプリカの選択（正常なものだけを対象に、ラウンドロビンまたは最小負荷）"""
+    def __init__(self, urls, strategy=REPLICA_STRATEGY):
+        self.replicas = [Replica(url) for url in urls]
+        self.strategy = strategy
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """使用するレプリカのエンジン（正常なものがなければNone）"""
+        candidates = [replica for replica in self.replicas if replica.is_healthy()]
+        if not candidates:
+            return None
+        if self.strategy == 'least_loaded':
+            replica = min(candidates, key=lambda r: (r.load(), r.selections))
+        else:
+            with self._lock:
+                replica = candidates[self._next % len(candidates)]
+                self._next += 1
+        replica.selections += 1
+        return replica.engine
+
+    def status(self):
+        return [replica.status() for replica in self.replicas]
+
+
+replicas = ReplicaSet(DATABASE_REPLICA_URLS)
+
+
+# read_from_primary のブロック内かどうか（スレッドごと）
+_primary_reads = threading.local()
+
+
+@contextmanager
+def read_from_primary():
+    """
+    ブロック内の読み取りをプライマリで行う
+    キャッシュに格納する値を読むときに使います（遅れているレプリカから読むと、
+    無効化した直後に古い値をキャッシュし直し、TTLの間そのまま返してしまうため）。
+    """
+    _primary_reads.depth = getattr(_primary_reads, 'depth', 0) + 1
     try:
-        admin = db.query(User).filter_by(username='admin').first()
-        if not admin:
-            from werkzeug.security import generate_password_hash
-            admin = User(
-                username='admin',
-                email='admin@library.com',
-                password_hash=generate_password_hash('admin123', method='pbkdf2:sha256'),
-                role=UserRole.ADMIN
-            )
-            db.add(admin)
-            db.commit()
-            print("初期管理者ユーザーを作成しました: admin / admin123")
-    except Exception as e:
-        print(f"初期管理者ユーザーの作成中にエラーが発生しました: {e}")
-        db.rollback()
+        yield
     finally:
-        db.close()
+        _primary_reads.depth -= 1
+
+
+def _primary_requested():
+    """書き込み直後のリクエストやキャッシュへの格納など、読み取りもプライマリで行うべきか"""
+    if getattr(_primary_reads, 'depth', 0):
+        return True
+    return has_request_context() and g.get('read_primary', False)
+
+
+def _mark_write():
+    if has_request_context():
+        g.db_wrote = True
+
+
+class RoutingSession(Session):
+    """
+    読み取り専用のセッション（info={'read_only': True}）のSELECTだけをレプリカに振り分けるセッション
+    1つのセッションでは同じレプリカを使い続けます。
+    """
+    def get_bind(self, mapper=None, clause=None, **kw):
+        writing = self._flushing or (clause is not None and clause.is_dml)
+        if writing:
+            _mark_write()
+        if (writing or not self.info.get('read_only') or not replicas.replicas
+                or getattr(clause, '_for_update_arg', None) is not None or _primary_requested()):
+            return engine
+        if 'replica' not in self.info:
+            self.info['replica'] = replicas.choose() or engine
+        return self.info['replica']
+
+
+def dispose_after_fork():
+    """
+    fork直後のワーカーで呼び出す（gunicornのpreload用）
+    親プロセスで開いた接続をワーカー間で共有しないよう、プールを作り直します（親の接続は閉じない）。
+    """
+    engine.dispose(close=False)
+    for replica in replicas.replicas:
+        replica.engine.dispose(close=False)
+
+
+def ping_database():
+    """プライマリに SELECT 1 を実行し、失敗した場合はエラーの内容を返す（成功時はNone）"""
+    try:
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+    except Exception as e:
+        return str(e)
+    return None
+
+
+def init_replica_routing(app: Flask):
+    """書き込みを行った利用者の直後の読み取りを、一定時間プライマリに固定する"""
+    @app.before_request
+    def _route_reads_after_write():
+        g.read_primary = flask_session.get('read_primary_until', 0) > time.time()
+
+    @app.after_request
+    def _remember_write(response):
+        if g.get('db_wrote') and replicas.replicas:
+            flask_session['read_primary_until'] = time.time() + REPLICA_STICKY_SECONDS
+        return response
+
+
+SessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, bind=engine)
+Base = declarative_base()
+
+
+# ==================== リクエスト単位のセッション ====================
+
+def get_session() -> Session:
+    """
+    現在のリクエストのセッションを取得（最初の呼び出しで作成し、g に保持）
+    ルートとユーザーローダーで同じセッションを使うため、1リクエストの接続は1本で、
+    一度読み込んだオブジェクトはリクエスト内で再利用されます。
+    """
+    if 'db' not in g:
+        g.db = SessionLocal(info={'read_only': g.get('read_only', False)})
+    return g.db
+
+
+def read_only(view):
+    """読み取りだけを行うルートを示すデコレータ（リクエストのセッションのSELECTをレプリカに振り分ける）"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        if 'db' in g:
+            g.db.info['read_only'] = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def init_request_session(app: Flask):
+    """
+    リクエストの終わりにセッションを確定して閉じる
+    正常なレスポンス（400未満）を返す前に未コミットの変更をコミットし、
+    エラーのレスポンスや例外で終わった場合はロールバックします。
+    テンプレートの描画はセッションを閉じる前に終わるため、遅延読み込みも失敗しません。
+    """
+    @app.after_request
+    def _commit_session(response):
+        db = g.get('db')
+        if db is not None and db.in_transaction():
+            if response.status_code < 400:
+                db.commit()
+            else:
+                db.rollback()
+        return response
+
+    @app.teardown_appcontext
+    def _close_session(error=None):
+        db = g.pop('db', None)
+        if db is not None:
+            if error is not None:
+                db.rollback()
+            db.close()
+
+def init_db(app: Flask):
+    """
+    起動時のスキーマ確認（テーブル作成・初期管理者の作成はマイグレーションで行い、ここでは実行しない）
+    schema_version の1行を読み、未適用のマイグレーションがあれば起動を中止します。
+    AUTO_MIGRATE=true の場合（ローカル開発・テスト用）はその場で適用します。
+    """
+    from migrations import check_schema
+    check_schema(auto_migrate=os.getenv('AUTO_MIGRATE', 'False').lower() == 'true')
 
 def get_db():
-    """データベースセッションを取得"""
+    """データベースセッションを取得（リクエストの外で使う場合）"""
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+
+class QueryCounter:
+    """発行されたSQLを数える（count_queries を呼び出したスレッドの分のみ）"""
+    def __init__(self, bind=None):
+        self.count = 0
+        self.statements = []
+        self.bind = bind
+    
+    def record(self, conn, statement):
+        if self.bind is None or conn.engine is getattr(self.bind, 'engine', self.bind):
+            self.count += 1
+            self.statements.append(statement)
+
+# 計測中の QueryCounter（スレッドごと）
+_query_counters = threading.local()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    for counter in getattr(_query_counters, 'active', ()):
+        counter.record(conn, statement)
+
+@contextmanager
+def count_queries(bind=None):
+    """
+    ブロック内で発行されたSQLの数を数える（bindを省略した場合はレプリカを含むすべてのエンジン）
+    リスナーは常に登録しておきスレッドごとの計数器に振り分けるため、
+    他のスレッドで実行中のSQLのイベントと競合しません（リクエストごとに登録・解除すると競合する）。
+    """
+    counter = QueryCounter(bind)
+    active = _query_counters.__dict__.setdefault('active', [])
+    active.append(counter)
+    try:
+        yield counter
+    finally:
+        active.remove(counter)
+
+@contextmanager
+def assert_max_queries(max_queries, bind=None):
+    """ブロック内のSQL数が上限を超えたらAssertionErrorを送出"""
+    with count_queries(bind) as counter:
+        yield counter
+    if counter.count > max_queries:
+        detail = '\n'.join(counter.statements)
+        raise AssertionError(f'{counter.count} queries executed (budget: {max_queries}):\n{detail}')
+
+def query_budget(max_queries):
+    """
+    ルートのクエリ数の上限を宣言するデコレータ
+    テスト時（app.testing または QUERY_BUDGET_STRICT）は超過でAssertionError、
+    それ以外は警告ログのみ
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            with count_queries() as counter:
+                response = view(*args, **kwargs)
+            if counter.count > max_queries:
+                message = f'{view.__name__}: {counter.count} queries executed (budget: {max_queries})'
+                if current_app.testing or current_app.config.get('QUERY_BUDGET_STRICT'):
+                    raise AssertionError(message + '\n' + '\n'.join(counter.statements))
+                current_app.logger.warning(message)
+            return response
+        wrapper.query_budget = max_queries
+        return wrapper
+    return decorator
@@ -35,11 +35,15 @@ while retry_count < max_retries:
             sys.exit(1)
 "
 
-echo "データベースを初期化中..."
-# データベース初期化（非対話的、サンプル書籍は作成しない）
-CREATE_SAMPLE_BOOKS=false python init_db.py
+echo "マイグレーションを適用中..."
+# デプロイごとに1回だけスキーマを更新（アプリの起動時はバージョンの確認のみ）
+python migrations.py upgrade
 
-echo "Flaskアプリケーションを起動中..."
-# Flaskアプリケーションを起動
-exec python app.py
+if [ "${APP_SERVER:-gunicorn}" = "dev" ]; then
+    echo "Flask開発サーバーを起動中..."
+    exec python app.py
+fi
+
+echo "gunicornでアプリケーションを起動中..."
+exec gunicorn -c gunicorn.conf.py app:app
 
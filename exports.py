@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+貸出・予約・ユーザーのエクスポート（CSV / JSON / JSON Lines）
+全件を一度に読み込まず、キーセット（日付, id または id）で一定件数ずつ短いトランザクションで取得し、
+各チャンクはサーバー側カーソル（stream_results / yield_per）で読みながら書き出します。
+長時間のトランザクションを保持しないため、大量の行を出力しても貸出・返却の処理を妨げません。
+貸出・予約はアーカイブ（archive.py）に移動した行も、現行のテーブルと同じ順に合わせて出力します
+（各チャンクを両方のテーブルの UNION ALL の1文で読むため、エクスポート中に移動した行も重複・欠落しません）。
+
+使い方:
+  python exports.py loans [--format csv|json|jsonl] [--start 2024-01-01] [--end 2024-12-31]
+                          [--status returned] [--output loans.csv]
+  python exports.py reservations --status pending
+  python exports.py users --status admin
+"""
+
+import argparse
+import csv
+import enum
+import io
+import json
+import os
+import sys
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, or_, select, union_all
+
+from database import engine
+from models import (Book, Loan, LoanArchive, LoanStatus, Reservation, ReservationArchive, ReservationStatus, User,
+                    UserRole)
+
+# 1回のトランザクションで取得する行数と、サーバー側カーソルから一度に受け取る行数
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', 10000))
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', 1000))
+
+FORMATS = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+class ExportSpec:
+    """エクスポート対象（出力する列、日付の列、状態の列。archiveはアーカイブのテーブルの同じ形の対象）"""
+    def __init__(self, name, model, date_column, status_column, status_enum, columns, joins=(), archive=None):
+        self.name = name
+        self.model = model
+        self.date_column = date_column
+        self.status_column = status_column
+        self.status_enum = status_enum
+        self.columns = columns
+        self.joins = joins
+        self.archive = archive
+
+    @property
+    def headers(self):
+        return [name for name, _ in self.columns]
+
+    def parse_status(self, value):
+        """'returned' などの値を列挙型に変換（不正な値はValueError）"""
+        try:
+            return self.status_enum(value.lower())
+        except ValueError:
+            choices = ', '.join(member.value for member in self.status_enum)
+            raise ValueError(f'{self.name} の状態は {choices} のいずれかを指定してください。')
+
+
+def _loan_spec(model, archive=None):
+    return ExportSpec(
+        'loans', model, model.loan_date, model.status, LoanStatus,
+        [('id', model.id), ('user_id', model.user_id), ('username', User.username),
+         ('book_id', model.book_id), ('title', Book.title), ('isbn', Book.isbn),
+         ('loan_date', model.loan_date), ('due_date', model.due_date),
+         ('return_date', model.return_date), ('status', model.status)],
+        joins=(User, Book), archive=archive,
+    )
+
+
+def _reservation_spec(model, archive=None):
+    return ExportSpec(
+        'reservations', model, model.reservation_date, model.status, ReservationStatus,
+        [('id', model.id), ('user_id', model.user_id), ('username', User.username),
+         ('book_id', model.book_id), ('title', Book.title), ('isbn', Book.isbn),
+         ('reservation_date', model.reservation_date), ('expiry_date', model.expiry_date),
+         ('status', model.status), ('queue_position', model.queue_position)],
+        joins=(User, Book), archive=archive,
+    )
+
+
+EXPORTS = {
+    'loans': _loan_spec(Loan, archive=_loan_spec(LoanArchive)),
+    'reservations': _reservation_spec(Reservation, archive=_reservation_spec(ReservationArchive)),
+    'users': ExportSpec(
+        'users', User, User.created_at, User.role, UserRole,
+        [('id', User.id), ('username', User.username), ('email', User.email),
+         ('role', User.role), ('created_at', User.created_at)],
+    ),
+}
+
+
+class ExportFilter:
+    """期間（startの日の0時からendの日の終わりまで）と状態による絞り込み"""
+    def __init__(self, start=None, end=None, status=None):
+        self.start = start
+        self.end = end
+        self.status = status
+
+    @classmethod
+    def parse(cls, spec, start=None, end=None, status=None):
+        """文字列の引数（YYYY-MM-DD、状態の値）から作成（不正な値はValueError）"""
+        def to_date(value, label):
+            if not value:
+                return None
+            try:
+                return date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f'{label}は YYYY-MM-DD の形式で指定してください。')
+        return cls(to_date(start, '開始日'), to_date(end, '終了日'),
+                   spec.parse_status(status) if status else None)
+
+    @property
+    def has_date_range(self):
+        return self.start is not None or self.end is not None
+
+    def conditions(self, spec):
+        conditions = []
+        if self.start:
+            conditions.append(spec.date_column >= datetime.combine(self.start, datetime.min.time()))
+        if self.end:
+            conditions.append(spec.date_column < datetime.combine(self.end + timedelta(days=1), datetime.min.time()))
+        if self.status:
+            conditions.append(spec.status_column == self.status)
+        return conditions
+
+
+def _format_value(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def iter_rows(spec, export_filter=None, chunk_size=None, bind=None):
+    """
+    条件に一致する行を (日付, id) 順（期間指定なしの場合は id 順）に1行ずつ返す
+    チャンクごとに接続を取り直すため、トランザクションはチャンクの処理時間しか続きません。
+    アーカイブのある対象は、各チャンクを現行とアーカイブのテーブルの UNION ALL の1文で読むため、
+    エクスポート中に行がアーカイブへ移動しても、同じ行を2回出力したり読み飛ばしたりしません
+    （1つの文は1つのスナップショットで読まれ、移動は同じトランザクションで INSERT と DELETE を行うため）。
+    """
+    specs = [spec] if spec.archive is None else [spec, spec.archive]
+    for row in _iter_keyed_rows(specs, export_filter, chunk_size, bind):
+        yield row
+
+
+def _chunk_query(spec, export_filter, use_date, last, limit):
+    """1つのテーブルの、位置lastより後の行をlimit件まで並び順に読むSELECT"""
+    id_column = spec.model.id
+    # 出力する列に、並び順の日付を追加（キーセットの位置に使う）
+    query = select(*[column.label(name) for name, column in spec.columns], spec.date_column.label('sort_date'))
+    query = query.select_from(spec.model)
+    for target in spec.joins:
+        query = query.join(target)
+    query = query.where(*export_filter.conditions(spec))
+    if last is not None:
+        last_date, last_id = last
+        if use_date:
+            query = query.where(or_(spec.date_column > last_date,
+                                    and_(spec.date_column == last_date, id_column > last_id)))
+        else:
+            query = query.where(id_column > last_id)
+    return query.order_by(*((spec.date_column, id_column) if use_date else (id_column,))).limit(limit)
+
+
+def _iter_keyed_rows(specs, export_filter=None, chunk_size=None, bind=None):
+    """同じ形の1つ以上のテーブル（現行とアーカイブ）の行を、並び順にチャンクごとに読んで出力する値を返す"""
+    bind = bind or engine
+    export_filter = export_filter or ExportFilter()
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    # 期間指定がある場合は (日付, id) のインデックスで範囲を読む
+    use_date = export_filter.has_date_range
+
+    last = None
+    while True:
+        # 各テーブルをそれぞれのインデックスで chunk_size 件まで読み、まとめて並べた先頭の chunk_size 件を使う
+        parts = [_chunk_query(spec, export_filter, use_date, last, chunk_size) for spec in specs]
+        if len(parts) == 1:
+            chunk = parts[0]
+        else:
+            merged = union_all(*[select(*part.subquery().c) for part in parts]).subquery()
+            chunk = select(*merged.c).order_by(
+                *((merged.c.sort_date, merged.c.id) if use_date else (merged.c.id,))
+            ).limit(chunk_size)
+        count = 0
+        with bind.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=EXPORT_FETCH_SIZE).execute(chunk)
+            for row in result:
+                count += 1
+                last = (row[-1], row[0])
+                yield [_format_value(value) for value in row[:-1]]
+        if count < chunk_size:
+            return
+
+
+def _write_csv(headers, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(headers)
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+
+def _write_json(headers, rows):
+    yield '['
+    separator = '\n'
+    for row in rows:
+        yield separator + json.dumps(dict(zip(headers, row)), ensure_ascii=False)
+        separator = ',\n'
+    yield '\n]\n'
+
+
+def _write_jsonl(headers, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(headers, row)), ensure_ascii=False) + '\n'
+
+
+WRITERS = {'csv': _write_csv, 'json': _write_json, 'jsonl': _write_jsonl}
+
+
+def generate_export(name, fmt='csv', export_filter=None, buffer_size=64 * 1024, bind=None):
+    """
+    エクスポートの内容を文字列の断片として順に返す（HTTPのチャンク転送・ファイル出力用）
+    小さな断片をbuffer_size程度にまとめてから返します。
+    """
+    spec = EXPORTS[name]
+    pieces = []
+    size = 0
+    for piece in WRITERS[fmt](spec.headers, iter_rows(spec, export_filter, bind=bind)):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= buffer_size:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+    if pieces:
+        yield ''.join(pieces)
+
+
+def export_filename(name, fmt, export_filter):
+    """ダウンロード時のファイル名（例: loans_20240101-20241231_returned.csv）"""
+    parts = [name]
+    if export_filter.has_date_range:
+        start, end = export_filter.start, export_filter.end
+        parts.append(f'{start:%Y%m%d}' if start else '')
+        parts[-1] += '-' + (f'{end:%Y%m%d}' if end else '')
+    if export_filter.status:
+        parts.append(export_filter.status.value)
+    return '_'.join(parts) + f'.{fmt}'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='貸出・予約・ユーザーをエクスポート')
+    parser.add_argument('kind', choices=sorted(EXPORTS))
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--start', help='開始日（YYYY-MM-DD）')
+    parser.add_argument('--end', help='終了日（YYYY-MM-DD、この日を含む）')
+    parser.add_argument('--status', help='状態（users の場合は役割）')
+    parser.add_argument('--output', '-o', help='出力先（省略時は標準出力）')
+    args = parser.parse_args(argv)
+
+    try:
+        export_filter = ExportFilter.parse(EXPORTS[args.kind], args.start, args.end, args.status)
+    except ValueError as e:
+        parser.error(str(e))
+
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for piece in generate_export(args.kind, args.format, export_filter):
+            out.write(piece)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
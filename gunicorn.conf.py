@@ -0,0 +1,90 @@
+"""
+gunicornの設定（本番用）
+
+使い方:
+  gunicorn -c gunicorn.conf.py app:app
+
+- ワーカー数はCPUコア数から決め（2 × コア数 + 1）、各ワーカーはスレッドで同時に処理します
+- preloadでアプリを親プロセスで1回だけ読み込み、ワーカーはforkで起動します
+  （接続プールはfork後に作り直し、定期ジョブも各ワーカーのfork後に開始）
+- DBのコネクションプールは、全ワーカーの合計が DB_MAX_CONNECTIONS を超えないように分けます
+- パスワードハッシュのプロセスプール（passwords.py）も、全ワーカーの合計がCPUコア数を超えないように分けます
+- 複数ワーカーでプロセス内のキャッシュ（CACHE_BACKEND=memory）を使う場合は起動時に警告し、
+  在庫状況のキャッシュを数秒に抑えます（cache.py。無効化が他のワーカーに届かないため）
+- 設定の再読み込み・ワーカーの入れ替え: kill -HUP <masterのPID>
+  （処理中のリクエストは graceful_timeout 秒まで待ってから古いワーカーを止めます）
+"""
+
+import multiprocessing
+import os
+
+
+def _env_int(name, default):
+    return int(os.getenv(name, default))
+
+
+bind = f"{os.getenv('FLASK_HOST', '0.0.0.0')}:{os.getenv('FLASK_PORT', '5001')}"
+worker_class = 'gthread'
+threads = _env_int('GUNICORN_THREADS', 4)
+workers = _env_int('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1)
+
+# MySQLの max_connections と、定期ジョブ・コマンド・管理作業用に残しておく接続数
+DB_MAX_CONNECTIONS = _env_int('DB_MAX_CONNECTIONS', 151)
+DB_RESERVED_CONNECTIONS = _env_int('DB_RESERVED_CONNECTIONS', 10)
+_available = max(1, DB_MAX_CONNECTIONS - DB_RESERVED_CONNECTIONS)
+# 各ワーカーがスレッド数分の接続を持てない場合は、ワーカー数を減らす
+if workers * threads > _available:
+    workers = max(1, _available // threads)
+# 1ワーカーあたりの接続数（スレッド数分を常駐させ、定期ジョブ・インポート用にスレッド数分までのオーバーフロー）
+connections_per_worker = max(1, _available // workers)
+_pool_size = min(threads, connections_per_worker)
+os.environ.setdefault('DB_POOL_PROFILE', 'web')
+os.environ.setdefault('DB_POOL_SIZE', str(_pool_size))
+os.environ.setdefault('DB_MAX_OVERFLOW', str(min(threads, connections_per_worker - _pool_size)))
+
+# パスワードハッシュのプロセス数（プールはワーカーごとに作成されるため、コア数をワーカー間で分ける）
+password_hash_workers = max(1, multiprocessing.cpu_count() // workers)
+os.environ.setdefault('PASSWORD_HASH_WORKERS', str(password_hash_workers))
+
+# キャッシュ（cache.py）が、無効化が他のワーカーに届くかどうかの判断に使う
+os.environ['GUNICORN_WORKERS'] = str(workers)
+
+preload_app = os.getenv('GUNICORN_PRELOAD', 'True').lower() == 'true'
+if preload_app:
+    os.environ['SCHEDULER_AFTER_FORK'] = 'true'
+
+# ロードバランサーのアイドルタイムアウトより長くする（例: 60秒のALBでは65）
+keepalive = _env_int('GUNICORN_KEEPALIVE', 5)
+timeout = _env_int('GUNICORN_TIMEOUT', 30)
+graceful_timeout = _env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+# メモリの増加に備えて一定数のリクエストごとにワーカーを入れ替える（同時に入れ替わらないよう揺らぎを加える）
+max_requests = _env_int('GUNICORN_MAX_REQUESTS', 2000)
+max_requests_jitter = _env_int('GUNICORN_MAX_REQUESTS_JITTER', 200)
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    server.log.info('ワーカー %d × スレッド %d、DB接続 %s + オーバーフロー %s / ワーカー（上限 %d）、'
+                    'パスワードハッシュ %s プロセス / ワーカー',
+                    workers, threads, os.environ['DB_POOL_SIZE'], os.environ['DB_MAX_OVERFLOW'],
+                    DB_MAX_CONNECTIONS, os.environ['PASSWORD_HASH_WORKERS'])
+    if workers > 1 and os.getenv('CACHE_BACKEND', 'memory') == 'memory':
+        server.log.warning('CACHE_BACKEND=memory はワーカーごとのキャッシュのため、他のワーカーでの変更の無効化が届きません'
+                           '（在庫状況は %s 秒、書籍詳細・一覧は有効期間まで古い値を表示します）。'
+                           '複数ワーカーでは CACHE_BACKEND=redis を設定してください。',
+                           os.getenv('CACHE_LOCAL_AVAILABILITY_TTL', '5'))
+
+
+def post_fork(server, worker):
+    # スレッドが動き出す前に、パスワードハッシュのプロセスをforkしておく（passwords.py）
+    from passwords import hasher
+    hasher.start()
+    if not preload_app:
+        return
+    from database import dispose_after_fork
+    from jobs import start_scheduler
+    dispose_after_fork()
+    start_scheduler(after_fork=True)
@@ -0,0 +1,128 @@
+"""
+人気書籍の順番待ち（ホールドキュー）
+書籍ごとのFIFOキューを、予約の queue_position と書籍の
+hold_queue_head（繰り上げ済みの位置）/ hold_queue_tail（最後に割り当てた位置）で表します。
+- 順番待ちへの追加: tailを原子的に+1して番号を割り当てる
+- 繰り上げ: (book_id, status, queue_position) のインデックスで先頭の1件を取得
+- 自分の順番: queue_position - hold_queue_head（書籍の主キー参照のみ）
+- 繰り上げた予約には在庫から1冊を確保し、新しい予約と取り合わないようにします。
+  繰り上げた予約がキャンセル・期限切れになった場合は、確保した1冊を次の順番待ちに回します（いなければ在庫に戻す）
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+from activity import adjust_user
+from inventory import put_back_copies, take_copy
+from models import Book, Reservation, ReservationStatus
+from stats import adjust
+
+# 繰り上げ後の予約の有効期限
+PROMOTED_RESERVATION_DAYS = 7
+
+
+def has_waiting_holds(book) -> bool:
+    """順番待ちの利用者がいるか"""
+    return book.hold_queue_head < book.hold_queue_tail
+
+
+def waiting_count(book) -> int:
+    """順番待ちの人数（キャンセル分を含む上限値）"""
+    return max(0, book.hold_queue_tail - book.hold_queue_head)
+
+
+def holds_copy(reservation) -> bool:
+    """順番待ちから繰り上げられ、1冊を確保している予約か（予約の行でも、status と queue_position を含む結果行でもよい）"""
+    return reservation.status == ReservationStatus.PENDING and reservation.queue_position is not None
+
+
+def enqueue_hold(db, user_id: int, book_id: int) -> Reservation:
+    """順番待ちに追加（コミットは呼び出し側で行う）"""
+    db.execute(
+        update(Book)
+        .where(Book.id == book_id)
+        .values(hold_queue_tail=Book.hold_queue_tail + 1, version=Book.version + 1),
+        execution_options={'synchronize_session': False},
+    )
+    # UPDATEで行ロックを取得済みのため、他のトランザクションと番号が重複しない
+    position = db.execute(select(Book.hold_queue_tail).where(Book.id == book_id)).scalar()
+    reservation = Reservation(
+        user_id=user_id,
+        book_id=book_id,
+        status=ReservationStatus.WAITING,
+        queue_position=position,
+    )
+    db.add(reservation)
+    return reservation
+
+
+def promote_next_hold(db, book_id: int):
+    """
+    順番待ちの先頭を通常の予約（PENDING）に繰り上げ、在庫から1冊を確保して予約IDを返す
+    返却処理などで在庫を戻した後に、同じトランザクションで呼び出します（コミットは呼び出し側）。
+    在庫がなければ繰り上げずにNoneを返します。
+    """
+    # 空振りした場合にキュー位置を揃えるため、先に末尾の位置を読んでおく
+    tail = db.execute(select(Book.hold_queue_tail).where(Book.id == book_id)).scalar()
+    row = db.execute(
+        select(Reservation.id, Reservation.user_id, Reservation.queue_position)
+        .where(Reservation.book_id == book_id, Reservation.status == ReservationStatus.WAITING)
+        .order_by(Reservation.queue_position)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).first()
+
+    if row is None:
+        # キャンセルで空になったキューの先頭位置を末尾に揃える
+        # （その間に順番待ちが追加されていればtailが変わっているので更新しない）
+        db.execute(
+            update(Book)
+            .where(Book.id == book_id, Book.hold_queue_tail == tail, Book.hold_queue_head < tail)
+            .values(hold_queue_head=tail, version=Book.version + 1),
+            execution_options={'synchronize_session': False},
+        )
+        return None
+
+    reservation_id, user_id, position = row
+    # 繰り上げた利用者の分を在庫から外す（貸出時は在庫を減らさない）
+    if not take_copy(db, book_id):
+        return None
+    db.execute(
+        update(Reservation)
+        .where(Reservation.id == reservation_id, Reservation.status == ReservationStatus.WAITING)
+        .values(status=ReservationStatus.PENDING,
+                reservation_date=datetime.utcnow(),
+                expiry_date=datetime.utcnow() + timedelta(days=PROMOTED_RESERVATION_DAYS)),
+        execution_options={'synchronize_session': False},
+    )
+    adjust(db, pending_reservations=1)
+    adjust_user(db, user_id, record_activity=False, waiting_reservations=-1, pending_reservations=1)
+    db.execute(
+        update(Book)
+        .where(Book.id == book_id, Book.hold_queue_head < position)
+        .values(hold_queue_head=position, version=Book.version + 1),
+        execution_options={'synchronize_session': False},
+    )
+    return reservation_id
+
+
+def promote_holds(db, book_id: int, count: int):
+    """在庫が増えた分だけ順番待ちを繰り上げる"""
+    promoted = []
+    for _ in range(max(0, count)):
+        reservation_id = promote_next_hold(db, book_id)
+        if reservation_id is None:
+            break
+        promoted.append(reservation_id)
+    return promoted
+
+
+def release_held_copies(db, counts):
+    """
+    繰り上げた予約のキャンセル・期限切れで、確保していた冊を次の順番待ちに回す（counts: 書籍ID -> 冊数）
+    順番待ちがいなければ在庫に戻します。
+    """
+    put_back_copies(db, counts)
+    for book_id, count in counts.items():
+        promote_holds(db, book_id, count)
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+書籍カタログの一括インポート
+CSV / JSONL / MARC（ISO 2709）のファイルを一定件数ずつ読み込み、ISBN（なければタイトルと著者）で重複をまとめて
+複数行の INSERT ... ON DUPLICATE KEY UPDATE で登録・更新します。
+- ファイル全体を読み込まないため、ファイルサイズに関係なくメモリ使用量は一定です
+- 各バッチと読み込み位置（import_jobs）を同じトランザクションでコミットするため、
+  途中で停止しても --resume で続きから再開できます
+- 既存の書籍（ISBNが一致するもの。ISBNがなければタイトルと著者が一致するもの）は書誌情報のみ更新し、
+  冊数は変更しません
+
+使い方:
+  python importer.py books.csv [--format csv|jsonl|marc] [--batch-size 1000] [--resume]
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+
+from sqlalchemy import bindparam, insert, select, tuple_, update
+
+from cache import invalidate_books
+from database import engine
+from jobs import LeaderLock
+from models import Book, ImportJob, ImportStatus, normalize_isbn
+from pagination import count_cache
+from stats import adjust
+from versions import touch
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+# 管理画面からアップロードしたファイルの保存先
+IMPORT_UPLOAD_DIR = os.getenv('IMPORT_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'library_imports'))
+# import_jobsに保存するエラーメッセージの上限
+MAX_ERRORS = 50
+
+FORMATS = ('csv', 'jsonl', 'marc')
+EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.mrc': 'marc', '.marc': 'marc'}
+
+# CSVの見出し（日本語の見出しにも対応）
+FIELD_ALIASES = {
+    'title': 'title', 'タイトル': 'title', '書名': 'title',
+    'author': 'author', '著者': 'author',
+    'isbn': 'isbn',
+    'publisher': 'publisher', '出版社': 'publisher',
+    'publication_date': 'publication_date', '出版日': 'publication_date',
+    'total_copies': 'total_copies', 'copies': 'total_copies', '冊数': 'total_copies', '総冊数': 'total_copies',
+}
+
+MAX_LENGTHS = {'title': 200, 'author': 100, 'publisher': 100}
+
+
+class RowError(ValueError):
+    """取り込めない行（件数とメッセージを記録して読み飛ばす）"""
+
+
+# ==================== 検証・正規化 ====================
+
+def is_valid_isbn(isbn: str) -> bool:
+    """正規化済みのISBN-10/ISBN-13のチェックディジットを検証"""
+    if re.fullmatch(r'[0-9]{9}[0-9X]', isbn):
+        total = sum((10 - i) * (10 if c == 'X' else int(c)) for i, c in enumerate(isbn))
+        return total % 11 == 0
+    if re.fullmatch(r'97[89][0-9]{10}', isbn):
+        total = sum((3 if i % 2 else 1) * int(c) for i, c in enumerate(isbn))
+        return total % 10 == 0
+    return False
+
+
+def parse_date(value):
+    """YYYY-MM-DD / YYYY/MM/DD / 年のみ（1月1日とみなす）を日付に変換"""
+    if value is None or isinstance(value, date):
+        return value
+    value = str(value).strip()
+    try:
+        return date.fromisoformat(value.replace('/', '-'))
+    except ValueError:
+        pass
+    year = re.search(r'\d{4}', value)
+    return date(int(year.group()), 1, 1) if year else None
+
+
+def clean_record(raw: dict) -> dict:
+    """読み込んだ1件を検証し、booksテーブルの値に変換"""
+    record = {}
+    for key, value in raw.items():
+        field = FIELD_ALIASES.get(str(key).strip().lower())
+        if field and value not in (None, ''):
+            record[field] = value.strip() if isinstance(value, str) else value
+
+    if not record.get('title') or not record.get('author'):
+        raise RowError('タイトルと著者は必須です')
+    for field, max_length in MAX_LENGTHS.items():
+        if record.get(field) and len(record[field]) > max_length:
+            raise RowError(f'{field} が長すぎます（{max_length}文字まで）')
+
+    isbn = None
+    if record.get('isbn'):
+        isbn = normalize_isbn(str(record['isbn']))
+        if not is_valid_isbn(isbn):
+            raise RowError(f'ISBNが正しくありません: {record["isbn"]}')
+
+    try:
+        copies = int(record.get('total_copies', 1))
+    except (TypeError, ValueError):
+        raise RowError(f'冊数が正しくありません: {record.get("total_copies")}')
+    if copies < 1:
+        raise RowError('冊数は1以上にしてください')
+
+    return {
+        'title': record['title'],
+        'author': record['author'],
+        'isbn': isbn,
+        'publisher': record.get('publisher'),
+        'publication_date': parse_date(record.get('publication_date')),
+        'total_copies': copies,
+    }
+
+
+# ==================== 読み込み ====================
+# 各readerはバイナリモードのファイルと開始位置を受け取り、(レコード, 次のレコードの位置) を返す
+
+def _read_csv_record(f):
+    """引用符内の改行を含む1レコード分の行を読む"""
+    chunks = []
+    while True:
+        line = f.readline()
+        if not line:
+            break
+        chunks.append(line)
+        # 引用符の数が偶数になればレコードの終わり
+        if b''.join(chunks).count(b'"') % 2 == 0:
+            break
+    return b''.join(chunks).decode('utf-8-sig')
+
+
+def read_csv(f, start=0):
+    header = next(csv.reader([_read_csv_record(f)]), None)
+    if not header:
+        return
+    if start > f.tell():
+        f.seek(start)
+    while True:
+        text = _read_csv_record(f)
+        if not text:
+            return
+        position = f.tell()
+        values = next(csv.reader([text]), None)
+        if values:
+            yield dict(zip(header, values)), position
+
+
+def read_jsonl(f, start=0):
+    f.seek(start)
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        position = f.tell()
+        if line.strip():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield RowError(f'JSONとして読み込めません: {e}'), position
+                continue
+            yield record if isinstance(record, dict) else RowError('オブジェクトではありません'), position
+
+
+MARC_RECORD_END = b'\x1d'
+MARC_FIELD_END = b'\x1e'
+MARC_SUBFIELD = b'\x1f'
+
+
+def parse_marc(record: bytes) -> dict:
+    """MARC21（ISO 2709）の1レコードから書誌情報を取り出す"""
+    base = int(record[12:17])
+    directory = record[24:base - 1]
+    fields = {}
+    for i in range(0, len(directory) - 11, 12):
+        tag = directory[i:i + 3].decode('ascii', 'replace')
+        length = int(directory[i + 3:i + 7])
+        start = int(directory[i + 7:i + 12])
+        data = record[base + start:base + start + length].rstrip(MARC_FIELD_END)
+        subfields = {}
+        for part in data.split(MARC_SUBFIELD)[1:]:
+            if part:
+                subfields.setdefault(chr(part[0]), part[1:].decode('utf-8', 'replace').strip())
+        fields.setdefault(tag, subfields)
+
+    def first(*candidates):
+        for tag, code in candidates:
+            value = fields.get(tag, {}).get(code)
+            if value:
+                return value
+        return None
+
+    isbn = first(('020', 'a'))
+    return {
+        'isbn': isbn.split()[0] if isbn else None,
+        'title': (first(('245', 'a')) or '').rstrip(' /:;,.') or None,
+        'author': (first(('100', 'a'), ('110', 'a'), ('700', 'a')) or '').rstrip(' ,.') or None,
+        'publisher': (first(('264', 'b'), ('260', 'b')) or '').rstrip(' ,:;') or None,
+        'publication_date': first(('264', 'c'), ('260', 'c')),
+    }
+
+
+def read_marc(f, start=0):
+    f.seek(start)
+    while True:
+        leader = f.read(5)
+        if len(leader) < 5:
+            return
+        try:
+            length = int(leader)
+        except ValueError:
+            # レコード長が読めない場合は次のレコード終端まで読み飛ばす
+            while (byte := f.read(1)) and byte != MARC_RECORD_END:
+                pass
+            yield RowError('MARCレコードの長さが読み取れません'), f.tell()
+            continue
+        record = leader + f.read(length - 5)
+        position = f.tell()
+        try:
+            yield parse_marc(record), position
+        except (ValueError, IndexError) as e:
+            yield RowError(f'MARCレコードを解析できません: {e}'), position
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl, 'marc': read_marc}
+
+
+def detect_format(path: str) -> str:
+    """拡張子からファイル形式を判定"""
+    fmt = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        raise ValueError(f'ファイル形式を判定できません: {path}（--format で指定してください）')
+    return fmt
+
+
+# ==================== 登録 ====================
+
+def record_key(row):
+    """同じ書籍とみなすキー（ISBN。ISBNがなければタイトルと著者）"""
+    return row['isbn'] or ('title', row['title'], row['author'])
+
+
+def upsert_books(conn, rows):
+    """
+    1バッチ分の書籍をまとめて登録し、ISBNが一致する書籍は書誌情報を更新
+    ISBNのない書籍はタイトルと著者が一致するISBNのない書籍を更新するため、同じファイルを再度取り込んでも重複しません。
+    (追加件数, 更新件数, 更新した書籍ID) を返します。
+    """
+    with_isbn = [row for row in rows if row['isbn']]
+    without_isbn = [row for row in rows if not row['isbn']]
+    isbns = [row['isbn'] for row in with_isbn]
+    existing = dict(conn.execute(select(Book.isbn, Book.id).where(Book.isbn.in_(isbns))).all()) if isbns else {}
+
+    now = datetime.utcnow()
+    values = [{**row, 'available_copies': row['total_copies'], 'hold_queue_head': 0,
+               'hold_queue_tail': 0, 'created_at': now} for row in rows]
+    if with_isbn:
+        # executemanyで実行する（文のコンパイルはキャッシュされ、PyMySQLが複数行のINSERTにまとめて送信する）
+        if conn.dialect.name == 'mysql':
+            from sqlalchemy.dialects.mysql import insert as upsert
+            stmt = upsert(Book)
+            stmt = stmt.on_duplicate_key_update(title=stmt.inserted.title, author=stmt.inserted.author,
+                                                publisher=stmt.inserted.publisher,
+                                                publication_date=stmt.inserted.publication_date,
+                                                version=Book.version + 1)
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+            stmt = upsert(Book)
+            stmt = stmt.on_conflict_do_update(index_elements=['isbn'], set_={
+                'title': stmt.excluded.title, 'author': stmt.excluded.author,
+                'publisher': stmt.excluded.publisher, 'publication_date': stmt.excluded.publication_date,
+                'version': Book.version + 1,
+            })
+        conn.execute(stmt, [value for value in values if value['isbn']])
+    updated_ids = list(existing.values())
+    if without_isbn:
+        updated_ids += _upsert_by_title(conn, [value for value in values if not value['isbn']])
+    return len(rows) - len(updated_ids), len(updated_ids), updated_ids
+
+
+def _upsert_by_title(conn, values):
+    """ISBNのない書籍を、タイトルと著者が一致するISBNのない書籍（idx_books_title_author）があれば更新し、なければ追加"""
+    keys = {(value['title'], value['author']) for value in values}
+    existing = {}
+    for book_id, title, author in conn.execute(
+        select(Book.id, Book.title, Book.author)
+        .where(Book.isbn.is_(None), tuple_(Book.title, Book.author).in_(list(keys)))
+        .order_by(Book.id)
+    ):
+        existing.setdefault((title, author), book_id)
+
+    # 冊数・在庫は変更せず、書誌情報だけを更新する
+    matched = [{'b_id': existing[(value['title'], value['author'])], 'b_publisher': value['publisher'],
+                'b_publication_date': value['publication_date']}
+               for value in values if (value['title'], value['author']) in existing]
+    if matched:
+        conn.execute(
+            update(Book)
+            .where(Book.id == bindparam('b_id'))
+            .values(publisher=bindparam('b_publisher'), publication_date=bindparam('b_publication_date'),
+                    version=Book.version + 1),
+            matched,
+        )
+    new = [value for value in values if (value['title'], value['author']) not in existing]
+    if new:
+        conn.execute(insert(Book), new)
+    return [value['b_id'] for value in matched]
+
+
+class ImportReport:
+    """インポートの結果"""
+    def __init__(self, job_id, rows, inserted, updated, rejected, seconds):
+        self.job_id = job_id
+        self.rows = rows
+        self.inserted = inserted
+        self.updated = updated
+        self.rejected = rejected
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return (f'{self.rows} 件（追加 {self.inserted} / 更新 {self.updated} / エラー {self.rejected}）'
+                f' {self.seconds:.2f}秒 ({self.rows_per_second:,.0f} rows/s)')
+
+
+def create_job(source, fmt=None, bind=None) -> int:
+    """インポートジョブを登録してIDを返す"""
+    fmt = fmt or detect_format(source)
+    if fmt not in FORMATS:
+        raise ValueError(f'対応していない形式です: {fmt}')
+    with (bind or engine).begin() as conn:
+        result = conn.execute(insert(ImportJob).values(
+            source=source, format=fmt, status=ImportStatus.RUNNING, position=0,
+            file_size=os.path.getsize(source), rows_read=0, inserted=0, updated=0, rejected=0,
+            started_at=datetime.utcnow(), updated_at=datetime.utcnow(),
+        ))
+        return result.inserted_primary_key[0]
+
+
+def find_resumable_job(source, bind=None):
+    """同じファイルの完了していないジョブのIDを返す（なければNone）"""
+    with (bind or engine).connect() as conn:
+        return conn.execute(
+            select(ImportJob.id)
+            .where(ImportJob.source == source, ImportJob.status != ImportStatus.COMPLETED)
+            .order_by(ImportJob.id.desc())
+            .limit(1)
+        ).scalar()
+
+
+def run_import(job_id, batch_size=None, progress=None, bind=None) -> ImportReport:
+    """
+    ジョブの続きの位置からファイルを読み込んで登録
+    progressには各バッチのコミット後に (ImportReport, 進捗率%) が渡されます。
+    """
+    bind = bind or engine
+    batch_size = batch_size or IMPORT_BATCH_SIZE
+    lock = LeaderLock(f'import_{job_id}', bind=bind)
+    if not lock.acquire():
+        raise RuntimeError(f'インポートジョブ {job_id} は他のプロセスで実行中です。')
+    try:
+        with bind.connect() as conn:
+            job = conn.execute(select(ImportJob).where(ImportJob.id == job_id)).mappings().first()
+        if job is None:
+            raise ValueError(f'インポートジョブ {job_id} が見つかりません。')
+        if job['status'] == ImportStatus.COMPLETED:
+            return ImportReport(job_id, job['rows_read'], job['inserted'], job['updated'], job['rejected'], 0.0)
+        if os.path.getsize(job['source']) != job['file_size']:
+            raise ValueError('前回のインポート以降にファイルが変更されています。新しいジョブとして実行してください。')
+        return _run(job, batch_size, progress, bind)
+    finally:
+        lock.release()
+
+
+def _run(job, batch_size, progress, bind):
+    job_id = job['id']
+    counts = {name: job[name] for name in ('rows_read', 'inserted', 'updated', 'rejected')}
+    errors = job['errors'].splitlines() if job['errors'] else []
+    report = ImportReport(job_id, 0, 0, 0, 0, 0.0)
+    start = time.perf_counter()
+
+    def flush(batch, position, status=ImportStatus.RUNNING):
+        """1バッチを登録し、読み込み位置と件数を同じトランザクションで保存"""
+        with bind.begin() as conn:
+            inserted = updated = 0
+            updated_ids = []
+            if batch:
+                inserted, updated, updated_ids = upsert_books(conn, list(batch.values()))
+                adjust(conn, total_books=inserted)
+                touch(conn, 'books', 'catalog')
+            counts['inserted'] += inserted
+            counts['updated'] += updated
+            conn.execute(update(ImportJob).where(ImportJob.id == job_id).values(
+                position=position, status=status, errors='\n'.join(errors[-MAX_ERRORS:]) or None,
+                updated_at=datetime.utcnow(),
+                finished_at=datetime.utcnow() if status == ImportStatus.COMPLETED else None,
+                **counts,
+            ))
+        if batch:
+            invalidate_books(updated_ids)
+            count_cache.invalidate('books')
+        report.rows += len(batch)
+        report.inserted += inserted
+        report.updated += updated
+        report.seconds = time.perf_counter() - start
+        if progress:
+            progress(report, position * 100.0 / job['file_size'] if job['file_size'] else 100.0)
+
+    try:
+        with open(job['source'], 'rb') as f:
+            # ISBN（なければタイトルと著者）ごとにまとめる（同じバッチ内の重複は後の行を優先）
+            batch = {}
+            position = job['position']
+            for record, position in READERS[job['format']](f, job['position']):
+                counts['rows_read'] += 1
+                try:
+                    if isinstance(record, RowError):
+                        raise record
+                    row = clean_record(record)
+                except RowError as e:
+                    counts['rejected'] += 1
+                    report.rejected += 1
+                    errors.append(f'{counts["rows_read"]}件目: {e}')
+                    del errors[:-MAX_ERRORS]
+                    continue
+                batch[record_key(row)] = row
+                if len(batch) >= batch_size:
+                    flush(batch, position)
+                    batch = {}
+            flush(batch, position, status=ImportStatus.COMPLETED)
+    except Exception as e:
+        errors.append(f'中断しました: {e}')
+        with bind.begin() as conn:
+            conn.execute(update(ImportJob).where(ImportJob.id == job_id).values(
+                status=ImportStatus.FAILED, errors='\n'.join(errors[-MAX_ERRORS:]),
+                updated_at=datetime.utcnow(),
+            ))
+        raise
+    return report
+
+
+def save_upload(file_storage) -> str:
+    """アップロードされたファイルを保存してパスを返す（メモリに読み込まずに書き出す）"""
+    os.makedirs(IMPORT_UPLOAD_DIR, exist_ok=True)
+    extension = os.path.splitext(file_storage.filename or '')[1].lower()
+    path = os.path.join(IMPORT_UPLOAD_DIR, f'{datetime.utcnow():%Y%m%d%H%M%S%f}{extension}')
+    file_storage.save(path)
+    return path
+
+
+def start_background_import(job_id, batch_size=None):
+    """管理画面からのインポートをバックグラウンドスレッドで実行"""
+    def worker():
+        try:
+            run_import(job_id, batch_size=batch_size)
+        except Exception as e:
+            print(f'インポートジョブ {job_id} でエラーが発生しました: {e}')
+
+    thread = threading.Thread(target=worker, name=f'import-{job_id}', daemon=True)
+    thread.start()
+    return thread
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='書籍カタログを一括インポート')
+    parser.add_argument('path', help='CSV / JSONL / MARC ファイル')
+    parser.add_argument('--format', choices=FORMATS, default=None, help='省略時は拡張子から判定')
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--resume', action='store_true', help='同じファイルの中断したインポートを続きから再開')
+    args = parser.parse_args(argv)
+
+    source = os.path.abspath(args.path)
+    job_id = find_resumable_job(source) if args.resume else None
+    if job_id is None:
+        job_id = create_job(source, args.format)
+        print(f'インポートジョブ {job_id} を開始します: {source}')
+    else:
+        print(f'インポートジョブ {job_id} を再開します: {source}')
+
+    def progress(report, percent):
+        print(f'\r{percent:5.1f}%  {report.rows:,} 件  {report.rows_per_second:,.0f} rows/s', end='', file=sys.stderr)
+
+    report = run_import(job_id, batch_size=args.batch_size, progress=progress)
+    print(file=sys.stderr)
+    print(f'import {job_id}: {report}')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,9 +7,9 @@
 import os
 import sys
 from sqlalchemy import create_engine, text
-from database import DATABASE_URL, Base, engine, SessionLocal
-from models import User, Book, Reservation, Loan, UserRole
-from werkzeug.security import generate_password_hash
+from database import DATABASE_URL, SessionLocal
+from models import Book
+import migrations
 
 def create_database():
     """データベースが存在しない場合は作成"""
@@ -34,38 +34,23 @@ def create_database():
         sys.exit(1)
 
 def init_tables():
-    """テーブルを作成"""
+    """マイグレーションを適用（テーブルと初期管理者ユーザーを作成）"""
     try:
-        Base.metadata.create_all(bind=engine)
-        print("テーブルの作成を完了しました。")
+        applied = migrations.upgrade()
+        print(f"{applied} 件のマイグレーションを適用しました。")
     except Exception as e:
-        print(f"テーブル作成エラー: {e}")
+        print(f"マイグレーションのエラー: {e}")
         sys.exit(1)
 
-def create_admin_user():
-    """初期管理者ユーザーを作成"""
-    db = SessionLocal()
-    try:
-        admin = db.query(User).filter_by(username='admin').first()
-        if not admin:
-            admin = User(
-                username='admin',
-                email='admin@library.com',
-                password_hash=generate_password_hash('admin123', method='pbkdf2:sha256'),
-                role=UserRole.ADMIN
-            )
-            db.add(admin)
-            db.commit()
-            print("初期管理者ユーザーを作成しました:")
-            print("  ユーザー名: admin")
-            print("  パスワード: admin123")
-        else:
-            print("管理者ユーザーは既に存在します。")
-    except Exception as e:
-        print(f"管理者ユーザー作成エラー: {e}")
-        db.rollback()
-    finally:
-        db.close()
+# サンプル書籍（ベンチマーク用のデータ生成 benchmarks/datagen.py でもひな形として使う）
+SAMPLE_BOOKS = [
+    {'title': 'Python入門', 'author': '山田太郎', 'isbn': '9784123456784',
+     'publisher': '技術出版社', 'total_copies': 5},
+    {'title': 'Flask Web開発', 'author': '佐藤花子', 'isbn': '9784123456791',
+     'publisher': 'プログラミング社', 'total_copies': 3},
+    {'title': 'データベース設計', 'author': '鈴木一郎', 'isbn': '9784123456807',
+     'publisher': 'IT出版', 'total_copies': 2},
+]
 
 def create_sample_books():
     """サンプル書籍を作成（オプション）"""
@@ -73,32 +58,7 @@ def create_sample_books():
     try:
         count = db.query(Book).count()
         if count == 0:
-            sample_books = [
-                Book(
-                    title='Python入門',
-                    author='山田太郎',
-                    isbn='978-4-1234-5678-9',
-                    publisher='技術出版社',
-                    total_copies=5,
-                    available_copies=5
-                ),
-                Book(
-                    title='Flask Web開発',
-                    author='佐藤花子',
-                    isbn='978-4-1234-5679-0',
-                    publisher='プログラミング社',
-                    total_copies=3,
-                    available_copies=3
-                ),
-                Book(
-                    title='データベース設計',
-                    author='鈴木一郎',
-                    isbn='978-4-1234-5680-1',
-                    publisher='IT出版',
-                    total_copies=2,
-                    available_copies=2
-                ),
-            ]
+            sample_books = [Book(available_copies=values['total_copies'], **values) for values in SAMPLE_BOOKS]
             for book in sample_books:
                 db.add(book)
             db.commit()
@@ -122,22 +82,17 @@ if __name__ == '__main__':
     create_database()
     print()
     
-    # テーブル作成
-    print("2. テーブルの作成...")
+    # テーブルと管理者ユーザーの作成
+    print("2. マイグレーションの適用（テーブル・初期管理者ユーザーの作成）...")
     init_tables()
     print()
     
-    # 管理者ユーザー作成
-    print("3. 初期管理者ユーザーの作成...")
-    create_admin_user()
-    print()
-    
     # サンプル書籍作成（オプション）
     # 環境変数で制御可能（Docker環境など）
     create_samples = os.getenv('CREATE_SAMPLE_BOOKS', '').lower() == 'true'
     if not create_samples:
         try:
-            response = input("4. サンプル書籍を作成しますか？ (y/n): ")
+            response = input("3. サンプル書籍を作成しますか？ (y/n): ")
             create_samples = response.lower() == 'y'
         except EOFError:
             # 非対話的環境（Dockerなど）ではスキップ
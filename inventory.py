@@ -0,0 +1,119 @@
+"""
+在庫（利用可能冊数）の更新
+読み取ってからPythonで増減する代わりに、条件付きのUPDATE文で原子的に更新し、
+更新件数で成否を判定します。デッドロック時はトランザクションをやり直します。
+"""
+
+import random
+import time
+
+from sqlalchemy import case, select, update
+from sqlalchemy.exc import OperationalError
+
+from models import Book
+
+# デッドロック・ロック待ちタイムアウトのエラーコード（MySQL）
+DEADLOCK_ERROR_CODES = {1213, 1205}
+DEFAULT_RETRY_ATTEMPTS = 3
+
+
+def take_copy(db, book_id: int) -> bool:
+    """在庫を1冊減らす（在庫がなければFalse）"""
+    result = db.execute(
+        update(Book)
+        .where(Book.id == book_id, Book.available_copies > 0)
+        .values(available_copies=Book.available_copies - 1, version=Book.version + 1),
+        execution_options={'synchronize_session': False},
+    )
+    return result.rowcount == 1
+
+
+def put_back_copy(db, book_id: int) -> bool:
+    """在庫を1冊戻す（総冊数を超える場合はFalse）"""
+    result = db.execute(
+        update(Book)
+        .where(Book.id == book_id, Book.available_copies < Book.total_copies)
+        .values(available_copies=Book.available_copies + 1, version=Book.version + 1),
+        execution_options={'synchronize_session': False},
+    )
+    return result.rowcount == 1
+
+
+def take_copies(db, counts) -> bool:
+    """
+    複数の書籍の在庫をまとめて減らす（counts: 書籍ID -> 冊数）
+    1回のUPDATEで更新し、在庫が足りない書籍が1冊でもあればFalse（その場合は呼び出し側でロールバックする）。
+    """
+    if not counts:
+        return True
+    needed = case(counts, value=Book.id, else_=0)
+    result = db.execute(
+        update(Book)
+        .where(Book.id.in_(counts), Book.available_copies >= needed)
+        .values(available_copies=Book.available_copies - needed, version=Book.version + 1),
+        execution_options={'synchronize_session': False},
+    )
+    return result.rowcount == len(counts)
+
+
+def put_back_copies(db, counts):
+    """複数の書籍の在庫をまとめて戻す（counts: 書籍ID -> 冊数。総冊数は超えない）"""
+    if not counts:
+        return
+    restored = Book.available_copies + case(counts, value=Book.id, else_=0)
+    db.execute(
+        update(Book)
+        .where(Book.id.in_(counts))
+        .values(available_copies=case((restored > Book.total_copies, Book.total_copies), else_=restored),
+                version=Book.version + 1),
+        execution_options={'synchronize_session': False},
+    )
+
+
+def change_total_copies(db, book_id: int, new_total: int) -> bool:
+    """総冊数を変更し、差分だけ利用可能冊数も増減（0未満にはしない）"""
+    adjusted = Book.available_copies + (new_total - Book.total_copies)
+    result = db.execute(
+        update(Book)
+        .where(Book.id == book_id)
+        .values(total_copies=new_total, available_copies=case((adjusted < 0, 0), else_=adjusted),
+                version=Book.version + 1),
+        execution_options={'synchronize_session': False},
+    )
+    return result.rowcount == 1
+
+
+def lock_book(db, book_id: int):
+    """
+    書籍の行を排他ロックして最新の値で取得（なければNone。ロックはトランザクション終了まで保持）
+    予約の判定では、在庫を読んだ後に同じ行（順番待ちの末尾）を更新するため、最初から排他ロックを取ります。
+    共有ロックで読んでから更新すると、同じ書籍を同時に予約した処理同士が排他ロックへの格上げで
+    互いを待ち、デッドロックになります。
+    """
+    return db.query(Book).filter(Book.id == book_id).with_for_update().populate_existing().first()
+
+
+def is_deadlock(error: OperationalError) -> bool:
+    """やり直すべきロック競合エラーかどうか"""
+    orig = getattr(error, 'orig', None)
+    args = getattr(orig, 'args', ())
+    if args and args[0] in DEADLOCK_ERROR_CODES:
+        return True
+    # SQLiteの書き込みロック競合
+    return 'database is locked' in str(orig)
+
+
+def run_with_retry(db, func, attempts=DEFAULT_RETRY_ATTEMPTS):
+    """
+    トランザクション処理funcを実行し、デッドロック時はロールバックしてやり直す
+    funcは毎回最初から処理をやり直せるように書く必要があります。
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except OperationalError as e:
+            db.rollback()
+            if attempt == attempts or not is_deadlock(e):
+                raise
+            # 競合しているトランザクション同士が再度ぶつからないようにずらす
+            time.sleep(random.uniform(0, 0.05 * attempt))
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+バックグラウンドジョブ
+一定間隔で実行する定期ジョブと、複数のWebワーカーで同時に実行しないための
+リーダーロックを提供します。
+
+CLIから1回だけ実行することもできます:
+  python jobs.py sweep-overdue
+  python jobs.py expire-reservations [--batch-size 1000] [--workers 4]
+  python jobs.py reconcile-stats [--days 30]
+  python jobs.py reconcile-user-activity [--batch-size 1000]
+  python jobs.py archive [--older-than-days 365] [--batch-size 1000] [--pause 0.1] [--max-batches 0]
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import insert, select, text, update
+
+from activity import adjust_users, reconcile_user_activity
+from archive import archive_history
+from cache import invalidate_availability
+from database import engine
+from holds import holds_copy, release_held_copies
+from models import JobRun, Loan, LoanStatus, Reservation, ReservationStatus
+from stats import adjust, reconcile_stats
+from versions import touch
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    """
+    ジョブごとの排他ロック
+    MySQLでは GET_LOCK() を使い、複数ホストのワーカー間でも1つだけが実行します。
+    それ以外（SQLite）では同一ホスト内のファイルロックで代用します。
+    """
+    def __init__(self, name, bind=None):
+        self.name = f'library_job_{name}'
+        self.bind = bind or engine
+        self._conn = None
+        self._file = None
+
+    def acquire(self) -> bool:
+        if self.bind.dialect.name == 'mysql':
+            conn = self.bind.connect()
+            acquired = conn.execute(text('SELECT GET_LOCK(:name, 0)'), {'name': self.name}).scalar()
+            if acquired == 1:
+                self._conn = conn
+                return True
+            conn.close()
+            return False
+        if fcntl is None:
+            return True
+        lock_file = open(os.path.join(tempfile.gettempdir(), f'{self.name}.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        return True
+
+    def release(self):
+        if self._conn is not None:
+            try:
+                self._conn.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': self.name})
+            finally:
+                self._conn.close()
+                self._conn = None
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class PeriodicJob:
+    """一定間隔で実行するジョブ（実行結果を保持）"""
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.last_run_at = None
+        self.last_rows = None
+        self.last_duration = None
+        self.last_error = None
+        self.runs = 0
+        self.skipped = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self):
+        """リーダーロックを取得できた場合のみ実行し、処理件数を返す"""
+        lock = LeaderLock(self.name)
+        if not lock.acquire():
+            self.skipped += 1
+            return None
+        try:
+            start = time.perf_counter()
+            rows = self.func()
+            self.last_duration = time.perf_counter() - start
+            self.last_rows = rows
+            self.last_error = None
+            self.runs += 1
+            return rows
+        except Exception as e:
+            self.last_error = str(e)
+            raise
+        finally:
+            self.last_run_at = datetime.utcnow()
+            try:
+                self._record()
+            finally:
+                lock.release()
+
+    def _record(self):
+        """実行結果をjob_runsテーブルに保存（他のワーカーからも参照できるように）"""
+        values = {
+            'last_run_at': self.last_run_at,
+            'last_rows': self.last_rows,
+            'last_duration': self.last_duration,
+            'last_error': self.last_error,
+        }
+        with engine.begin() as conn:
+            result = conn.execute(
+                update(JobRun).where(JobRun.name == self.name).values(runs=JobRun.runs + 1, **values)
+            )
+            if result.rowcount == 0:
+                conn.execute(insert(JobRun).values(name=self.name, runs=1, **values))
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                # 次の間隔でも実行を続ける（スタックトレースはログに残す）
+                logger.exception('ジョブ %s の実行中にエラーが発生しました', self.name)
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name=f'job-{self.name}', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self, record=None):
+        """ジョブの状態（recordがあればDBに保存された最新の結果を優先）"""
+        source = record or self
+        return {
+            'name': self.name,
+            'interval': self.interval,
+            'last_run_at': source.last_run_at,
+            'last_rows': source.last_rows,
+            'last_duration': source.last_duration,
+            'last_error': source.last_error,
+            'runs': source.runs,
+            'skipped': self.skipped,
+        }
+
+
+class Scheduler:
+    """定期ジョブの登録と起動"""
+    def __init__(self):
+        self.jobs = {}
+        self.started = False
+
+    def register(self, name, func, interval):
+        self.jobs[name] = PeriodicJob(name, func, interval)
+        return self.jobs[name]
+
+    def start(self):
+        for job in self.jobs.values():
+            job.start()
+        self.started = True
+
+    def stop(self):
+        for job in self.jobs.values():
+            job.stop()
+        self.started = False
+
+    def status(self, db=None):
+        """全ジョブの状態（dbを渡すと全ワーカー共通の実行結果を参照）"""
+        records = {}
+        if db is not None:
+            records = {run.name: run for run in db.execute(select(JobRun)).scalars()}
+        return [job.status(records.get(name)) for name, job in self.jobs.items()]
+
+
+# ==================== ジョブ ====================
+
+def sweep_overdue_loans(batch_size=None, max_batches=None, bind=None) -> int:
+    """
+    返却期限を過ぎた貸出を、ID順に一定件数ずつ延滞に変更
+    利用者ごとの件数を増減するため、各バッチの行はロックして利用者IDと一緒に先に読みます。
+    バッチごとに短いトランザクションで処理し、ロックする行数とUPDATEのIN句の長さを batch_size 件に抑えます。
+    FOR UPDATE SKIP LOCKED により、貸出・返却の処理中の行は待たずに次回の実行に回します。
+    """
+    bind = bind or engine
+    batch_size = batch_size or int(os.getenv('OVERDUE_SWEEP_BATCH_SIZE', 1000))
+    now = datetime.utcnow()
+    rows = batches = last_id = 0
+    while max_batches is None or batches < max_batches:
+        with bind.begin() as conn:
+            locked = conn.execute(
+                select(Loan.id, Loan.user_id)
+                .where(Loan.status == LoanStatus.ACTIVE, Loan.due_date < now, Loan.id > last_id)
+                .order_by(Loan.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not locked:
+                break
+            result = conn.execute(
+                update(Loan)
+                .where(Loan.id.in_([row.id for row in locked]), Loan.status == LoanStatus.ACTIVE)
+                .values(status=LoanStatus.OVERDUE)
+            )
+            adjust(conn, active_loans=-result.rowcount, overdue_loans=result.rowcount)
+            adjust_users(conn, Counter(row.user_id for row in locked), False, active_loans=-1, overdue_loans=1)
+            touch(conn, 'loans')
+        last_id = locked[-1].id
+        rows += result.rowcount
+        batches += 1
+    return rows
+
+
+class ExpiryReport:
+    """予約期限切れ処理の結果"""
+    def __init__(self, rows, batches, seconds):
+        self.rows = rows
+        self.batches = batches
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        return (f'{self.rows} 件 / {self.batches} バッチ / {self.seconds:.3f}秒 '
+                f'({self.rows_per_second:,.0f} rows/s)')
+
+
+def expire_reservations(batch_size=None, max_batches=None, bind=None) -> ExpiryReport:
+    """
+    有効期限を過ぎた待機中の予約を、一定件数ずつEXPIREDに変更
+    各バッチは短いトランザクションで処理し、FOR UPDATE SKIP LOCKED により
+    複数ワーカーが同時に実行しても同じ行を奪い合いません。
+    UPDATEにもstatus条件を付けているため、何度実行しても結果は同じです。
+    順番待ちから繰り上げた予約が期限切れになった場合は、確保していた冊を次の順番待ちに繰り上げます。
+    """
+    bind = bind or engine
+    batch_size = batch_size or int(os.getenv('RESERVATION_EXPIRY_BATCH_SIZE', 1000))
+    now = datetime.utcnow()
+    rows = batches = 0
+    start = time.perf_counter()
+    while max_batches is None or batches < max_batches:
+        with bind.begin() as conn:
+            locked = conn.execute(
+                select(Reservation.id, Reservation.user_id, Reservation.book_id, Reservation.status,
+                       Reservation.queue_position)
+                .where(Reservation.status == ReservationStatus.PENDING, Reservation.expiry_date < now)
+                .order_by(Reservation.expiry_date)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not locked:
+                break
+            result = conn.execute(
+                update(Reservation)
+                .where(Reservation.id.in_([row.id for row in locked]),
+                       Reservation.status == ReservationStatus.PENDING)
+                .values(status=ReservationStatus.EXPIRED)
+            )
+            adjust(conn, pending_reservations=-result.rowcount)
+            adjust_users(conn, Counter(row.user_id for row in locked), False, pending_reservations=-1)
+            # 順番待ちから繰り上げた予約が確保していた冊は、次の順番待ちに回す（いなければ在庫に戻す）
+            held = Counter(row.book_id for row in locked if holds_copy(row))
+            if held:
+                release_held_copies(conn, held)
+                touch(conn, 'books')
+            touch(conn, 'reservations')
+        for book_id in held:
+            invalidate_availability(book_id)
+        rows += result.rowcount
+        batches += 1
+    return ExpiryReport(rows, batches, time.perf_counter() - start)
+
+
+scheduler = Scheduler()
+scheduler.register('sweep_overdue', sweep_overdue_loans,
+                   interval=int(os.getenv('OVERDUE_SWEEP_INTERVAL', 300)))
+scheduler.register('expire_reservations', lambda: expire_reservations().rows,
+                   interval=int(os.getenv('RESERVATION_EXPIRY_INTERVAL', 600)))
+scheduler.register('reconcile_stats', lambda: reconcile_stats().drift,
+                   interval=int(os.getenv('STATS_RECONCILE_INTERVAL', 3600)))
+scheduler.register('reconcile_user_activity', lambda: reconcile_user_activity().drift,
+                   interval=int(os.getenv('USER_ACTIVITY_RECONCILE_INTERVAL', 3600)))
+scheduler.register('archive_history', lambda: archive_history().rows,
+                   interval=int(os.getenv('ARCHIVE_INTERVAL', 3600)))
+
+
+def start_scheduler(after_fork=False):
+    """
+    環境変数ENABLE_SCHEDULERが有効なら定期ジョブを開始
+    gunicornのpreloadでは親プロセスで開始したスレッドがワーカーに引き継がれないため、
+    SCHEDULER_AFTER_FORK が有効な場合はワーカーのfork後（after_fork=True）にだけ開始します。
+    """
+    if os.getenv('SCHEDULER_AFTER_FORK', 'False').lower() == 'true' and not after_fork:
+        return
+    if os.getenv('ENABLE_SCHEDULER', 'True').lower() == 'true' and not scheduler.started:
+        scheduler.start()
+
+
+def run_expiry_workers(workers, batch_size):
+    """複数スレッドで期限切れ処理を同時に実行し、合計のスループットを返す"""
+    reports = []
+    lock = threading.Lock()
+
+    def worker():
+        report = expire_reservations(batch_size=batch_size)
+        with lock:
+            reports.append(report)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return ExpiryReport(sum(r.rows for r in reports), sum(r.batches for r in reports),
+                        time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='バックグラウンドジョブを1回実行')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('sweep-overdue', help='返却期限を過ぎた貸出を延滞に更新')
+    expire = subparsers.add_parser('expire-reservations', help='期限切れの予約をEXPIREDに更新')
+    expire.add_argument('--batch-size', type=int, default=None)
+    expire.add_argument('--workers', type=int, default=1)
+    reconcile = subparsers.add_parser('reconcile-stats', help='ダッシュボードの集計値を数え直す')
+    reconcile.add_argument('--days', type=int, default=None, help='作り直す日別貸出件数の日数')
+    user_activity = subparsers.add_parser('reconcile-user-activity', help='利用者ごとの貸出・予約の件数を数え直す')
+    user_activity.add_argument('--batch-size', type=int, default=None)
+    archive = subparsers.add_parser('archive', help='古い返却済みの貸出・終了した予約をアーカイブへ移動')
+    archive.add_argument('--older-than-days', type=int, default=None)
+    archive.add_argument('--batch-size', type=int, default=None)
+    archive.add_argument('--pause', type=float, default=None, help='バッチの間の休止（秒）')
+    archive.add_argument('--max-batches', type=int, default=0, help='処理するバッチ数の上限（0は無制限）')
+    args = parser.parse_args(argv)
+
+    if args.command == 'expire-reservations':
+        print(f'expire_reservations: {run_expiry_workers(args.workers, args.batch_size)}')
+        return
+
+    if args.command == 'reconcile-stats':
+        print(f'reconcile_stats: {reconcile_stats(days=args.days)}')
+        return
+
+    if args.command == 'reconcile-user-activity':
+        print(f'reconcile_user_activity: {reconcile_user_activity(batch_size=args.batch_size)}')
+        return
+
+    if args.command == 'archive':
+        report = archive_history(older_than_days=args.older_than_days, batch_size=args.batch_size,
+                                 pause=args.pause, max_batches=args.max_batches)
+        print(f'archive_history: {report}')
+        return
+
+    job = scheduler.jobs['sweep_overdue']
+    rows = job.run_once()
+    if rows is None:
+        print('他のワーカーが実行中のためスキップしました。')
+    else:
+        print(f'{job.name}: {rows} 件を処理しました（{job.last_duration:.3f}秒）')
+
+
+if __name__ == '__main__':
+    main()
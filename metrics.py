@@ -0,0 +1,420 @@
+"""
+リクエストとSQLの計測（/metrics でPrometheus形式のテキストとして公開）
+
+- ルート（エンドポイント）ごとの応答時間・SQL数・DB時間のヒストグラムと、ステータス別のリクエスト数
+- SLOW_QUERY_MS 以上かかったSQLを、値を ? に置き換えた形で直近 SLOW_QUERY_SAMPLES 種類まで保持
+- コネクションプール・キャッシュ・パスワードハッシュ・読み取りレプリカの状態
+
+計測はリクエストの前後とSQLの実行前後に時刻を取って足し込むだけなので、本番でも有効のまま使えます
+（METRICS_ENABLED=false で無効）。値はプロセスごとのため、gunicornでは各ワーカーの値になります。
+ワーカーの入れ替えやリクエストごとに応答するワーカーが変わっても、カウンターが減ったように見えないよう
+すべての値に pid ラベルを付けます（合算は rate() の後に sum without (pid) で行います）。
+
+/metrics にはエンドポイント名と遅いSQLが含まれるため、METRICS_TOKEN を設定した場合はトークンが、
+設定しない場合は管理者のログインか、プロキシを経由しないローカルホストからのアクセスが必要です。
+"""
+
+import bisect
+import hmac
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import Flask, Response, abort, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True').lower() == 'true'
+# 設定した場合は Authorization: Bearer <METRICS_TOKEN> が必要（未設定の場合は管理者かローカルホストのみ）
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))
+SLOW_QUERY_SAMPLES = int(os.getenv('SLOW_QUERY_SAMPLES', 50))
+
+# ヒストグラムの区切り（Prometheusの慣例に合わせて秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# 計測しないエンドポイント（メトリクス自体と静的ファイル）
+EXCLUDED_ENDPOINTS = {'metrics', 'static'}
+
+_WHITESPACE = re.compile(r'\s+')
+_PARAMETERS = re.compile(r'%\(\w+\)s|%s|\?')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+LOOPBACK_ADDRESSES = {'127.0.0.1', '::1'}
+
+# このプロセスの開始時刻（gunicornのpreloadではfork後に取り直す）
+_process_start_time = time.time()
+
+
+def normalize_sql(statement, max_length=500):
+    """パラメータ・リテラルを ? に、IN (?, ?, ...) を IN (...) にまとめた1行のSQL"""
+    sql = _WHITESPACE.sub(' ', statement).strip()
+    sql = _PARAMETERS.sub('?', sql)
+    sql = _LITERALS.sub('?', sql)
+    sql = _IN_LISTS.sub('(...)', sql)
+    return sql if len(sql) <= max_length else sql[:max_length] + '...'
+
+
+class Histogram:
+    """区切りごとの件数と合計（累積はせず、出力時に累積する）"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は上限なし
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def cumulative(self):
+        """(上限, 累積件数) の一覧（最後の上限は '+Inf'）"""
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+
+class RouteMetrics:
+    """1つのエンドポイントの計測値"""
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.db_time = Histogram(LATENCY_BUCKETS)
+        self.responses = {}  # (メソッド, ステータス) -> 件数
+
+
+class RequestMetrics:
+    """リクエストとSQLの計測値（プロセス内で共有し、ロックで保護する）"""
+    def __init__(self, slow_query_ms=SLOW_QUERY_MS, slow_query_samples=SLOW_QUERY_SAMPLES):
+        self.slow_query_ms = slow_query_ms
+        self.slow_query_samples = slow_query_samples
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.routes = {}
+            self.in_progress = 0
+            self.queries = {'request': 0, 'background': 0}
+            self.query_seconds = {'request': 0.0, 'background': 0.0}
+            self.slow_queries_total = 0
+            self.slow_queries = OrderedDict()  # 正規化したSQL -> 集計（古いものから追い出す）
+
+    # ---------- リクエスト ----------
+
+    def start_request(self, endpoint):
+        local = self._local
+        local.endpoint = endpoint
+        local.queries = 0
+        local.db_seconds = 0.0
+        local.start = time.perf_counter()
+        with self._lock:
+            self.in_progress += 1
+
+    def end_request(self, method, status):
+        """計測中のリクエストを記録し、(応答時間, SQL数, DB時間) を返す（計測していなければNone）"""
+        local = self._local
+        endpoint = getattr(local, 'endpoint', None)
+        if endpoint is None:
+            return None
+        elapsed = time.perf_counter() - local.start
+        local.endpoint = None
+        with self._lock:
+            self.in_progress -= 1
+            route = self.routes.get(endpoint)
+            if route is None:
+                route = self.routes[endpoint] = RouteMetrics()
+            route.latency.observe(elapsed)
+            route.queries.observe(local.queries)
+            route.db_time.observe(local.db_seconds)
+            key = (method, status)
+            route.responses[key] = route.responses.get(key, 0) + 1
+        return elapsed, local.queries, local.db_seconds
+
+    # ---------- SQL ----------
+
+    def observe_query(self, statement, elapsed):
+        local = self._local
+        endpoint = getattr(local, 'endpoint', None)
+        source = 'background' if endpoint is None else 'request'
+        if endpoint is not None:
+            local.queries += 1
+            local.db_seconds += elapsed
+        elapsed_ms = elapsed * 1000
+        with self._lock:
+            self.queries[source] += 1
+            self.query_seconds[source] += elapsed
+            if elapsed_ms >= self.slow_query_ms:
+                self._record_slow_query(statement, elapsed_ms, endpoint or 'background')
+
+    def _record_slow_query(self, statement, elapsed_ms, endpoint):
+        self.slow_queries_total += 1
+        sql = normalize_sql(statement)
+        sample = self.slow_queries.pop(sql, None)
+        if sample is None:
+            sample = {'sql': sql, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+            if len(self.slow_queries) >= self.slow_query_samples:
+                self.slow_queries.popitem(last=False)
+        sample['count'] += 1
+        sample['total_ms'] += elapsed_ms
+        sample['max_ms'] = max(sample['max_ms'], elapsed_ms)
+        sample['endpoint'] = endpoint
+        sample['last_seen'] = datetime.now()
+        self.slow_queries[sql] = sample
+
+    # ---------- 管理画面用 ----------
+
+    def route_summary(self, limit=10):
+        """合計時間の長い順のエンドポイント（管理画面用）"""
+        with self._lock:
+            rows = [{
+                'endpoint': endpoint,
+                'requests': route.latency.count,
+                'avg_ms': route.latency.sum / route.latency.count * 1000 if route.latency.count else 0.0,
+                'total_s': route.latency.sum,
+                'avg_queries': route.queries.sum / route.queries.count if route.queries.count else 0.0,
+                'avg_db_ms': route.db_time.sum / route.db_time.count * 1000 if route.db_time.count else 0.0,
+            } for endpoint, route in self.routes.items()]
+        rows.sort(key=lambda row: row['total_s'], reverse=True)
+        return rows[:limit]
+
+    def slow_query_summary(self, limit=10):
+        """最大実行時間の長い順の遅いSQL（管理画面用）"""
+        with self._lock:
+            samples = [dict(sample) for sample in self.slow_queries.values()]
+        samples.sort(key=lambda sample: sample['max_ms'], reverse=True)
+        return samples[:limit]
+
+
+request_metrics = RequestMetrics()
+
+
+# ==================== 計測の登録 ====================
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is not None:
+        request_metrics.observe_query(statement, time.perf_counter() - start)
+
+
+def instrument_engines():
+    """すべてのエンジン（プライマリ・レプリカ）のSQLを計測"""
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_metrics(app: Flask):
+    """リクエストの前後の計測と /metrics を登録"""
+    if not METRICS_ENABLED:
+        return
+    instrument_engines()
+
+    @app.before_request
+    def _start_request_metrics():
+        endpoint = request.endpoint or 'unmatched'
+        if endpoint not in EXCLUDED_ENDPOINTS:
+            request_metrics.start_request(endpoint)
+
+    # 他の after_request（セッションのコミットなど）より後に実行されるよう、先に登録すること
+    @app.after_request
+    def _end_request_metrics(response):
+        request_metrics.end_request(request.method, response.status_code)
+        return response
+
+    @app.teardown_request
+    def _abandon_request_metrics(error=None):
+        # after_request まで到達しなかったリクエストはエラーとして記録する（計測済みなら何もしない）
+        request_metrics.end_request(request.method, 500)
+
+    @app.route('/metrics')
+    def metrics():
+        """Prometheus形式のメトリクス"""
+        if not _metrics_allowed():
+            abort(401 if METRICS_TOKEN else 403)
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _metrics_allowed():
+    """/metrics を返してよいか（トークン、管理者のログイン、プロキシを経由しないローカルホスト）"""
+    if METRICS_TOKEN:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')
+    if current_user.is_authenticated and current_user.is_admin():
+        return True
+    # 同じホストのリバースプロキシ経由ではすべてのアクセスがローカルホストからに見えるため除く
+    return request.remote_addr in LOOPBACK_ADDRESSES and 'X-Forwarded-For' not in request.headers
+
+
+def _reset_after_fork():
+    # preloadで親プロセスから引き継いだ値を捨て、ワーカーごとに0から数える
+    global _process_start_time
+    _process_start_time = time.time()
+    request_metrics.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# ==================== Prometheus形式の出力 ====================
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _number(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Writer:
+    """labels はすべての値に付けるラベル（pidなど）"""
+    def __init__(self, **labels):
+        self.lines = []
+        self.labels = labels
+
+    def family(self, name, kind, help_text):
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {kind}')
+
+    def sample(self, name, value, **labels):
+        self.lines.append(f'{name}{_labels({**self.labels, **labels})} {_number(value)}')
+
+    def metric(self, name, kind, help_text, value, **labels):
+        self.family(name, kind, help_text)
+        self.sample(name, value, **labels)
+
+    def histogram(self, name, histogram, **labels):
+        for bound, count in histogram.cumulative():
+            self.sample(f'{name}_bucket', count, **labels, le=bound)
+        self.sample(f'{name}_sum', histogram.sum, **labels)
+        self.sample(f'{name}_count', histogram.count, **labels)
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def _write_requests(out):
+    with request_metrics._lock:
+        routes = sorted(request_metrics.routes.items())
+        out.metric('library_http_requests_in_progress', 'gauge', '処理中のリクエスト数',
+                   request_metrics.in_progress)
+        out.family('library_http_requests_total', 'counter', 'エンドポイント・メソッド・ステータス別のリクエスト数')
+        for endpoint, route in routes:
+            for (method, status), count in sorted(route.responses.items()):
+                out.sample('library_http_requests_total', count, endpoint=endpoint, method=method, status=status)
+        out.family('library_http_request_duration_seconds', 'histogram', 'エンドポイント別の応答時間')
+        for endpoint, route in routes:
+            out.histogram('library_http_request_duration_seconds', route.latency, endpoint=endpoint)
+        out.family('library_http_request_queries', 'histogram', 'エンドポイント別の1リクエストあたりのSQL数')
+        for endpoint, route in routes:
+            out.histogram('library_http_request_queries', route.queries, endpoint=endpoint)
+        out.family('library_http_request_db_seconds', 'histogram', 'エンドポイント別の1リクエストあたりのSQLの実行時間')
+        for endpoint, route in routes:
+            out.histogram('library_http_request_db_seconds', route.db_time, endpoint=endpoint)
+
+        out.family('library_db_queries_total', 'counter', 'SQLの実行数（request: リクエスト内 / background: 定期ジョブなど）')
+        for source, count in request_metrics.queries.items():
+            out.sample('library_db_queries_total', count, source=source)
+        out.family('library_db_query_seconds_total', 'counter', 'SQLの実行時間の合計')
+        for source, seconds in request_metrics.query_seconds.items():
+            out.sample('library_db_query_seconds_total', seconds, source=source)
+        out.metric('library_db_slow_queries_total', 'counter', f'{request_metrics.slow_query_ms:g}ms以上かかったSQLの数',
+                   request_metrics.slow_queries_total)
+
+
+def _write_pool(out, pool):
+    out.metric('library_db_pool_checkouts_total', 'counter', '接続の取り出し回数', pool['checkouts'])
+    out.metric('library_db_pool_max_checked_out', 'gauge', '最大同時使用数', pool['max_checked_out'])
+    for key, help_text in (('connects', '新しい接続の作成数'), ('timeouts', '接続待ちのタイムアウト数'),
+                           ('connection_errors', '接続の切断・接続失敗の数'), ('invalidations', '破棄した接続の数'),
+                           ('pings', '生存確認の回数'), ('ping_failures', '生存確認の失敗数')):
+        out.metric(f'library_db_pool_{key}_total', 'counter', help_text, pool[key])
+    for key, help_text in (('size', 'プールの大きさ'), ('max_overflow', 'オーバーフローの上限'),
+                           ('checked_out', '使用中の接続数'), ('checked_in', '待機中の接続数'),
+                           ('overflow', 'オーバーフロー中の接続数')):
+        if key in pool:
+            out.metric(f'library_db_pool_{key}', 'gauge', help_text, pool[key])
+    # 接続待ち時間（ミリ秒の区切りを秒に直して累積する）
+    out.family('library_db_pool_wait_seconds', 'histogram', '接続を取り出すまでの待ち時間')
+    total = 0
+    for bound, count in pool['wait_histogram']:
+        total += count
+        out.sample('library_db_pool_wait_seconds_bucket', total, le='+Inf' if bound is None else bound / 1000)
+    out.sample('library_db_pool_wait_seconds_sum', pool['wait_avg_ms'] * pool['wait_count'] / 1000)
+    out.sample('library_db_pool_wait_seconds_count', pool['wait_count'])
+
+
+def _write_cache(out, backend, stats):
+    for key, help_text in (('hits', 'キャッシュのヒット数'), ('misses', 'キャッシュのミス数'),
+                           ('evictions', 'キャッシュの追い出し数'), ('invalidations', 'キャッシュの無効化数')):
+        out.metric(f'library_cache_{key}_total', 'counter', help_text, stats[key], backend=backend)
+
+
+def _write_passwords(out, stats):
+    out.metric('library_password_hash_pending', 'gauge', '処理待ちのパスワードハッシュ', stats['pending'])
+    out.metric('library_password_hash_max_pending', 'gauge', '処理待ちの上限', stats['max_pending'])
+    out.metric('library_password_hash_completed_total', 'counter', '完了したパスワードハッシュ', stats['completed'])
+    out.metric('library_password_hash_rejected_total', 'counter', '混雑により拒否したパスワードハッシュ',
+               stats['rejected'])
+    out.metric('library_password_hash_seconds_total', 'counter', 'パスワードハッシュの処理時間の合計',
+               stats['avg_ms'] * stats['completed'] / 1000)
+
+
+def _write_replicas(out, replicas):
+    if not replicas:
+        return
+    out.family('library_db_replica_healthy', 'gauge', 'レプリカが正常か（1: 正常）')
+    for replica in replicas:
+        out.sample('library_db_replica_healthy', replica['healthy'], replica=replica['name'])
+    out.family('library_db_replica_lag_seconds', 'gauge', 'レプリケーション遅延（取得できない場合はNaN）')
+    for replica in replicas:
+        out.sample('library_db_replica_lag_seconds', replica['lag'], replica=replica['name'])
+    out.family('library_db_replica_checked_out', 'gauge', 'レプリカの使用中の接続数')
+    for replica in replicas:
+        out.sample('library_db_replica_checked_out', replica['load'], replica=replica['name'])
+    out.family('library_db_replica_selections_total', 'counter', 'レプリカが選ばれた回数')
+    for replica in replicas:
+        out.sample('library_db_replica_selections_total', replica['selections'], replica=replica['name'])
+
+
+def render_metrics():
+    """Prometheusのテキスト形式（version 0.0.4）"""
+    from cache import cache
+    from database import pool_status, replicas
+    from passwords import hasher
+
+    out = _Writer(pid=os.getpid())
+    out.metric('library_process_start_time_seconds', 'gauge', 'ワーカープロセスの開始時刻（UNIX時間）',
+               _process_start_time)
+    _write_requests(out)
+    _write_pool(out, pool_status())
+    _write_cache(out, cache.name, cache.stats.as_dict())
+    _write_passwords(out, hasher.stats())
+    _write_replicas(out, replicas.status())
+    return out.text()
@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+スキーマのマイグレーション
+デプロイごとに1回だけ実行し、適用した番号を schema_version テーブルに記録します。
+アプリの起動時はDDLを実行せず、schema_version の最大値を1回読んで最新かどうかだけを確認します（check_schema）。
+
+新規のデータベースでは1番目のマイグレーションが現在のモデルからテーブルを作成するため、
+2番目以降は既に適用済みの状態でも失敗しないように（存在を確認してから変更するように）書きます。
+また、2番目以降は書いた時点のテーブル・インデックスを名前で指定し、現在のモデル全体（Base.metadata）は走査しません
+（後のマイグレーションで作成するテーブルは、古いデータベースではまだ存在しないため）。
+インデックスの追加・削除は create_index_online / drop_index_online、列の追加は add_column_online、
+ENUMの値の追加は add_enum_values_online を使います。MySQLでは ALGORITHM=INPLACE, LOCK=NONE で変更するため、
+大きなテーブルでも変更中の読み書きを止めません（オンラインで実行できない場合はテーブルをロックせずにエラーになります）。
+既存のテーブルへの変更は、手で実行するSQLではなく必ず番号付きのマイグレーションとして追加してください。
+
+使い方:
+  python migrations.py upgrade [--to 2]   未適用のマイグレーションを順に適用
+  python migrations.py status             適用済み・未適用の一覧
+  python migrations.py check              未適用があれば終了コード1（デプロイ前の確認用）
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import bindparam, func, insert, inspect, select, text, update
+from sqlalchemy.schema import CreateIndex
+
+from activity import reconcile_users, user_batches
+from database import Base, engine
+from jobs import LeaderLock
+from models import (Book, CollectionVersion, LoanArchive, ReservationArchive, SchemaVersion, User, UserActivity,
+                    UserRole, normalize_isbn)
+from stats import reconcile_counts
+
+# 他のプロセスがマイグレーション中の場合に待つ秒数
+MIGRATION_LOCK_TIMEOUT = int(os.getenv('MIGRATION_LOCK_TIMEOUT', 600))
+
+
+class Migration:
+    def __init__(self, version, name, func):
+        self.version = version
+        self.name = name
+        self.func = func
+
+    def __repr__(self):
+        return f'<Migration {self.version}: {self.name}>'
+
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """マイグレーションを登録するデコレータ（関数にはトランザクション中のConnectionが渡される）"""
+    def decorator(func):
+        MIGRATIONS.append(Migration(version, name, func))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return func
+    return decorator
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+
+class SchemaOutOfDate(RuntimeError):
+    """未適用のマイグレーションがある"""
+
+
+# ==================== インデックス ====================
+
+def _index_names(conn, table_name):
+    return {index['name'] for index in inspect(conn).get_indexes(table_name)}
+
+
+def _applies_to(conn, index):
+    """ddl_if で対象のデータベースを限定したインデックス（FULLTEXTなど）かどうか"""
+    condition = getattr(index, '_ddl_if', None)
+    return condition is None or condition._should_execute(CreateIndex(index), index, conn)
+
+
+def create_index_online(conn, index) -> bool:
+    """
+    モデルに定義したインデックスがなければ作成し、作成したかどうかを返す
+    MySQLでは作成中もテーブルの読み書きを止めないオンラインDDLで作成します
+    （FULLTEXTはLOCK=NONEに対応していないため、書き込みだけを止めるLOCK=SHAREDで作成）。
+    """
+    if not _applies_to(conn, index) or index.name in _index_names(conn, index.table.name):
+        return False
+    if conn.dialect.name == 'mysql':
+        lock = 'SHARED' if index.dialect_options['mysql']['prefix'] == 'FULLTEXT' else 'NONE'
+        ddl = str(CreateIndex(index).compile(dialect=conn.dialect))
+        conn.execute(text(f'{ddl} ALGORITHM=INPLACE LOCK={lock}'))
+    else:
+        index.create(bind=conn)
+    return True
+
+
+def drop_index_online(conn, table_name, index_name) -> bool:
+    """インデックスがあれば削除し、削除したかどうかを返す"""
+    if index_name not in _index_names(conn, table_name):
+        return False
+    preparer = conn.dialect.identifier_preparer
+    if conn.dialect.name == 'mysql':
+        conn.execute(text(f'ALTER TABLE {preparer.quote(table_name)} DROP INDEX {preparer.quote(index_name)}, '
+                          'ALGORITHM=INPLACE, LOCK=NONE'))
+    else:
+        conn.execute(text(f'DROP INDEX {preparer.quote(index_name)}'))
+    return True
+
+
+# ==================== 列 ====================
+
+def _columns(conn, table_name):
+    return {column['name']: column for column in inspect(conn).get_columns(table_name)}
+
+
+def add_column_online(conn, table_name, column_name, ddl) -> bool:
+    """
+    列がなければ追加し、追加したかどうかを返す（ddl は 'INTEGER NOT NULL DEFAULT 0' のような型と制約）
+    既存の行にも値が入るよう、NOT NULLの列には必ずDEFAULTを指定します。
+    """
+    if column_name in _columns(conn, table_name):
+        return False
+    preparer = conn.dialect.identifier_preparer
+    statement = f'ALTER TABLE {preparer.quote(table_name)} ADD COLUMN {preparer.quote(column_name)} {ddl}'
+    if conn.dialect.name == 'mysql':
+        statement += ', ALGORITHM=INPLACE, LOCK=NONE'
+    conn.execute(text(statement))
+    return True
+
+
+def add_enum_values_online(conn, table_name, column_name, values) -> bool:
+    """
+    MySQLのENUM列に足りない値を末尾に追加し、追加したかどうかを返す
+    末尾への追加はテーブルを作り直さずに行えます。SQLiteのENUMは文字列の列のため何もしません。
+    """
+    if conn.dialect.name != 'mysql':
+        return False
+    column = _columns(conn, table_name)[column_name]
+    existing = list(column['type'].enums)
+    missing = [value for value in values if value not in existing]
+    if not missing:
+        return False
+    preparer = conn.dialect.identifier_preparer
+    members = ', '.join("'" + value.replace("'", "''") + "'" for value in existing + missing)
+    conn.execute(text(f'ALTER TABLE {preparer.quote(table_name)} MODIFY {preparer.quote(column_name)} '
+                      f'ENUM({members}) {"NULL" if column["nullable"] else "NOT NULL"}, '
+                      'ALGORITHM=INPLACE, LOCK=NONE'))
+    return True
+
+
+# ==================== マイグレーション ====================
+
+@migration(1, '初期スキーマ（テーブルの作成）')
+def _create_tables(conn):
+    Base.metadata.create_all(bind=conn)
+    # マイグレーションの導入前に作成したデータベースでは、create_all は既存のテーブルを変更しないため、
+    # 2番目以降が前提とする列をここで追加する（6〜9・12番目と同じ変更。追加済みであれば何もしない）
+    for change in (_add_expired_status, _add_hold_queue, _add_auth_version, _add_book_version, _add_loan_reservation):
+        change(conn)
+
+
+@migration(2, '初期管理者ユーザーとJSON APIの版番号の作成')
+def _seed(conn):
+    from versions import COLLECTIONS
+    if conn.execute(select(User.id).where(User.username == 'admin')).first() is None:
+        from werkzeug.security import generate_password_hash
+        conn.execute(insert(User).values(
+            username='admin', email='admin@library.com',
+            password_hash=generate_password_hash('admin123', method='pbkdf2:sha256'),
+            role=UserRole.ADMIN, auth_version=1, created_at=datetime.utcnow(),
+        ))
+        print('初期管理者ユーザーを作成しました: admin / admin123')
+    existing = set(conn.execute(select(CollectionVersion.name)).scalars())
+    missing = [name for name in COLLECTIONS if name not in existing]
+    if missing:
+        conn.execute(insert(CollectionVersion), [{'name': name, 'version': 1} for name in missing])
+
+
+# 旧 schema.sql にあった単一列インデックス（右は代わりに使われる複合インデックス）
+LEGACY_INDEXES = (
+    ('reservations', 'idx_reservations_user'),  # idx_reservations_user_book_status
+    ('reservations', 'idx_reservations_book'),  # idx_reservations_hold_queue
+    ('loans', 'idx_loans_user'),                # idx_loans_user_date
+    ('loans', 'idx_loans_book'),                # idx_loans_book_status
+    ('loans', 'idx_loans_status'),              # idx_loans_status_due
+)
+
+
+# 3番目のマイグレーションで作成するインデックス（作成時点のモデルにあったもの。後から追加したテーブル・
+# インデックスはそれぞれのマイグレーションで作成するため、ここには加えない）
+MIGRATION_3_INDEXES = (
+    ('users', ('idx_users_created',)),
+    ('books', ('idx_books_created', 'ft_books_title_author')),
+    ('reservations', ('idx_reservations_date', 'idx_reservations_user_date', 'idx_reservations_status_expiry',
+                      'idx_reservations_hold_queue', 'idx_reservations_user_book_status')),
+    ('loans', ('idx_loans_date', 'idx_loans_user_date', 'idx_loans_status_due', 'idx_loans_book_status')),
+    ('daily_loan_stats', ('idx_daily_loan_stats_book',)),
+    ('import_jobs', ('idx_import_jobs_source',)),
+)
+
+
+def _model_index(table_name, index_name):
+    """モデルに定義したインデックス（名前で指定）"""
+    return next(index for index in Base.metadata.tables[table_name].indexes if index.name == index_name)
+
+
+@migration(3, 'モデルのインデックスの作成と重複する単一列インデックスの削除')
+def _reconcile_indexes(conn):
+    # schema.sql から作成したデータベースや、インデックスの追加前に作成したテーブルでは
+    # モデルのインデックスが揃っていないため、足りないものだけを作成する
+    # （現在のモデルの全テーブルではなく、このマイグレーションを書いた時点のものに限る）
+    for table_name, index_names in MIGRATION_3_INDEXES:
+        if not inspect(conn).has_table(table_name):
+            continue
+        for index_name in index_names:
+            if create_index_online(conn, _model_index(table_name, index_name)):
+                print(f'インデックスを作成しました: {table_name}.{index_name}')
+    # 旧 schema.sql の単一列インデックスは、先頭の列が同じ複合インデックスで代用できる
+    for table_name, index_name in LEGACY_INDEXES:
+        if drop_index_online(conn, table_name, index_name):
+            print(f'インデックスを削除しました: {table_name}.{index_name}')
+
+
+@migration(4, '利用者ごとの貸出・予約の件数（user_activity）の作成と集計')
+def _create_user_activity(conn):
+    UserActivity.__table__.create(bind=conn, checkfirst=True)
+    if create_index_online(conn, _model_index('loans', 'idx_loans_user_status')):
+        print('インデックスを作成しました: loans.idx_loans_user_status')
+    # 既存の利用者の行を実データから作成する（作成済みの行は数え直す）
+    for user_ids in user_batches(conn):
+        reconcile_users(conn, user_ids)
+
+
+@migration(5, '貸出・予約の履歴のアーカイブ用テーブルの作成')
+def _create_archive_tables(conn):
+    # インデックスはテーブルと一緒に作成される（空のテーブルのためオンラインDDLは不要）
+    Base.metadata.create_all(bind=conn, tables=[ReservationArchive.__table__, LoanArchive.__table__])
+
+
+@migration(6, '予約の状態 EXPIRED の追加')
+def _add_expired_status(conn):
+    if add_enum_values_online(conn, 'reservations', 'status', ['PENDING', 'CONFIRMED', 'CANCELLED', 'EXPIRED']):
+        print('予約の状態を追加しました: reservations.status EXPIRED')
+
+
+@migration(7, '順番待ちの列（books.hold_queue_head / hold_queue_tail, reservations.queue_position）と状態 WAITING の追加')
+def _add_hold_queue(conn):
+    for table_name, column_name, ddl in (('books', 'hold_queue_head', 'INTEGER NOT NULL DEFAULT 0'),
+                                         ('books', 'hold_queue_tail', 'INTEGER NOT NULL DEFAULT 0'),
+                                         ('reservations', 'queue_position', 'INTEGER NULL')):
+        if add_column_online(conn, table_name, column_name, ddl):
+            print(f'列を追加しました: {table_name}.{column_name}')
+    if add_enum_values_online(conn, 'reservations', 'status', ['WAITING']):
+        print('予約の状態を追加しました: reservations.status WAITING')
+    if create_index_online(conn, _model_index('reservations', 'idx_reservations_hold_queue')):
+        print('インデックスを作成しました: reservations.idx_reservations_hold_queue')
+
+
+@migration(8, 'ログインユーザーのキャッシュ用の users.auth_version の追加')
+def _add_auth_version(conn):
+    if add_column_online(conn, 'users', 'auth_version', 'INTEGER NOT NULL DEFAULT 1'):
+        print('列を追加しました: users.auth_version')
+
+
+@migration(9, 'JSON APIのETag用の books.version の追加')
+def _add_book_version(conn):
+    if add_column_online(conn, 'books', 'version', 'INTEGER NOT NULL DEFAULT 1'):
+        print('列を追加しました: books.version')
+
+
+@migration(10, '書籍のISBNの正規化（ハイフン・空白の除去）')
+def _normalize_isbns(conn):
+    # 一括インポートは正規化したISBNで照合・更新するため、書籍管理・サンプルデータで保存した
+    # ハイフン付きのISBNを同じ形に揃える（揃えないと再インポートで同じ書籍が重複して登録される）
+    stripped = func.upper(func.replace(func.replace(Book.isbn, '-', ''), ' ', ''))
+    rows = conn.execute(select(Book.id, Book.isbn).where(Book.isbn != stripped).order_by(Book.id)).all()
+    if not rows:
+        return
+    normalized = {row.id: normalize_isbn(row.isbn) for row in rows}
+    taken = set(conn.execute(select(Book.isbn).where(Book.isbn.in_(set(normalized.values())))).scalars())
+    changes = []
+    for book_id, isbn in normalized.items():
+        if isbn in taken:
+            # 正規化すると別の書籍と同じISBNになる（既に重複登録されている）場合は変更せず、手で統合してもらう
+            print(f'ISBNを正規化できませんでした（{isbn} は別の書籍が使用中）: books.id={book_id}')
+            continue
+        taken.add(isbn)
+        changes.append({'book_id': book_id, 'normalized_isbn': isbn})
+    if changes:
+        conn.execute(update(Book).where(Book.id == bindparam('book_id')).values(isbn=bindparam('normalized_isbn')),
+                     changes)
+        print(f'ISBNを正規化しました: {len(changes)} 冊')
+
+
+@migration(11, '管理画面の集計値の行（library_stats）の作成')
+def _create_library_stats(conn):
+    # 管理画面の表示中に全件を数えて作成しないよう、デプロイ時に作成しておく（作成済みの行は数え直す）
+    print(f'集計値を数え直しました: {reconcile_counts(conn)}')
+
+
+@migration(12, '一括貸出で作成した貸出を読み直すための loans.reservation_id の追加')
+def _add_loan_reservation(conn):
+    if add_column_online(conn, 'loans', 'reservation_id', 'INTEGER NULL'):
+        print('列を追加しました: loans.reservation_id')
+    if create_index_online(conn, _model_index('loans', 'idx_loans_reservation')):
+        print('インデックスを作成しました: loans.idx_loans_reservation')
+
+
+@migration(13, '一括インポートでISBNのない書籍を照合するための books.idx_books_title_author の追加')
+def _add_book_title_index(conn):
+    if create_index_online(conn, _model_index('books', 'idx_books_title_author')):
+        print('インデックスを作成しました: books.idx_books_title_author')
+
+
+@migration(14, '管理画面の集計値（library_stats）のスロット行の作成')
+def _create_stats_slots(conn):
+    # 11番目で作成した1行に加えて、同時の更新を分散させる行を作成する（作成済みの行は数え直す）
+    print(f'集計値を数え直しました: {reconcile_counts(conn)}')
+
+
+# ==================== 適用 ====================
+
+def current_version(bind=None) -> int:
+    """適用済みの最大の番号（schema_version がまだなければ0）"""
+    # 接続できないなどのエラーは0（全件適用）と区別がつかなくなるため、そのまま送出する
+    with (bind or engine).connect() as conn:
+        if not inspect(conn).has_table(SchemaVersion.__tablename__):
+            return 0
+        return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+
+def pending(bind=None):
+    current = current_version(bind)
+    return [m for m in MIGRATIONS if m.version > current]
+
+
+def _acquire(lock):
+    deadline = time.monotonic() + MIGRATION_LOCK_TIMEOUT
+    while not lock.acquire():
+        if time.monotonic() >= deadline:
+            raise RuntimeError('他のプロセスがマイグレーション中のため、ロックを取得できませんでした。')
+        time.sleep(1)
+
+
+def upgrade(bind=None, target=None, log=print):
+    """
+    未適用のマイグレーションを順に適用し、適用した件数を返す
+    複数のプロセスが同時に実行しても、ロックで1つずつ順に適用されます。
+    """
+    bind = bind or engine
+    lock = LeaderLock('schema_migrations', bind=bind)
+    _acquire(lock)
+    try:
+        SchemaVersion.__table__.create(bind=bind, checkfirst=True)
+        applied = 0
+        for m in pending(bind):
+            if target is not None and m.version > target:
+                break
+            start = time.perf_counter()
+            # MySQLのDDLは暗黙にコミットされるため、番号の記録はマイグレーションの最後に行う
+            with bind.begin() as conn:
+                m.func(conn)
+                conn.execute(insert(SchemaVersion).values(version=m.version, name=m.name,
+                                                          applied_at=datetime.utcnow()))
+            applied += 1
+            log(f'{m.version:>4}: {m.name} ({time.perf_counter() - start:.2f}秒)')
+        return applied
+    finally:
+        lock.release()
+
+
+def check_schema(bind=None, auto_migrate=False) -> int:
+    """
+    起動時の確認（schema_version の最大値を1回読むだけ）
+    未適用のマイグレーションがあれば、auto_migrate の場合は適用し、それ以外はSchemaOutOfDateを送出します。
+    データベースの方が新しい場合（ローリングデプロイ中など）はそのまま起動します。
+    """
+    current = current_version(bind)
+    if current >= latest_version():
+        return current
+    if auto_migrate:
+        upgrade(bind)
+        return latest_version()
+    raise SchemaOutOfDate(f'データベースのスキーマが古いため起動できません（適用済み {current} / 最新 {latest_version()}）。'
+                          'python migrations.py upgrade を実行してください。')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='スキーマのマイグレーション')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    up = subparsers.add_parser('upgrade', help='未適用のマイグレーションを適用')
+    up.add_argument('--to', type=int, default=None, help='この番号まで適用')
+    subparsers.add_parser('status', help='適用済み・未適用の一覧')
+    subparsers.add_parser('check', help='未適用があれば終了コード1')
+    args = parser.parse_args(argv)
+
+    if args.command == 'upgrade':
+        applied = upgrade(target=args.to)
+        print(f'{applied} 件のマイグレーションを適用しました（現在 {current_version()}）。')
+    elif args.command == 'status':
+        current = current_version()
+        for m in MIGRATIONS:
+            print(f'{"適用済み" if m.version <= current else "未適用  "}  {m.version:>4}: {m.name}')
+    elif args.command == 'check':
+        missing = pending()
+        if missing:
+            print(f'未適用のマイグレーションが {len(missing)} 件あります。')
+            sys.exit(1)
+        print('スキーマは最新です。')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum, Date
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Enum, Date, Index, Float, Text, BigInteger
+from sqlalchemy.orm import relationship, validates
 from datetime import datetime, date, timedelta
 from database import Base
 import enum
+import re
+
+def normalize_isbn(value: str) -> str:
+    """ISBNからハイフンと空白を除去して正規化（books.isbn には常にこの形で保存する）"""
+    return re.sub(r'[\s\-]', '', value or '').upper()
 
 class UserRole(enum.Enum):
     USER = 'user'
@@ -12,12 +17,19 @@ class ReservationStatus(enum.Enum):
     PENDING = 'pending'
     CONFIRMED = 'confirmed'
     CANCELLED = 'cancelled'
+    EXPIRED = 'expired'
+    WAITING = 'waiting'
 
 class LoanStatus(enum.Enum):
     ACTIVE = 'active'
     RETURNED = 'returned'
     OVERDUE = 'overdue'
 
+class ImportStatus(enum.Enum):
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+
 class User(Base):
     __tablename__ = 'users'
     
@@ -26,11 +38,19 @@ class User(Base):
     email = Column(String(120), unique=True, nullable=False)
     password_hash = Column(String(255), nullable=False)
     role = Column(Enum(UserRole), default=UserRole.USER, nullable=False)
+    # 役割・パスワードの変更ごとに増える（ログインユーザーのキャッシュキーに使用）
+    auth_version = Column(Integer, default=1, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        # 一覧のキーセットページネーション用
+        Index('idx_users_created', 'created_at', 'id'),
+    )
+    
     # リレーション
     reservations = relationship('Reservation', back_populates='user', cascade='all, delete-orphan')
     loans = relationship('Loan', back_populates='user', cascade='all, delete-orphan')
+    activity = relationship('UserActivity', back_populates='user', uselist=False, cascade='all, delete-orphan')
     
     def is_admin(self):
         return self.role == UserRole.ADMIN
@@ -49,12 +69,32 @@ class Book(Base):
     publication_date = Column(Date, nullable=True)
     total_copies = Column(Integer, default=1, nullable=False)
     available_copies = Column(Integer, default=1, nullable=False)
+    # 順番待ちキュー（繰り上げ済みの位置 / 最後に割り当てた位置）
+    hold_queue_head = Column(Integer, default=0, nullable=False)
+    hold_queue_tail = Column(Integer, default=0, nullable=False)
+    # 書籍の行を更新するたびに増える（JSON APIのETagに使用）
+    version = Column(Integer, default=1, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        # 一覧のキーセットページネーション用
+        Index('idx_books_created', 'created_at', 'id'),
+        # 一括インポートでISBNのない書籍をタイトルと著者で照合する
+        Index('idx_books_title_author', 'title', 'author'),
+        # 全文検索用インデックス（MySQLのみ。日本語タイトルのためngramパーサーを使用）
+        Index('ft_books_title_author', 'title', 'author',
+              mysql_prefix='FULLTEXT', mysql_with_parser='ngram').ddl_if(dialect='mysql'),
+    )
+    
     # リレーション
     reservations = relationship('Reservation', back_populates='book', cascade='all, delete-orphan')
     loans = relationship('Loan', back_populates='book', cascade='all, delete-orphan')
     
+    @validates('isbn')
+    def _normalize_isbn(self, key, value):
+        # 書籍管理・サンプルデータなど、ORMで保存するISBNも一括インポートと同じ形に揃える
+        return normalize_isbn(value) or None
+    
     def is_available(self):
         return self.available_copies > 0
     
@@ -70,6 +110,20 @@ class Reservation(Base):
     reservation_date = Column(DateTime, default=datetime.utcnow, nullable=False)
     status = Column(Enum(ReservationStatus), default=ReservationStatus.PENDING, nullable=False)
     expiry_date = Column(DateTime, nullable=True)
+    # 順番待ち（WAITING）のときの書籍ごとの通し番号（繰り上げ後も残し、1冊を確保している目印にする）
+    queue_position = Column(Integer, nullable=True)
+    
+    __table_args__ = (
+        # 一覧のキーセットページネーション用（全件 / ユーザー別）
+        Index('idx_reservations_date', 'reservation_date', 'id'),
+        Index('idx_reservations_user_date', 'user_id', 'reservation_date', 'id'),
+        # 期限切れ予約の一括処理用
+        Index('idx_reservations_status_expiry', 'status', 'expiry_date'),
+        # 順番待ちの先頭の取得用
+        Index('idx_reservations_hold_queue', 'book_id', 'status', 'queue_position'),
+        # 予約の重複チェック用（reserve_book / book_detail）
+        Index('idx_reservations_user_book_status', 'user_id', 'book_id', 'status'),
+    )
     
     # リレーション
     user = relationship('User', back_populates='reservations')
@@ -84,6 +138,12 @@ class Reservation(Base):
     def is_expired(self):
         return datetime.utcnow() > self.expiry_date
     
+    def hold_position(self):
+        """順番待ちの何番目か（前の利用者のキャンセル分を含む目安）"""
+        if self.status != ReservationStatus.WAITING or self.queue_position is None:
+            return None
+        return max(1, self.queue_position - self.book.hold_queue_head)
+    
     def __repr__(self):
         return f'<Reservation {self.id} - User {self.user_id} - Book {self.book_id}>'
 
@@ -97,6 +157,21 @@ class Loan(Base):
     due_date = Column(DateTime, nullable=False)
     return_date = Column(DateTime, nullable=True)
     status = Column(Enum(LoanStatus), default=LoanStatus.ACTIVE, nullable=False)
+    # 貸し出した予約（予約はアーカイブに移動するため外部キーにしない。一括貸出で作成した貸出のIDを読み直すのに使う）
+    reservation_id = Column(Integer, nullable=True)
+    
+    __table_args__ = (
+        # 一覧のキーセットページネーション用（全件 / ユーザー別）
+        Index('idx_loans_date', 'loan_date', 'id'),
+        Index('idx_loans_user_date', 'user_id', 'loan_date', 'id'),
+        # 状態別の集計と延滞の更新用
+        Index('idx_loans_status_due', 'status', 'due_date'),
+        # 書籍ごとの貸出中の冊数の集計用
+        Index('idx_loans_book_status', 'book_id', 'status'),
+        # 利用者ごとの貸出中の冊数の再集計用
+        Index('idx_loans_user_status', 'user_id', 'status'),
+        Index('idx_loans_reservation', 'reservation_id'),
+    )
     
     # リレーション
     user = relationship('User', back_populates='loans')
@@ -116,3 +191,183 @@ class Loan(Base):
     def __repr__(self):
         return f'<Loan {self.id} - User {self.user_id} - Book {self.book_id}>'
 
+
+class ReservationArchive(Base):
+    """古い終了済みの予約（archive.py が reservations から移動。一覧・エクスポートでは reservations と合わせて表示）"""
+    __tablename__ = 'reservations_archive'
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    book_id = Column(Integer, ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
+    reservation_date = Column(DateTime, nullable=False)
+    status = Column(Enum(ReservationStatus), nullable=False)
+    expiry_date = Column(DateTime, nullable=True)
+    queue_position = Column(Integer, nullable=True)
+    archived_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        # 一覧のキーセットページネーション用（全件 / ユーザー別）
+        Index('idx_reservations_archive_date', 'reservation_date', 'id'),
+        Index('idx_reservations_archive_user_date', 'user_id', 'reservation_date', 'id'),
+        Index('idx_reservations_archive_book', 'book_id'),
+    )
+    
+    # リレーション
+    user = relationship('User')
+    book = relationship('Book')
+    
+    def is_expired(self):
+        return False
+    
+    def hold_position(self):
+        return None
+    
+    def __repr__(self):
+        return f'<ReservationArchive {self.id} - User {self.user_id} - Book {self.book_id}>'
+
+class LoanArchive(Base):
+    """古い返却済みの貸出（archive.py が loans から移動。一覧・エクスポートでは loans と合わせて表示）"""
+    __tablename__ = 'loans_archive'
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    book_id = Column(Integer, ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
+    loan_date = Column(DateTime, nullable=False)
+    due_date = Column(DateTime, nullable=False)
+    return_date = Column(DateTime, nullable=True)
+    status = Column(Enum(LoanStatus), nullable=False)
+    archived_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        # 一覧のキーセットページネーション用（全件 / ユーザー別）
+        Index('idx_loans_archive_date', 'loan_date', 'id'),
+        Index('idx_loans_archive_user_date', 'user_id', 'loan_date', 'id'),
+        Index('idx_loans_archive_book', 'book_id'),
+    )
+    
+    # リレーション
+    user = relationship('User')
+    book = relationship('Book')
+    
+    def is_overdue(self):
+        return False
+    
+    def __repr__(self):
+        return f'<LoanArchive {self.id} - User {self.user_id} - Book {self.book_id}>'
+
+class JobRun(Base):
+    """定期ジョブの最終実行結果（ワーカー間で共有するためDBに保存）"""
+    __tablename__ = 'job_runs'
+    
+    name = Column(String(64), primary_key=True)
+    last_run_at = Column(DateTime, nullable=True)
+    last_rows = Column(Integer, nullable=True)
+    last_duration = Column(Float, nullable=True)
+    last_error = Column(Text, nullable=True)
+    runs = Column(Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<JobRun {self.name}>'
+
+class LibraryStats(Base):
+    """管理画面ダッシュボード用の集計値（stats.STATS_SLOTS 行に分けて各処理で増減し、合計して表示。定期的に再集計）"""
+    __tablename__ = 'library_stats'
+    
+    # スロットの番号（1〜STATS_SLOTS）
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    total_books = Column(Integer, default=0, nullable=False)
+    total_users = Column(Integer, default=0, nullable=False)
+    pending_reservations = Column(Integer, default=0, nullable=False)
+    active_loans = Column(Integer, default=0, nullable=False)
+    overdue_loans = Column(Integer, default=0, nullable=False)
+    reconciled_at = Column(DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<LibraryStats books={self.total_books} users={self.total_users}>'
+
+class UserActivity(Base):
+    """利用者ごとの貸出・予約の件数（各処理で増減し、定期的に再集計。予約の上限の確認と一覧の表示用）"""
+    __tablename__ = 'user_activity'
+    
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True, autoincrement=False)
+    active_loans = Column(Integer, default=0, nullable=False)
+    overdue_loans = Column(Integer, default=0, nullable=False)
+    pending_reservations = Column(Integer, default=0, nullable=False)
+    waiting_reservations = Column(Integer, default=0, nullable=False)
+    last_activity_at = Column(DateTime, nullable=True)
+    reconciled_at = Column(DateTime, nullable=True)
+    
+    # リレーション
+    user = relationship('User', back_populates='activity')
+    
+    def __repr__(self):
+        return f'<UserActivity {self.user_id}: loans={self.active_loans} reservations={self.pending_reservations}>'
+
+class DailyLoanStat(Base):
+    """日別・書籍別の貸出件数（貸出数の推移・人気ランキング用）"""
+    __tablename__ = 'daily_loan_stats'
+    
+    day = Column(Date, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    loans = Column(Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        Index('idx_daily_loan_stats_book', 'book_id', 'day'),
+    )
+    
+    def __repr__(self):
+        return f'<DailyLoanStat {self.day} - Book {self.book_id}: {self.loans}>'
+
+class SchemaVersion(Base):
+    """適用済みのマイグレーション（migrations.py）"""
+    __tablename__ = 'schema_version'
+    
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    name = Column(String(200), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    
+    def __repr__(self):
+        return f'<SchemaVersion {self.version}: {self.name}>'
+
+class CollectionVersion(Base):
+    """JSON APIの一覧（books / reservations / loans）ごとの版番号（内容が変わる更新と同じトランザクションで増やす）"""
+    __tablename__ = 'collection_versions'
+    
+    name = Column(String(50), primary_key=True)
+    version = Column(BigInteger, default=1, nullable=False)
+    
+    def __repr__(self):
+        return f'<CollectionVersion {self.name}: {self.version}>'
+
+class ImportJob(Base):
+    """書籍の一括インポートの進捗（クラッシュ後に途中から再開するためのチェックポイント）"""
+    __tablename__ = 'import_jobs'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    source = Column(String(500), nullable=False)
+    format = Column(String(10), nullable=False)
+    status = Column(Enum(ImportStatus), default=ImportStatus.RUNNING, nullable=False)
+    # 処理済みの位置（ファイル先頭からのバイト数）
+    position = Column(BigInteger, default=0, nullable=False)
+    file_size = Column(BigInteger, nullable=True)
+    rows_read = Column(Integer, default=0, nullable=False)
+    inserted = Column(Integer, default=0, nullable=False)
+    updated = Column(Integer, default=0, nullable=False)
+    rejected = Column(Integer, default=0, nullable=False)
+    errors = Column(Text, nullable=True)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
+    __table_args__ = (
+        Index('idx_import_jobs_source', 'source', 'status'),
+    )
+    
+    def progress(self):
+        """進捗率（%）"""
+        if not self.file_size:
+            return 100.0 if self.status == ImportStatus.COMPLETED else 0.0
+        return min(100.0, self.position * 100.0 / self.file_size)
+    
+    def __repr__(self):
+        return f'<ImportJob {self.id} {self.source} {self.status.value}>'
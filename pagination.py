@@ -0,0 +1,175 @@
+"""
+一覧画面の共通ページネーション
+OFFSETの代わりに (並び順の列, id) によるキーセットページネーションを行うため、
+深いページでも1ページ目と同じコストで取得できます。
+カーソルはURLに載せる不透明なトークンとしてエンコードします。
+"""
+
+import base64
+import json
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+# 総件数キャッシュの有効期間（秒）
+COUNT_CACHE_TTL = 60
+
+
+class Page:
+    """1ページ分の結果"""
+    def __init__(self, items, per_page, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and 'dt' in value:
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+
+def encode_cursor(payload: dict) -> str:
+    """カーソル情報をURLセーフな文字列にエンコード"""
+    data = json.dumps({k: _encode_value(v) for k, v in payload.items()}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """カーソル文字列をデコード（不正な値の場合はNone）"""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return {k: _decode_value(v) for k, v in payload.items()}
+    except (ValueError, TypeError):
+        return None
+
+
+def keyset_paginate(query, sort_column, id_column, cursor=None, per_page=20, total=None):
+    """
+    (sort_column, id_column) の降順でキーセットページネーション
+    cursorは前ページ/次ページのリンクに埋め込まれたトークン
+    """
+    return keyset_paginate_union([(query, sort_column, id_column)], cursor=cursor, per_page=per_page, total=total)
+
+
+def keyset_paginate_union(sources, cursor=None, per_page=20, total=None):
+    """
+    複数のクエリ（現行のテーブルとアーカイブなど）を1つの一覧としてキーセットページネーション
+    sourcesは (query, sort_column, id_column) の一覧で、並び順の列とidの名前はすべて同じにします。
+    各クエリをそれぞれのインデックスで per_page + 1 件ずつ読み、キーの順にマージします。
+    """
+    position = decode_cursor(cursor)
+    backwards = bool(position and position.get('d') == 'prev')
+    if not (position and 's' in position and 'i' in position):
+        position = None
+
+    rows = []
+    for query, sort_column, id_column in sources:
+        if position:
+            sort_value, id_value = position['s'], position['i']
+            if backwards:
+                condition = or_(sort_column > sort_value,
+                                and_(sort_column == sort_value, id_column > id_value))
+            else:
+                condition = or_(sort_column < sort_value,
+                                and_(sort_column == sort_value, id_column < id_value))
+            query = query.filter(condition)
+        if backwards:
+            query = query.order_by(sort_column.asc(), id_column.asc())
+        else:
+            query = query.order_by(sort_column.desc(), id_column.desc())
+        # 1件多く取得して次のページの有無を判定
+        rows.extend(query.limit(per_page + 1).all())
+
+    _, sort_column, id_column = sources[0]
+
+    def key_of(row):
+        return (getattr(row, sort_column.key), getattr(row, id_column.key))
+
+    if len(sources) > 1:
+        rows.sort(key=key_of, reverse=not backwards)
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first_key, last_key = key_of(rows[0]), key_of(rows[-1])
+        if has_more or backwards:
+            next_cursor = encode_cursor({'s': last_key[0], 'i': last_key[1], 'd': 'next'})
+        if position and (has_more or not backwards):
+            prev_cursor = encode_cursor({'s': first_key[0], 'i': first_key[1], 'd': 'prev'})
+
+    return Page(rows, per_page, next_cursor=next_cursor, prev_cursor=prev_cursor, total=total)
+
+
+def offset_cursor(cursor) -> int:
+    """関連度順など、キーを持たない結果のためのオフセット型カーソル"""
+    position = decode_cursor(cursor) or {}
+    offset = position.get('o', 0)
+    return offset if isinstance(offset, int) and offset > 0 else 0
+
+
+def offset_page(items, offset, per_page, total):
+    """オフセット型カーソルでPageを生成"""
+    next_cursor = encode_cursor({'o': offset + per_page}) if offset + per_page < total else None
+    prev_cursor = encode_cursor({'o': max(0, offset - per_page)}) if offset > 0 else None
+    return Page(items, per_page, next_cursor=next_cursor, prev_cursor=prev_cursor, total=total)
+
+
+class CountCache:
+    """COUNT(*) の結果を一定時間キャッシュ（一覧ごとに毎回数えないため）"""
+    def __init__(self, ttl=COUNT_CACHE_TTL):
+        self.ttl = ttl
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._values.get(key)
+            if cached and cached[1] > now:
+                return cached[0]
+        value = compute()
+        with self._lock:
+            self._values[key] = (value, now + self.ttl)
+        return value
+
+    def invalidate(self, prefix=None):
+        with self._lock:
+            if prefix is None:
+                self._values.clear()
+            else:
+                for key in [k for k in self._values if k.startswith(prefix)]:
+                    del self._values[key]
+
+
+count_cache = CountCache()
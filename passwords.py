@@ -0,0 +1,133 @@
+"""
+パスワードハッシュの計算
+PBKDF2などのCPU負荷の高い計算をリクエストスレッドから別プロセスのプールに移し、
+同時に処理する件数に上限を設けます（上限を超えた場合は待たずにエラーを返す）。
+KDFのパラメータは環境変数で変更でき、ログイン時に古いパラメータのハッシュを再計算します。
+
+プールはプロセス（gunicornのワーカー）ごとに作成します。gunicornでは全ワーカーの合計がCPUコア数を超えないよう
+gunicorn.conf.py が PASSWORD_HASH_WORKERS を「コア数 ÷ ワーカー数」に設定します。
+プールのプロセスはforkで起動するため、スレッドを持つプロセスからforkすると他のスレッドが保持していたロックを
+引き継いでしまいます。gunicornではワーカーのfork直後（post_fork。リクエストを処理するスレッドや定期ジョブの
+スレッドが動き出す前）に start() ですべてのプロセスを起動しておき、以降はforkしません。
+プールのプロセスはwerkzeugのハッシュ関数だけを実行し、引き継いだDBの接続などには触れません。
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+# 例: pbkdf2:sha256:600000 / scrypt:32768:8:1
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', f'pbkdf2:sha256:{DEFAULT_PBKDF2_ITERATIONS}')
+# ハッシュ計算用のプロセス数（0の場合はリクエストスレッドで計算。gunicornでは gunicorn.conf.py が設定する）
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+# 同時に受け付ける計算の上限（既定はプロセス数の4倍）と、空きを待つ最大秒数
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', max(PASSWORD_HASH_WORKERS, 1) * 4))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv('PASSWORD_HASH_QUEUE_TIMEOUT', 2.0))
+
+
+def _noop(_):
+    return None
+
+
+class PasswordHashBusy(Exception):
+    """ハッシュ計算の待ち行列が満杯"""
+
+
+def normalize_method(method: str) -> str:
+    """省略されたパラメータをwerkzeugの既定値で補う（保存済みハッシュの接頭辞と比較するため）"""
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2':
+        if len(parts) == 1:
+            parts.append('sha256')
+        if len(parts) == 2:
+            parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+    elif parts[0] == 'scrypt' and len(parts) == 1:
+        parts.extend(['32768', '8', '1'])
+    return ':'.join(parts)
+
+
+class PasswordHasher:
+    """プロセスプールでパスワードハッシュを計算（待ち行列の長さを記録）"""
+    def __init__(self, method=PASSWORD_HASH_METHOD, workers=PASSWORD_HASH_WORKERS,
+                 max_pending=PASSWORD_HASH_MAX_PENDING, queue_timeout=PASSWORD_HASH_QUEUE_TIMEOUT):
+        self.method = normalize_method(method)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self.pending = 0
+        self.max_pending_seen = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+
+    def _get_executor(self):
+        # フォーク後のワーカーでは親プロセスのプールを使わず作り直す
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def start(self):
+        """
+        プールのすべてのプロセスを今すぐ起動（forkの場合、最初の計算ですべてのプロセスが起動する）
+        スレッドを起動する前に呼び出すこと（gunicornでは post_fork）。呼ばない場合は最初の計算の時に起動します。
+        """
+        if self.workers > 0:
+            list(self._get_executor().map(_noop, range(self.workers)))
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHashBusy('パスワード処理が混雑しています。')
+        with self._lock:
+            self.pending += 1
+            self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        start = time.perf_counter()
+        try:
+            if self.workers <= 0:
+                return func(*args)
+            return self._get_executor().submit(func, *args).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                self.total_seconds += time.perf_counter() - start
+            self._slots.release()
+
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """保存済みハッシュのパラメータが現在の設定と異なるか"""
+        return password_hash.split('$', 1)[0] != self.method
+
+    def stats(self):
+        return {
+            'method': self.method,
+            'workers': self.workers,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'max_pending_seen': self.max_pending_seen,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_ms': self.total_seconds / self.completed * 1000 if self.completed else 0.0,
+        }
+
+    def shutdown(self):
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
+
+
+hasher = PasswordHasher()
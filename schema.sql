@@ -1,5 +1,6 @@
 -- 図書館予約管理システム データベーススキーマ
--- 参考用: SQLAlchemyが自動的にテーブルを作成するため、このファイルは参考用です
+-- 参考用: テーブルとインデックスは migrations.py のマイグレーションで作成するため、このファイルは参考用です
+-- （インデックスは models.py の定義と同じです）
 
 CREATE DATABASE IF NOT EXISTS library_system CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
 
@@ -12,6 +13,7 @@ CREATE TABLE IF NOT EXISTS users (
     email VARCHAR(120) UNIQUE NOT NULL,
     password_hash VARCHAR(255) NOT NULL,
     role ENUM('user', 'admin') DEFAULT 'user' NOT NULL,
+    auth_version INT DEFAULT 1 NOT NULL,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -25,6 +27,9 @@ CREATE TABLE IF NOT EXISTS books (
     publication_date DATE,
     total_copies INT DEFAULT 1 NOT NULL,
     available_copies INT DEFAULT 1 NOT NULL,
+    hold_queue_head INT DEFAULT 0 NOT NULL,
+    hold_queue_tail INT DEFAULT 0 NOT NULL,
+    version INT DEFAULT 1 NOT NULL,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -34,8 +39,9 @@ CREATE TABLE IF NOT EXISTS reservations (
     user_id INT NOT NULL,
     book_id INT NOT NULL,
     reservation_date DATETIME DEFAULT CURRENT_TIMESTAMP NOT NULL,
-    status ENUM('pending', 'confirmed', 'cancelled') DEFAULT 'pending' NOT NULL,
+    status ENUM('pending', 'confirmed', 'cancelled', 'expired', 'waiting') DEFAULT 'pending' NOT NULL,
     expiry_date DATETIME,
+    queue_position INT,
     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
     FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE
 );
@@ -53,10 +59,134 @@ CREATE TABLE IF NOT EXISTS loans (
     FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE
 );
 
+-- 予約・貸出の履歴のアーカイブ（archive.py が古い終了済みの行を移動。IDは元のテーブルのまま）
+CREATE TABLE IF NOT EXISTS reservations_archive (
+    id INT PRIMARY KEY,
+    user_id INT NOT NULL,
+    book_id INT NOT NULL,
+    reservation_date DATETIME NOT NULL,
+    status ENUM('pending', 'confirmed', 'cancelled', 'expired', 'waiting') NOT NULL,
+    expiry_date DATETIME,
+    queue_position INT,
+    archived_at DATETIME NOT NULL,
+    INDEX idx_reservations_archive_date (reservation_date, id),
+    INDEX idx_reservations_archive_user_date (user_id, reservation_date, id),
+    INDEX idx_reservations_archive_book (book_id),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS loans_archive (
+    id INT PRIMARY KEY,
+    user_id INT NOT NULL,
+    book_id INT NOT NULL,
+    loan_date DATETIME NOT NULL,
+    due_date DATETIME NOT NULL,
+    return_date DATETIME,
+    status ENUM('active', 'returned', 'overdue') NOT NULL,
+    archived_at DATETIME NOT NULL,
+    INDEX idx_loans_archive_date (loan_date, id),
+    INDEX idx_loans_archive_user_date (user_id, loan_date, id),
+    INDEX idx_loans_archive_book (book_id),
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+    FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE
+);
+
+-- 定期ジョブの実行結果
+CREATE TABLE IF NOT EXISTS job_runs (
+    name VARCHAR(64) PRIMARY KEY,
+    last_run_at DATETIME,
+    last_rows INT,
+    last_duration FLOAT,
+    last_error TEXT,
+    runs INT DEFAULT 0 NOT NULL
+);
+
+-- ダッシュボードの集計値（1行のみ）
+CREATE TABLE IF NOT EXISTS library_stats (
+    id INT PRIMARY KEY,
+    total_books INT DEFAULT 0 NOT NULL,
+    total_users INT DEFAULT 0 NOT NULL,
+    pending_reservations INT DEFAULT 0 NOT NULL,
+    active_loans INT DEFAULT 0 NOT NULL,
+    overdue_loans INT DEFAULT 0 NOT NULL,
+    reconciled_at DATETIME
+);
+
+-- 利用者ごとの貸出・予約の件数
+CREATE TABLE IF NOT EXISTS user_activity (
+    user_id INT PRIMARY KEY,
+    active_loans INT DEFAULT 0 NOT NULL,
+    overdue_loans INT DEFAULT 0 NOT NULL,
+    pending_reservations INT DEFAULT 0 NOT NULL,
+    waiting_reservations INT DEFAULT 0 NOT NULL,
+    last_activity_at DATETIME,
+    reconciled_at DATETIME,
+    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+);
+
+-- 適用済みのマイグレーション（migrations.py）
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INT PRIMARY KEY,
+    name VARCHAR(200) NOT NULL,
+    applied_at DATETIME NOT NULL
+);
+
+-- JSON APIの一覧ごとの版番号（ETag用）
+CREATE TABLE IF NOT EXISTS collection_versions (
+    name VARCHAR(50) PRIMARY KEY,
+    version BIGINT DEFAULT 1 NOT NULL
+);
+
+INSERT IGNORE INTO collection_versions (name, version) VALUES ('books', 1), ('reservations', 1), ('loans', 1), ('catalog', 1);
+
+-- 日別・書籍別の貸出件数
+CREATE TABLE IF NOT EXISTS daily_loan_stats (
+    day DATE NOT NULL,
+    book_id INT NOT NULL,
+    loans INT DEFAULT 0 NOT NULL,
+    PRIMARY KEY (day, book_id),
+    INDEX idx_daily_loan_stats_book (book_id, day),
+    FOREIGN KEY (book_id) REFERENCES books(id) ON DELETE CASCADE
+);
+
+-- 書籍の一括インポートの進捗
+CREATE TABLE IF NOT EXISTS import_jobs (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    source VARCHAR(500) NOT NULL,
+    format VARCHAR(10) NOT NULL,
+    status ENUM('RUNNING', 'COMPLETED', 'FAILED') DEFAULT 'RUNNING' NOT NULL,
+    position BIGINT DEFAULT 0 NOT NULL,
+    file_size BIGINT,
+    rows_read INT DEFAULT 0 NOT NULL,
+    inserted INT DEFAULT 0 NOT NULL,
+    updated INT DEFAULT 0 NOT NULL,
+    rejected INT DEFAULT 0 NOT NULL,
+    errors TEXT,
+    started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    finished_at DATETIME,
+    INDEX idx_import_jobs_source (source, status)
+);
+
 -- インデックス
-CREATE INDEX idx_reservations_user ON reservations(user_id);
-CREATE INDEX idx_reservations_book ON reservations(book_id);
-CREATE INDEX idx_loans_user ON loans(user_id);
-CREATE INDEX idx_loans_book ON loans(book_id);
-CREATE INDEX idx_loans_status ON loans(status);
+CREATE FULLTEXT INDEX ft_books_title_author ON books(title, author) WITH PARSER ngram;
+
+-- キーセットページネーション用の複合インデックス
+CREATE INDEX idx_users_created ON users(created_at, id);
+CREATE INDEX idx_books_created ON books(created_at, id);
+CREATE INDEX idx_reservations_date ON reservations(reservation_date, id);
+CREATE INDEX idx_reservations_user_date ON reservations(user_id, reservation_date, id);
+CREATE INDEX idx_loans_date ON loans(loan_date, id);
+CREATE INDEX idx_loans_user_date ON loans(user_id, loan_date, id);
+CREATE INDEX idx_reservations_status_expiry ON reservations(status, expiry_date);
+CREATE INDEX idx_reservations_hold_queue ON reservations(book_id, status, queue_position);
+CREATE INDEX idx_loans_status_due ON loans(status, due_date);
+
+-- 予約の重複チェック・書籍ごと / 利用者ごとの貸出中の冊数の集計用
+CREATE INDEX idx_reservations_user_book_status ON reservations(user_id, book_id, status);
+CREATE INDEX idx_loans_book_status ON loans(book_id, status);
+CREATE INDEX idx_loans_user_status ON loans(user_id, status);
 
+-- 一括インポートでISBNのない書籍をタイトルと著者で照合する
+CREATE INDEX idx_books_title_author ON books(title, author);
@@ -0,0 +1,249 @@
+"""
+書籍検索サブシステム
+データベースの種類に応じて検索バックエンドを切り替えます。
+- MySQL: FULLTEXTインデックス（ngramパーサー）による全文検索
+- SQLite/テスト: プロセス内の転置インデックス
+  （ワーカーごとに持つため、書名・著者の変更は全ワーカーで共有する版番号 catalog で検出して作り直す）
+"""
+
+import math
+import os
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+
+from sqlalchemy.dialects.mysql import match
+
+from models import Book, normalize_isbn
+from versions import collection_version
+
+# ISBNとみなす文字列（数字・ハイフン・末尾のX）
+ISBN_FRAGMENT_PATTERN = re.compile(r'^[0-9][0-9\-]{3,}[0-9Xx]?$')
+
+# 英数字の単語と、それ以外（日本語など）の連続した文字列に分割
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+CJK_PATTERN = re.compile(r'[^\W_a-z0-9]+')
+
+# MySQLのBOOLEAN MODEで演算子として解釈される文字
+BOOLEAN_OPERATORS = re.compile(r'[+\-<>()~*"@]')
+
+# タイトルの一致は著者の一致より重く評価する
+TITLE_WEIGHT = 2
+AUTHOR_WEIGHT = 1
+
+
+class SearchResult:
+    """検索結果（1ページ分の書籍と総件数）"""
+    def __init__(self, books, total):
+        self.books = books
+        self.total = total
+
+
+def looks_like_isbn(query: str) -> bool:
+    """検索語がISBN（またはその一部）かどうか"""
+    return bool(ISBN_FRAGMENT_PATTERN.match(query.strip()))
+
+
+def tokenize(value: str):
+    """
+    文字列を検索用のトークンに分割
+    英数字は単語単位、日本語などは2文字ずつのn-gram（MySQLのngramパーサーと同じ考え方）
+    """
+    value = unicodedata.normalize('NFKC', value or '').lower()
+    tokens = WORD_PATTERN.findall(value)
+    for run in CJK_PATTERN.findall(value):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+class SearchBackend:
+    """検索バックエンドの基底クラス"""
+    name = 'base'
+
+    def search(self, db, query: str, limit: int, offset: int = 0) -> SearchResult:
+        query = query.strip()
+        if looks_like_isbn(query):
+            result = self._search_isbn(db, query, limit, offset)
+            if result.total:
+                return result
+        return self._search_text(db, query, limit, offset)
+
+    def _search_isbn(self, db, query, limit, offset):
+        """ISBNの完全一致を優先し、なければ前方一致で検索（books.isbn は正規化して保存されている）"""
+        normalized = normalize_isbn(query)
+        book = db.query(Book).filter(Book.isbn == normalized).first()
+        if book:
+            return SearchResult([book] if offset == 0 else [], 1)
+        prefix_query = db.query(Book).filter(Book.isbn.like(f'{normalized}%'))
+        books = prefix_query.order_by(Book.isbn).offset(offset).limit(limit).all()
+        return SearchResult(books, prefix_query.count())
+
+    def _search_text(self, db, query, limit, offset) -> SearchResult:
+        raise NotImplementedError
+
+    def index_book(self, book):
+        """書籍の追加・更新をインデックスに反映"""
+
+    def remove_book(self, book_id: int):
+        """書籍の削除をインデックスに反映"""
+
+    def reset(self):
+        """一括インポートの後など、インデックスを作り直す必要があるとき"""
+
+
+class MySQLFulltextSearch(SearchBackend):
+    """MySQLのFULLTEXTインデックス（ngramパーサー）を使った検索"""
+    name = 'mysql'
+
+    def _boolean_query(self, query):
+        # 各語を必須（+）かつ前方一致（*）にする
+        terms = BOOLEAN_OPERATORS.sub(' ', query).split()
+        return ' '.join(f'+{term}*' for term in terms)
+
+    def _search_text(self, db, query, limit, offset):
+        against = self._boolean_query(query)
+        if not against:
+            return SearchResult([], 0)
+        relevance = match(Book.title, Book.author, against=against).in_boolean_mode()
+        base = db.query(Book).filter(relevance > 0)
+        books = base.order_by(relevance.desc(), Book.id.desc()).offset(offset).limit(limit).all()
+        total = base.count()
+        return SearchResult(books, total)
+
+
+class InvertedIndexSearch(SearchBackend):
+    """
+    プロセス内の転置インデックスによる検索（SQLite・テスト用）
+    書籍の追加・編集・削除・一括インポートは、どのワーカーで行っても一覧の版番号 catalog
+    （versions.py。書名・著者が変わる更新のときだけ増える）を増やします。
+    検索のたびに版番号だけを読み、構築したときの番号と違えばbooksテーブルから作り直すため、
+    他のワーカーでの変更も次の検索から反映されます（貸出・返却では作り直しません）。
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = {}   # term -> {book_id: weight}
+        self._doc_terms = {}  # book_id -> set(term)
+        self._terms = []      # 前方一致用にソート済みのterm一覧
+        self._built = False
+        self._version = None  # 構築したときの catalog の版番号
+
+    def _ensure_built(self, db):
+        version = collection_version(db, 'catalog')
+        if self._built and self._version == version:
+            return
+        with self._lock:
+            if self._built and self._version == version:
+                return
+            self._clear()
+            rows = db.query(Book.id, Book.title, Book.author).yield_per(10000)
+            for book_id, title, author in rows:
+                self._add(book_id, title, author)
+            self._built = True
+            self._version = version
+
+    def _clear(self):
+        self._postings = {}
+        self._doc_terms = {}
+        self._terms = []
+        self._built = False
+
+    def _add(self, book_id, title, author):
+        weights = {}
+        for term in tokenize(title):
+            weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+        for term in tokenize(author):
+            weights[term] = weights.get(term, 0) + AUTHOR_WEIGHT
+        for term, weight in weights.items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = {}
+                insort(self._terms, term)
+            posting[book_id] = weight
+        self._doc_terms[book_id] = set(weights)
+
+    def _remove(self, book_id):
+        for term in self._doc_terms.pop(book_id, ()):
+            posting = self._postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(book_id, None)
+            if not posting:
+                del self._postings[term]
+                del self._terms[bisect_left(self._terms, term)]
+
+    def _expand(self, token):
+        """前方一致するtermを列挙"""
+        start = bisect_left(self._terms, token)
+        for term in self._terms[start:]:
+            if not term.startswith(token):
+                break
+            yield term
+
+    def ranked_ids(self, query):
+        """検索語に一致する書籍IDを関連度順に返す"""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return []
+        total_docs = max(len(self._doc_terms), 1)
+        scores = None
+        for token in tokens:
+            token_scores = {}
+            for term in self._expand(token):
+                posting = self._postings[term]
+                idf = math.log(1 + total_docs / len(posting))
+                for book_id, weight in posting.items():
+                    token_scores[book_id] = max(token_scores.get(book_id, 0), weight * idf)
+            if scores is None:
+                scores = token_scores
+            else:
+                # すべての語を含む書籍のみ（AND検索）
+                scores = {book_id: score + token_scores[book_id]
+                          for book_id, score in scores.items() if book_id in token_scores}
+            if not scores:
+                return []
+        return sorted(scores, key=lambda book_id: (-scores[book_id], -book_id))
+
+    def _search_text(self, db, query, limit, offset):
+        self._ensure_built(db)
+        with self._lock:
+            ids = self.ranked_ids(query)
+        page_ids = ids[offset:offset + limit]
+        if not page_ids:
+            return SearchResult([], len(ids))
+        books_by_id = {book.id: book for book in db.query(Book).filter(Book.id.in_(page_ids))}
+        books = [books_by_id[book_id] for book_id in page_ids if book_id in books_by_id]
+        return SearchResult(books, len(ids))
+
+    def reset(self):
+        # 次回の検索時にbooksテーブルから構築し直す
+        with self._lock:
+            self._clear()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_search_backend(dialect_name: str) -> SearchBackend:
+    """環境変数SEARCH_BACKENDまたはDBの種類からバックエンドを生成"""
+    name = os.getenv('SEARCH_BACKEND') or ('mysql' if dialect_name == 'mysql' else 'memory')
+    if name == 'mysql':
+        return MySQLFulltextSearch()
+    return InvertedIndexSearch()
+
+
+def get_search_backend() -> SearchBackend:
+    """アプリケーション全体で共有する検索バックエンドを取得"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                from database import engine
+                _backend = create_search_backend(engine.dialect.name)
+    return _backend
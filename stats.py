@@ -0,0 +1,245 @@
+"""
+管理画面ダッシュボードの集計値
+書籍数・ユーザー数・待機中の予約・貸出中・延滞中の件数を library_stats に保持し、
+予約・キャンセル・貸出・返却・書籍管理の各処理と同じトランザクションで増減させます。
+集計値は STATS_SLOTS 行（スロット）に分けて持ち、各処理は1つのスロットだけを更新するため、
+同時に実行される貸出・返却が1行のロックを奪い合いません（表示するときは全スロットを合計します）。
+取りこぼしや手動のデータ修正によるずれは、定期ジョブ（reconcile_stats）が実データから数え直して修正します。
+
+貸出数の推移と人気ランキングは、日別・書籍別の貸出件数（daily_loan_stats）から集計します。
+"""
+
+import os
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select, union_all, update
+
+from activity import adjust_users
+from database import engine
+from models import (Book, DailyLoanStat, LibraryStats, Loan, LoanArchive, LoanStatus, Reservation,
+                    ReservationStatus, User)
+
+STATS_ID = 1
+# 集計値を分けて持つ行数（スロットのIDは 1〜STATS_SLOTS）
+STATS_SLOTS = int(os.getenv('STATS_SLOTS', 16))
+# 再集計のたびに作り直す日別貸出件数の日数
+STATS_RECONCILE_DAYS = int(os.getenv('STATS_RECONCILE_DAYS', 2))
+
+COUNTER_COLUMNS = ('total_books', 'total_users', 'pending_reservations', 'active_loans', 'overdue_loans')
+
+
+def _slot(db) -> int:
+    """
+    更新するスロット（セッション・接続ごとに固定）
+    1つのトランザクションで複数回増減しても同じ行だけをロックするため、スロット同士のデッドロックは起きません。
+    """
+    return db.info.setdefault('stats_slot', random.randint(1, STATS_SLOTS))
+
+
+def adjust(db, **deltas):
+    """
+    集計値を増減（例: adjust(db, active_loans=1, pending_reservations=-1)）
+    呼び出し側のトランザクション内で実行し、コミットは呼び出し側で行います。
+    dbにはSessionとConnectionのどちらも渡せます。
+    """
+    values = {name: getattr(LibraryStats, name) + delta for name, delta in deltas.items() if delta}
+    if not values:
+        return
+    for slot in (_slot(db), STATS_ID):
+        updated = db.execute(
+            update(LibraryStats)
+            .where(LibraryStats.id == slot)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        # スロットの行がまだない場合（STATS_SLOTS を増やした直後）は1番目の行を更新する
+        # （1番目の行もなければ何もしない。最初の再集計で正しい値が入る）
+        if updated or slot == STATS_ID:
+            return
+
+
+def record_loan(db, book_id: int, when=None):
+    """日別・書籍別の貸出件数を1増やす（貸出と同じトランザクションで呼び出す）"""
+    record_loans(db, {book_id: 1}, when)
+
+
+def record_loans(db, counts, when=None):
+    """日別・書籍別の貸出件数を書籍ごとにまとめて増やす（counts: 書籍ID -> 件数）"""
+    if not counts:
+        return
+    day = (when or datetime.utcnow()).date()
+    rows = [{'day': day, 'book_id': book_id, 'loans': count} for book_id, count in counts.items()]
+    if db.get_bind().dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as upsert
+        stmt = upsert(DailyLoanStat).values(rows)
+        stmt = stmt.on_duplicate_key_update(loans=DailyLoanStat.loans + stmt.inserted.loans)
+    else:
+        from sqlalchemy.dialects.sqlite import insert as upsert
+        stmt = upsert(DailyLoanStat).values(rows)
+        stmt = stmt.on_conflict_do_update(index_elements=['day', 'book_id'],
+                                          set_={'loans': DailyLoanStat.loans + stmt.excluded.loans})
+    db.execute(stmt)
+
+
+def forget_book(db, book_id: int):
+    """書籍の削除時に、一緒に削除される予約・貸出の分を集計値（全体・利用者ごと）から引く"""
+    reservations = db.execute(
+        select(Reservation.user_id, Reservation.status, func.count(Reservation.id))
+        .where(Reservation.book_id == book_id,
+               Reservation.status.in_([ReservationStatus.PENDING, ReservationStatus.WAITING]))
+        .group_by(Reservation.user_id, Reservation.status)
+    ).all()
+    loans = db.execute(
+        select(Loan.user_id, Loan.status, func.count(Loan.id))
+        .where(Loan.book_id == book_id, Loan.status.in_([LoanStatus.ACTIVE, LoanStatus.OVERDUE]))
+        .group_by(Loan.user_id, Loan.status)
+    ).all()
+
+    def by_user(rows, status):
+        return {user_id: count for user_id, row_status, count in rows if row_status == status}
+
+    pending = by_user(reservations, ReservationStatus.PENDING)
+    active, overdue = by_user(loans, LoanStatus.ACTIVE), by_user(loans, LoanStatus.OVERDUE)
+    adjust(db, total_books=-1, pending_reservations=-sum(pending.values()),
+           active_loans=-sum(active.values()), overdue_loans=-sum(overdue.values()))
+    adjust_users(db, pending, False, pending_reservations=-1)
+    adjust_users(db, by_user(reservations, ReservationStatus.WAITING), False, waiting_reservations=-1)
+    adjust_users(db, active, False, active_loans=-1)
+    adjust_users(db, overdue, False, overdue_loans=-1)
+
+
+# ==================== 再集計 ====================
+
+def _actual_counts():
+    """実データから数え直す式（各状態の件数は status 先頭のインデックスで数える）"""
+    def count(column, *conditions):
+        return select(func.count(column)).where(*conditions).scalar_subquery()
+
+    return {
+        'total_books': count(Book.id),
+        'total_users': count(User.id),
+        'pending_reservations': count(Reservation.id, Reservation.status == ReservationStatus.PENDING),
+        'active_loans': count(Loan.id, Loan.status == LoanStatus.ACTIVE),
+        'overdue_loans': count(Loan.id, Loan.status == LoanStatus.OVERDUE),
+    }
+
+
+def _totals():
+    """全スロットの合計の式"""
+    return [func.sum(getattr(LibraryStats, name)).label(name) for name in COUNTER_COLUMNS]
+
+
+def rebuild_daily_loans(conn, days: int):
+    """直近days日分の日別貸出件数を貸出テーブル（アーカイブに移動した分を含む）から作り直す"""
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    start = datetime.combine(since, datetime.min.time())
+    conn.execute(delete(DailyLoanStat).where(DailyLoanStat.day >= since))
+    loans = union_all(*[
+        select(model.loan_date, model.book_id).where(model.loan_date >= start)
+        for model in (Loan, LoanArchive)
+    ]).subquery()
+    loan_day = func.date(loans.c.loan_date)
+    conn.execute(insert(DailyLoanStat).from_select(
+        ['day', 'book_id', 'loans'],
+        select(loan_day, loans.c.book_id, func.count())
+        .group_by(loan_day, loans.c.book_id)
+    ))
+
+
+class ReconcileReport:
+    """再集計の結果（driftは修正した差分の合計）"""
+    def __init__(self, before, after):
+        self.before = before
+        self.after = after
+        self.drift = sum(abs(after[name] - (before or {}).get(name, 0)) for name in COUNTER_COLUMNS)
+
+    def changes(self):
+        before = self.before or {}
+        return {name: (before.get(name), value) for name, value in self.after.items()
+                if before.get(name) != value}
+
+    def __str__(self):
+        changes = ', '.join(f'{name}: {old} -> {new}' for name, (old, new) in self.changes().items())
+        return f'ずれ {self.drift} 件' + (f' ({changes})' if changes else '')
+
+
+def reconcile_stats(bind=None, days=None) -> ReconcileReport:
+    """
+    集計値を実データから数え直して修正
+    MySQLでは READ COMMITTED で実行し、件数の読み取りや日別件数の INSERT ... SELECT が
+    貸出・予約の行をロックして、実行中の貸出・返却を待たせないようにします。
+    """
+    bind = bind or engine
+    if bind.dialect.name == 'mysql':
+        with bind.connect().execution_options(isolation_level='READ COMMITTED') as conn, conn.begin():
+            return reconcile_counts(conn, days)
+    with bind.begin() as conn:
+        return reconcile_counts(conn, days)
+
+
+def reconcile_counts(conn, days=None) -> ReconcileReport:
+    """
+    実行中のトランザクション（conn）で集計値を数え直す（スロットの行がなければ作成）
+    実データの件数と全スロットの合計を1回の（ロックしない）SELECTで同時に読み、その差分だけを1番目のスロットに足します。
+    読み取りの後にコミットされた貸出・返却の増減は各スロットにそのまま残るため、数え直しと同時に実行されても取りこぼしません。
+    """
+    actual = _actual_counts()
+    row = conn.execute(select(*[actual[name].label(name) for name in COUNTER_COLUMNS], *_totals(),
+                              func.count(LibraryStats.id))).first()
+    counts = dict(zip(COUNTER_COLUMNS, row[:len(COUNTER_COLUMNS)]))
+    before = None if not row[-1] else dict(zip(COUNTER_COLUMNS, row[len(COUNTER_COLUMNS):-1]))
+
+    existing = set(conn.execute(select(LibraryStats.id)).scalars())
+    missing = [slot for slot in range(1, STATS_SLOTS + 1) if slot not in existing]
+    if missing:
+        conn.execute(insert(LibraryStats), [{'id': slot, **dict.fromkeys(COUNTER_COLUMNS, 0)} for slot in missing])
+    conn.execute(
+        update(LibraryStats)
+        .where(LibraryStats.id == STATS_ID)
+        .values(reconciled_at=datetime.utcnow(),
+                **{name: getattr(LibraryStats, name) + counts[name] - (before or {}).get(name, 0)
+                   for name in COUNTER_COLUMNS})
+    )
+    rebuild_daily_loans(conn, days or STATS_RECONCILE_DAYS)
+    return ReconcileReport(before, counts)
+
+
+# ==================== 参照 ====================
+
+def get_stats(db) -> LibraryStats:
+    """
+    全スロットを合計した集計値（保存しない LibraryStats として返す）
+    通常はマイグレーションで作成済み。削除された場合のみここで作成します。
+    """
+    row = db.execute(select(*_totals(), func.max(LibraryStats.reconciled_at))).first()
+    if row[0] is None:
+        reconcile_stats(bind=db.get_bind())
+        row = db.execute(select(*_totals(), func.max(LibraryStats.reconciled_at))).first()
+    return LibraryStats(id=STATS_ID, reconciled_at=row[-1], **dict(zip(COUNTER_COLUMNS, row[:-1])))
+
+
+def loans_per_day(db, days=14):
+    """直近days日の日別貸出件数（貸出のない日は0件）を古い順に返す"""
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    loans = dict(db.execute(
+        select(DailyLoanStat.day, func.sum(DailyLoanStat.loans))
+        .where(DailyLoanStat.day >= since)
+        .group_by(DailyLoanStat.day)
+    ).all())
+    days = [since + timedelta(days=i) for i in range(days)]
+    return [(day, int(loans.get(day) or 0)) for day in days]
+
+
+def top_borrowed(db, days=30, limit=5):
+    """直近days日でよく貸し出された書籍（書籍, 貸出件数）"""
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    total = func.sum(DailyLoanStat.loans).label('loans')
+    return db.execute(
+        select(Book.id, Book.title, Book.author, total)
+        .join(DailyLoanStat, DailyLoanStat.book_id == Book.id)
+        .where(DailyLoanStat.day >= since)
+        .group_by(Book.id, Book.title, Book.author)
+        .order_by(total.desc(), Book.id)
+        .limit(limit)
+    ).all()
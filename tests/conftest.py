@@ -0,0 +1,142 @@
+"""
+テストの共通設定
+一時ディレクトリのSQLiteに benchmarks/datagen.py で偏りのあるデータを作成し、アプリを testing モードで読み込みます
+（testing モードでは query_budget の上限を超えると AssertionError になります）。
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+# アプリの読み込み前に設定する
+os.environ['DATABASE_URL'] = f'sqlite:///{tempfile.mkdtemp()}/test.db'
+os.environ['ENABLE_SCHEDULER'] = 'false'
+os.environ['AUTO_MIGRATE'] = 'true'
+os.environ['PASSWORD_HASH_WORKERS'] = '0'
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+os.environ.pop('DATABASE_REPLICA_URLS', None)
+
+# 一覧の1ページ（50件）より多くなる件数（N+1クエリがあればクエリ数が行数に比例して増える）
+BOOKS = 200
+USERS = 30
+LOANS = 1500
+RESERVATIONS = 800
+# この日数より古い貸出・予約はアーカイブに移動し、一覧が現行とアーカイブの両方を読むようにする
+ARCHIVE_AFTER_DAYS = 60
+
+
+@pytest.fixture(scope='session')
+def dataset():
+    import datagen
+    from archive import archive_history
+    from database import engine
+    data = datagen.generate(engine, books=BOOKS, users=USERS, loans=LOANS, reservations=RESERVATIONS, seed=2,
+                            log=lambda message: None)
+    archive_history(older_than_days=ARCHIVE_AFTER_DAYS, pause=0)
+    return data
+
+
+@pytest.fixture(scope='session')
+def app(dataset):
+    from app import app
+    app.config['TESTING'] = True
+    return app
+
+
+def _login(app, username, password):
+    client = app.test_client()
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code == 302, f'{username} でログインできませんでした。'
+    return client
+
+
+@pytest.fixture
+def admin_client(app):
+    return _login(app, 'admin', 'admin123')
+
+
+@pytest.fixture
+def user_client(app, dataset):
+    # 貸出・予約の最も多い利用者
+    import datagen
+    return _login(app, dataset.users[0], datagen.USER_PASSWORD)
+
+
+@pytest.fixture
+def anonymous_client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def cold_cache():
+    """書籍・ログインユーザー・件数のキャッシュを空にする（キャッシュに載っていない最初のアクセスを再現）"""
+    import auth
+    from cache import cache
+    from pagination import count_cache
+    cache.clear()
+    auth.identity_cache.clear()
+    count_cache.invalidate()
+
+
+@pytest.fixture
+def db(app):
+    from database import SessionLocal
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+_created = {'users': 0, 'books': 0}
+
+
+@pytest.fixture
+def make_user(db):
+    """テスト専用の利用者を作成する（パスワードは datagen.USER_PASSWORD）"""
+    import datagen
+    from werkzeug.security import generate_password_hash
+    from models import User, UserActivity, UserRole
+    from passwords import PASSWORD_HASH_METHOD
+    from stats import adjust
+
+    def make(role=UserRole.USER):
+        _created['users'] += 1
+        name = f'test{_created["users"]}'
+        user = User(username=name, email=f'{name}@example.com', role=role, activity=UserActivity(),
+                    password_hash=generate_password_hash(datagen.USER_PASSWORD, method=PASSWORD_HASH_METHOD))
+        db.add(user)
+        adjust(db, total_users=1)
+        db.commit()
+        return user
+    return make
+
+
+@pytest.fixture
+def make_book(db):
+    """テスト専用の書籍を作成する（他のテストのデータと在庫を共有しない）"""
+    from models import Book
+    from stats import adjust
+    from versions import touch
+
+    def make(copies=1):
+        _created['books'] += 1
+        book = Book(title=f'テスト書籍{_created["books"]}', author='テスト', total_copies=copies,
+                    available_copies=copies)
+        db.add(book)
+        adjust(db, total_books=1)
+        touch(db, 'books', 'catalog')
+        db.commit()
+        return book
+    return make
+
+
+@pytest.fixture
+def login(app):
+    """利用者としてログインしたクライアントを返す"""
+    import datagen
+    return lambda user: _login(app, user.username, datagen.USER_PASSWORD)
@@ -0,0 +1,90 @@
+"""
+JSON API（api.py）のテスト
+ETagと条件付きGET（If-None-Match が一致すれば304）、貸出・返却でETagが変わること、
+一括処理のエンドポイントが管理者以外を拒否することを確認します。
+"""
+
+import pytest
+
+from database import assert_max_queries
+from models import Loan, Reservation, UserRole
+
+
+@pytest.fixture
+def admin(make_user, login):
+    return login(make_user(role=UserRole.ADMIN))
+
+
+def _etag(client, url, **kwargs):
+    response = client.get(url, **kwargs)
+    assert response.status_code == 200
+    assert response.headers.get('ETag'), f'{url} にETagがありません。'
+    return response.headers['ETag']
+
+
+def _loan(db, client, admin, book, user):
+    """利用者の予約を一括貸出のAPIで貸し出し、貸出IDを返す"""
+    assert client.post(f'/books/{book.id}/reserve').status_code == 302
+    reservation = db.query(Reservation).filter_by(user_id=user.id, book_id=book.id).one()
+    response = admin.post('/api/v1/circulation/checkouts', json={'reservation_ids': [reservation.id]})
+    assert response.status_code == 200
+    assert response.get_json()['results'][0]['status'] == 'ok'
+    return db.query(Loan.id).filter_by(reservation_id=reservation.id).scalar()
+
+
+def _return(admin, loan_id):
+    response = admin.post('/api/v1/circulation/returns', json={'loan_ids': [loan_id]})
+    assert response.status_code == 200
+    assert response.get_json()['results'][0]['status'] == 'ok'
+
+
+@pytest.mark.parametrize('url', ['/api/v1/books', '/api/v1/books/{book_id}'])
+def test_if_none_match_returns_not_modified(anonymous_client, make_book, url):
+    url = url.format(book_id=make_book().id)
+    etag = _etag(anonymous_client, url)
+    # 版番号だけを読み、行データは読まない
+    with assert_max_queries(1):
+        response = anonymous_client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert not response.get_data()
+
+
+@pytest.mark.parametrize('url', ['/api/v1/reservations', '/api/v1/loans'])
+def test_own_lists_revalidate_per_user(make_user, login, url):
+    client = login(make_user())
+    etag = _etag(client, url)
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    # 同じURLでも利用者が違えば内容が違うため、ETagも違う
+    assert _etag(login(make_user()), url) != etag
+
+
+def test_etags_change_after_loan_and_return(db, make_user, make_book, login, admin):
+    user, book = make_user(), make_book()
+    client = login(user)
+    urls = ['/api/v1/books', f'/api/v1/books/{book.id}', '/api/v1/loans']
+    before = [_etag(client, url) for url in urls]
+
+    loan_id = _loan(db, client, admin, book, user)
+    loaned = [_etag(client, url) for url in urls]
+    for url, old, new in zip(urls, before, loaned):
+        assert old != new, f'貸出後も {url} のETagが変わっていません。'
+        assert client.get(url, headers={'If-None-Match': old}).status_code == 200
+    assert client.get(f'/api/v1/books/{book.id}').get_json()['available_copies'] == 0
+
+    _return(admin, loan_id)
+    returned = [_etag(client, url) for url in urls]
+    for url, old, new in zip(urls, loaned, returned):
+        assert old != new, f'返却後も {url} のETagが変わっていません。'
+    assert client.get(f'/api/v1/books/{book.id}').get_json()['available_copies'] == 1
+
+
+@pytest.mark.parametrize('url, payload', [
+    ('/api/v1/circulation/checkouts', {'reservation_ids': [1]}),
+    ('/api/v1/circulation/returns', {'loan_ids': [1]}),
+])
+def test_batch_endpoints_require_admin(anonymous_client, user_client, url, payload):
+    response = user_client.post(url, json=payload)
+    assert response.status_code == 403
+    assert 'error' in response.get_json()
+    assert anonymous_client.post(url, json=payload).status_code == 401
@@ -0,0 +1,51 @@
+"""
+履歴のアーカイブ（archive.py）とエクスポート（exports.py）のテスト
+バッチ数の上限が対象（貸出・予約）ごとに適用されること、エクスポートの途中で行がアーカイブへ移動しても
+同じ行を2回出力したり読み飛ばしたりしないことを確認します。
+"""
+
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import select, union_all
+
+from archive import archive_history
+from exports import EXPORTS, ExportFilter, iter_rows
+from models import Loan, LoanArchive, LoanStatus, Reservation, ReservationStatus
+
+
+def test_max_batches_applies_per_target(db, make_user, make_book):
+    user, book = make_user(), make_book()
+    old = datetime.utcnow() - timedelta(days=100)
+    for _ in range(6):
+        db.add(Loan(user_id=user.id, book_id=book.id, loan_date=old, due_date=old, return_date=old,
+                    status=LoanStatus.RETURNED))
+        db.add(Reservation(user_id=user.id, book_id=book.id, reservation_date=old, expiry_date=old,
+                           status=ReservationStatus.CANCELLED))
+    db.commit()
+
+    report = archive_history(older_than_days=90, batch_size=3, max_batches=1, pause=0)
+    # 貸出で上限に達しても、予約も同じ回数だけ移動する
+    assert report.moved == {'loans': 3, 'reservations': 3}
+    assert report.batches == 2
+
+
+def _loan_ids(db):
+    db.expire_all()
+    return set(db.execute(union_all(select(Loan.id), select(LoanArchive.id))).scalars())
+
+
+# 期間指定なし（id順）と期間指定あり（日付順）。移動する行が残るよう、それぞれ別の日数より古い行を移動する
+@pytest.mark.parametrize('export_filter, archive_days', [
+    (ExportFilter(), 45),
+    (ExportFilter(start=date(2000, 1, 1)), 25),
+], ids=['by-id', 'by-date'])
+def test_export_during_archive_has_each_row_once(db, export_filter, archive_days):
+    rows = iter_rows(EXPORTS['loans'], export_filter, chunk_size=100)
+    exported = [next(rows)[0] for _ in range(150)]
+    # 2チャンク目の途中で、まだ出力していない行と出力済みの行の両方をアーカイブへ移動する
+    assert archive_history(older_than_days=archive_days, pause=0).rows > 0
+    exported += [row[0] for row in rows]
+
+    assert len(exported) == len(set(exported))
+    assert set(exported) == _loan_ids(db)
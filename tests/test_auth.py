@@ -0,0 +1,82 @@
+"""
+ログインユーザーのキャッシュのテスト
+キャッシュにあればDBを読まないこと、役割・パスワードの変更が次のリクエストから反映されることを確認します。
+"""
+
+import pytest
+
+import auth
+from cache import RedisCache
+from database import count_queries
+from models import User, UserRole
+
+
+class FakeRedis:
+    """RedisCache が使う get/set/delete/mget だけを持つ、プロセス内のRedisの代わり"""
+    def __init__(self):
+        self.values = {}
+
+    def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.values.pop(key, None) is not None)
+
+
+@pytest.fixture
+def shared_cache(monkeypatch):
+    """全ワーカーで共有するキャッシュ（CACHE_BACKEND=redis）を使う"""
+    shared = RedisCache(FakeRedis())
+    monkeypatch.setattr(auth, 'cache', shared)
+    return shared
+
+
+def test_cached_login_reads_nothing(app, make_user, login):
+    client = login(make_user())
+    client.get('/loans')
+    with count_queries() as counter:
+        response = client.get('/logout')
+    assert response.status_code == 302
+    assert not any('FROM users' in statement for statement in counter.statements)
+
+
+def test_demotion_applies_to_next_request(app, db, make_user, login, shared_cache):
+    admin = make_user(UserRole.ADMIN)
+    client = login(admin)
+    assert client.get('/admin').status_code == 200
+    # 別のワーカーで降格された（このワーカーのキャッシュは使わず、共有するキャッシュからの削除だけで反映される）
+    auth.identity_cache.clear()
+    admin.role = UserRole.USER
+    db.commit()
+    response = client.get('/admin')
+    assert response.status_code == 302
+    assert '/login' in response.headers['Location']
+
+
+def test_local_cache_ttl_is_short():
+    # 共有するキャッシュがない場合、他のワーカーでの変更が反映されない時間は IDENTITY_CACHE_LOCAL_TTL 秒まで
+    store, ttl = auth._identity_store()
+    assert store is auth.identity_cache
+    assert ttl <= auth.IDENTITY_CACHE_LOCAL_TTL
+
+
+def test_password_change_invalidates_shared_cache(app, db, make_user, login, shared_cache):
+    user = make_user()
+    login(user).get('/loans')
+    key = f'login:{user.id}'
+    assert shared_cache.get(key) is not None
+    user.password_hash = user.password_hash + 'x'
+    db.commit()
+    assert shared_cache.get(key) is None
+    assert db.get(User, user.id).auth_version == 2
+
+
+def test_session_id_without_version_rejected(app, make_user):
+    user = make_user()
+    with app.test_request_context():
+        from app import load_user
+        assert load_user(str(user.id)) is None
+        assert load_user(f'{user.id}:{user.auth_version}').id == user.id
@@ -0,0 +1,37 @@
+"""
+書籍カタログのキャッシュ（cache.py）のテスト
+ワーカー間で共有しないキャッシュを複数ワーカーで使う場合に、在庫状況の有効期間が数秒に抑えられることを確認します。
+"""
+
+import pytest
+
+import cache
+from cache import LRUCache
+
+
+class RecordingCache(LRUCache):
+    """格納した有効期間を記録する"""
+    def __init__(self, shared):
+        super().__init__()
+        self.shared = shared
+        self.ttls = {}
+
+    def set(self, key, value, ttl=None):
+        self.ttls[key] = ttl
+        super().set(key, value, ttl)
+
+
+@pytest.mark.parametrize('workers, shared, expected', [
+    (1, False, cache.AVAILABILITY_TTL),
+    (4, False, min(cache.AVAILABILITY_TTL, cache.LOCAL_AVAILABILITY_TTL)),
+    (4, True, cache.AVAILABILITY_TTL),
+])
+def test_availability_ttl_depends_on_workers(monkeypatch, db, make_book, workers, shared, expected):
+    backend = RecordingCache(shared)
+    monkeypatch.setattr(cache, 'cache', backend)
+    monkeypatch.setattr(cache, 'WEB_WORKERS', workers)
+    book = make_book()
+    cache.get_book(db, book.id)
+    assert backend.ttls[f'availability:{book.id}'] == expected
+    assert backend.ttls[f'book:{book.id}'] is None
+
@@ -0,0 +1,73 @@
+"""
+貸出の一括処理（circulation.py）のテスト
+作成した貸出のIDが予約と正しく対応すること、利用者ごとの貸出の上限を1件ずつの貸出と同じく確認することを確認します。
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import activity
+import circulation
+from activity import adjust_user
+from database import engine
+from models import Loan, LoanStatus, Reservation, ReservationStatus
+from stats import adjust
+
+
+@pytest.fixture
+def reserve(db):
+    """待機中の予約を作成する（集計値も予約と同じように増やす）"""
+    def make(user, book):
+        reservation = Reservation(user_id=user.id, book_id=book.id, status=ReservationStatus.PENDING,
+                                  expiry_date=datetime.utcnow() + timedelta(days=3))
+        db.add(reservation)
+        adjust(db, pending_reservations=1)
+        adjust_user(db, user.id, pending_reservations=1)
+        db.commit()
+        return reservation
+    return make
+
+
+@pytest.mark.parametrize('returning', [True, False], ids=['returning', 'reselect'])
+def test_checkout_returns_created_loan_ids(monkeypatch, db, make_user, make_book, reserve, returning):
+    if not returning:
+        # RETURNING を複数行のINSERTで使えないMySQLと同じ経路（予約IDで読み直す）
+        monkeypatch.setattr(engine.dialect, 'insert_executemany_returning_sort_by_parameter_order', False)
+    user = make_user()
+    books = [make_book() for _ in range(3)]
+    # 同じ利用者・書籍・秒の既存の貸出（貸出日時で読み直すとこちらと取り違える）
+    now = datetime.utcnow().replace(microsecond=0)
+    old = Loan(user_id=user.id, book_id=books[0].id, loan_date=now, due_date=now, status=LoanStatus.RETURNED)
+    db.add(old)
+    db.commit()
+    reservations = [reserve(user, book) for book in books]
+    result = circulation.checkout_reservations(db, [r.id for r in reversed(reservations)])
+    assert [item['status'] for item in result.items] == ['ok'] * 3
+    for item in result.items:
+        loan = db.get(Loan, item['loan_id'])
+        assert loan.id != old.id
+        assert loan.reservation_id == item['reservation_id']
+        assert loan.status == LoanStatus.ACTIVE
+
+
+def test_checkout_applies_loan_limit(monkeypatch, db, make_user, make_book, reserve):
+    monkeypatch.setattr(activity, 'MAX_LOANS', 2)
+    user, other = make_user(), make_user()
+    reservations = [reserve(user, make_book()) for _ in range(3)] + [reserve(other, make_book())]
+    result = circulation.checkout_reservations(db, [r.id for r in reservations])
+    assert [item['status'] for item in result.items] == ['ok', 'ok', 'limit', 'ok']
+    assert db.get(Reservation, reservations[2].id).status == ReservationStatus.PENDING
+    assert activity.get_activity(db, user.id).active_loans == 2
+
+
+def test_single_loan_applies_same_limit(monkeypatch, app, db, make_user, make_book, reserve, admin_client):
+    monkeypatch.setattr(activity, 'MAX_LOANS', 1)
+    user = make_user()
+    first, second = reserve(user, make_book()), reserve(user, make_book())
+    admin_client.post(f'/reservations/{first.id}/loan')
+    response = admin_client.post(f'/reservations/{second.id}/loan', follow_redirects=True)
+    assert '上限' in response.get_data(as_text=True)
+    db.expire_all()
+    assert db.get(Reservation, second.id).status == ReservationStatus.PENDING
+    assert activity.get_activity(db, user.id).active_loans == 1
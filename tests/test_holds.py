@@ -0,0 +1,152 @@
+"""
+順番待ち（holds.py）のテスト
+予約・キャンセル・貸出・返却の各ルートと期限切れ処理を通して、FIFOでの繰り上げ、書籍の先頭・末尾の位置、
+繰り上げで確保した1冊の扱い（利用可能冊数には戻さず次の順番待ちに回す）を確認します。
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import update
+
+from models import Book, Loan, LoanStatus, Reservation, ReservationStatus, UserRole
+
+PENDING, WAITING = ReservationStatus.PENDING, ReservationStatus.WAITING
+CONFIRMED, CANCELLED, EXPIRED = ReservationStatus.CONFIRMED, ReservationStatus.CANCELLED, ReservationStatus.EXPIRED
+
+
+@pytest.fixture
+def admin(make_user, login):
+    return login(make_user(role=UserRole.ADMIN))
+
+
+@pytest.fixture
+def queue(db, make_user, make_book, login, admin):
+    """在庫1冊の書籍を先頭の利用者に貸し出し、残りの利用者が順番待ちに並んだ状態を作る"""
+    def make(waiting):
+        book = make_book(copies=1)
+        users = [make_user() for _ in range(waiting + 1)]
+        clients = [login(user) for user in users]
+        assert clients[0].post(f'/books/{book.id}/reserve').status_code == 302
+        _check_out(db, admin, _reservations(db, book)[users[0].id])
+        for client in clients[1:]:
+            assert client.post(f'/books/{book.id}/reserve').status_code == 302
+        return book, users, clients
+    return make
+
+
+def _reservations(db, book):
+    db.expire_all()
+    rows = db.query(Reservation).filter(Reservation.book_id == book.id).all()
+    return {row.user_id: row for row in rows}
+
+
+def _statuses(db, book, users):
+    reservations = _reservations(db, book)
+    return [reservations[user.id].status for user in users]
+
+
+def _counters(db, book):
+    """利用可能冊数・順番待ちの先頭と末尾の位置"""
+    db.expire_all()
+    book = db.get(Book, book.id)
+    return book.available_copies, book.hold_queue_head, book.hold_queue_tail
+
+
+def _check_out(db, admin, reservation):
+    assert admin.post(f'/reservations/{reservation.id}/loan').status_code == 302
+    return db.query(Loan).filter_by(reservation_id=reservation.id).one()
+
+
+def _return(db, admin, user):
+    loan = db.query(Loan).filter_by(user_id=user.id, status=LoanStatus.ACTIVE).one()
+    assert admin.post(f'/loans/{loan.id}/return').status_code == 302
+
+
+def _cancel(client, reservation):
+    assert client.post(f'/reservations/{reservation.id}/cancel').status_code == 302
+
+
+def test_waiting_reservations_get_fifo_positions(db, queue):
+    book, users, _ = queue(3)
+    reservations = _reservations(db, book)
+    assert _statuses(db, book, users) == [CONFIRMED, WAITING, WAITING, WAITING]
+    assert [reservations[user.id].queue_position for user in users[1:]] == [1, 2, 3]
+    assert [reservations[user.id].hold_position() for user in users[1:]] == [1, 2, 3]
+    assert _counters(db, book) == (0, 0, 3)
+
+
+def test_return_promotes_waiters_in_order(db, queue, admin):
+    book, users, _ = queue(3)
+    _return(db, admin, users[0])
+    assert _statuses(db, book, users)[1:] == [PENDING, WAITING, WAITING]
+    # 返却された1冊は繰り上げた予約が確保するため、利用可能冊数には戻らない
+    assert _counters(db, book) == (0, 1, 3)
+    assert _reservations(db, book)[users[2].id].hold_position() == 1
+
+    _check_out(db, admin, _reservations(db, book)[users[1].id])
+    _return(db, admin, users[1])
+    assert _statuses(db, book, users)[2:] == [PENDING, WAITING]
+    assert _counters(db, book) == (0, 2, 3)
+
+
+def test_promoted_reservation_checks_out_without_taking_stock(db, queue, admin):
+    book, users, _ = queue(1)
+    _return(db, admin, users[0])
+    promoted = _reservations(db, book)[users[1].id]
+    assert promoted.status == PENDING and promoted.expiry_date > datetime.utcnow()
+    assert admin.post(f'/reservations/{promoted.id}/loan').status_code == 302
+    assert _statuses(db, book, users)[1] == CONFIRMED
+    assert _counters(db, book)[0] == 0
+
+
+def test_cancelling_held_copy_promotes_next_waiter(db, queue, admin):
+    book, users, clients = queue(2)
+    _return(db, admin, users[0])
+    _cancel(clients[1], _reservations(db, book)[users[1].id])
+    assert _statuses(db, book, users)[1:] == [CANCELLED, PENDING]
+    assert _counters(db, book) == (0, 2, 2)
+
+
+def test_cancelling_last_held_copy_returns_it_to_stock(db, queue, admin):
+    book, users, clients = queue(1)
+    _return(db, admin, users[0])
+    _cancel(clients[1], _reservations(db, book)[users[1].id])
+    assert _statuses(db, book, users)[1] == CANCELLED
+    assert _counters(db, book) == (1, 1, 1)
+
+
+def test_cancelling_waiter_keeps_copy_and_is_skipped(db, queue, admin):
+    book, users, clients = queue(3)
+    _cancel(clients[1], _reservations(db, book)[users[1].id])
+    # 順番待ちのキャンセルでは在庫も先頭の位置も変わらない
+    assert _statuses(db, book, users) == [CONFIRMED, CANCELLED, WAITING, WAITING]
+    assert _counters(db, book) == (0, 0, 3)
+
+    _return(db, admin, users[0])
+    assert _statuses(db, book, users)[1:] == [CANCELLED, PENDING, WAITING]
+    assert _counters(db, book) == (0, 2, 3)
+
+
+def test_cancelling_every_waiter_realigns_head_on_return(db, queue, admin):
+    book, users, clients = queue(2)
+    for index in (1, 2):
+        _cancel(clients[index], _reservations(db, book)[users[index].id])
+    _return(db, admin, users[0])
+    assert _counters(db, book) == (1, 2, 2)
+
+
+def test_expiry_hands_held_copy_to_next_waiter(db, queue, admin):
+    from database import engine
+    from jobs import expire_reservations
+
+    book, users, _ = queue(2)
+    _return(db, admin, users[0])
+    promoted = _reservations(db, book)[users[1].id]
+    db.execute(update(Reservation).where(Reservation.id == promoted.id)
+               .values(expiry_date=datetime.utcnow() - timedelta(minutes=1)))
+    db.commit()
+
+    expire_reservations(bind=engine)
+    assert _statuses(db, book, users)[1:] == [EXPIRED, PENDING]
+    assert _counters(db, book) == (0, 2, 2)
@@ -0,0 +1,84 @@
+"""
+一括インポート（importer.py）のテスト
+途中で中断したインポートを読み込み位置（バイト単位）から再開しても書籍が重複しないこと、
+ISBNのない行を含むファイルを再度取り込んでも重複しないことを確認します。
+"""
+
+import csv
+import itertools
+
+import pytest
+from sqlalchemy import func
+
+import importer
+from bench_import import make_isbn
+from models import Book, ImportJob, ImportStatus
+
+ROWS = 25
+BATCH_SIZE = 4
+# テストごとに別のISBNを使う（datagen の書籍のISBNとも重ならない番号）
+_isbn_offsets = itertools.count(900000, ROWS)
+
+
+class Interrupted(Exception):
+    """インポートの途中停止（プロセスの停止の代わり）"""
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    """ISBNのある行とない行が混ざったCSV（ISBNのない行は同じファイル内でも1件重複する）"""
+    path = tmp_path / 'books.csv'
+    offset = next(_isbn_offsets)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['title', 'author', 'isbn', 'publisher', 'total_copies'])
+        for i in range(ROWS):
+            isbn = make_isbn(offset + i) if i % 3 else ''
+            writer.writerow([f'インポート書籍{tmp_path.name}-{i}', 'インポート著者', isbn, '出版社', 2])
+        writer.writerow([f'インポート書籍{tmp_path.name}-0', 'インポート著者', '', '別の出版社', 2])
+    return str(path)
+
+
+def _books(db, path):
+    prefix = f'インポート書籍{path.split("/")[-2]}-'
+    db.expire_all()
+    return db.query(func.count(Book.id)).filter(Book.title.startswith(prefix)).scalar()
+
+
+def test_resume_after_interruption_does_not_duplicate(db, catalog):
+    job_id = importer.create_job(catalog)
+
+    def stop_after_second_batch(report, percent):
+        if report.rows >= BATCH_SIZE * 2:
+            raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        importer.run_import(job_id, batch_size=BATCH_SIZE, progress=stop_after_second_batch)
+    job = db.get(ImportJob, job_id)
+    assert job.status == ImportStatus.FAILED
+    assert 0 < job.position < job.file_size
+    assert _books(db, catalog) == BATCH_SIZE * 2
+
+    assert importer.find_resumable_job(catalog) == job_id
+    importer.run_import(job_id, batch_size=BATCH_SIZE)
+    db.expire_all()
+    job = db.get(ImportJob, job_id)
+    assert job.status == ImportStatus.COMPLETED
+    assert job.position == job.file_size
+    assert job.rows_read == ROWS + 1
+    assert _books(db, catalog) == ROWS
+
+
+def test_reimport_updates_rows_without_isbn(db, catalog):
+    first = importer.run_import(importer.create_job(catalog), batch_size=BATCH_SIZE)
+    # ファイルの末尾の重複行は別のバッチのため、先に登録した行の更新になる
+    assert (first.inserted, first.updated) == (ROWS, 1)
+    second = importer.run_import(importer.create_job(catalog), batch_size=BATCH_SIZE)
+    assert (second.inserted, second.updated) == (0, ROWS + 1)
+    assert _books(db, catalog) == ROWS
+
+    # 書誌情報は更新し、冊数・在庫は変更しない
+    book = db.query(Book).filter_by(title=f'インポート書籍{catalog.split("/")[-2]}-0').one()
+    assert book.isbn is None
+    assert book.publisher == '別の出版社'
+    assert (book.total_copies, book.available_copies) == (2, 2)
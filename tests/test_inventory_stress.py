@@ -0,0 +1,84 @@
+"""
+在庫更新のストレステスト
+1冊の書籍に対して複数のスレッドから予約・キャンセル・貸出・返却を同時に実行し、
+利用可能冊数が 総冊数 - 貸出中の件数 - 繰り上げで確保した予約の件数 と一致することを確認します。
+"""
+
+import random
+import threading
+
+from sqlalchemy import func
+
+from models import Book, Loan, LoanStatus, Reservation, ReservationStatus, UserRole
+
+THREADS = 8
+OPERATIONS = 25
+COPIES = 3
+
+
+def _pick(db, model, *conditions):
+    return db.query(model.id).filter(*conditions).order_by(model.id).limit(1).scalar()
+
+
+def test_concurrent_circulation_keeps_inventory(app, db, make_user, make_book, login):
+    from database import SessionLocal
+
+    book_id = make_book(copies=COPIES).id
+    # スレッドごとに利用者と、貸出・返却を行う管理者のクライアントを用意する
+    users = [make_user() for _ in range(THREADS)]
+    clients = [(user.id, login(user), login(make_user(role=UserRole.ADMIN))) for user in users]
+    errors = []
+
+    def worker(seed, user_id, user_client, admin_client):
+        rng = random.Random(seed)
+        session = SessionLocal()
+        try:
+            for _ in range(OPERATIONS):
+                session.rollback()
+                operation = rng.choice(('reserve', 'cancel', 'loan', 'return'))
+                if operation == 'reserve':
+                    response = user_client.post(f'/books/{book_id}/reserve')
+                elif operation == 'cancel':
+                    reservation_id = _pick(session, Reservation, Reservation.user_id == user_id,
+                                           Reservation.status.in_([ReservationStatus.PENDING,
+                                                                   ReservationStatus.WAITING]))
+                    if reservation_id is None:
+                        continue
+                    response = user_client.post(f'/reservations/{reservation_id}/cancel')
+                elif operation == 'loan':
+                    reservation_id = _pick(session, Reservation, Reservation.user_id == user_id,
+                                           Reservation.status == ReservationStatus.PENDING)
+                    if reservation_id is None:
+                        continue
+                    response = admin_client.post(f'/reservations/{reservation_id}/loan')
+                else:
+                    loan_id = _pick(session, Loan, Loan.user_id == user_id, Loan.status == LoanStatus.ACTIVE)
+                    if loan_id is None:
+                        continue
+                    response = admin_client.post(f'/loans/{loan_id}/return')
+                assert response.status_code == 302
+        except Exception as e:
+            errors.append(e)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=worker, args=(i, user_id, user_client, admin_client))
+               for i, (user_id, user_client, admin_client) in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+    db.expire_all()
+    available = db.query(Book.available_copies).filter_by(id=book_id).scalar()
+    active = db.query(func.count(Loan.id)).filter(
+        Loan.book_id == book_id, Loan.status.in_([LoanStatus.ACTIVE, LoanStatus.OVERDUE])).scalar()
+    held = db.query(func.count(Reservation.id)).filter(
+        Reservation.book_id == book_id, Reservation.status == ReservationStatus.PENDING,
+        Reservation.queue_position.isnot(None)).scalar()
+    loaned = db.query(func.count(Loan.id)).filter(Loan.book_id == book_id).scalar()
+
+    assert loaned > 0, '貸出が1件も成功していません。'
+    assert 0 <= available <= COPIES
+    assert available == COPIES - active - held
@@ -0,0 +1,24 @@
+"""
+バックグラウンドジョブ（jobs.py）のテスト
+定期ジョブが失敗した場合に、スタックトレース付きでモジュールのロガーに記録することを確認します。
+"""
+
+import logging
+
+from jobs import PeriodicJob
+
+
+def test_loop_logs_failed_run(db, caplog):
+    def fail():
+        raise ValueError('集計に失敗しました')
+
+    job = PeriodicJob('test-failing-job', fail, interval=60)
+    job.stop()  # 1回実行したら終了する
+    with caplog.at_level(logging.ERROR, logger='jobs'):
+        job._loop()
+
+    [record] = caplog.records
+    assert record.name == 'jobs'
+    assert 'test-failing-job' in record.getMessage()
+    assert record.exc_info[0] is ValueError
+    assert job.last_error == '集計に失敗しました'
@@ -0,0 +1,26 @@
+"""
+スキーマのマイグレーション（migrations.py）のテスト
+schema_version テーブルがない場合だけを未適用（0）とし、接続できない場合はエラーにすることを確認します。
+"""
+
+import pytest
+from sqlalchemy import create_engine, exc
+
+from migrations import current_version, latest_version
+
+
+def test_current_version_of_migrated_database(db):
+    assert current_version() == latest_version()
+
+
+def test_current_version_without_schema_table(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/empty.db')
+    assert current_version(engine) == 0
+    engine.dispose()
+
+
+def test_current_version_raises_when_unreachable(tmp_path):
+    # 存在しないディレクトリのファイルは開けない（接続エラー）
+    engine = create_engine(f'sqlite:///{tmp_path}/missing/library.db')
+    with pytest.raises(exc.OperationalError):
+        current_version(engine)
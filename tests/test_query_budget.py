@@ -0,0 +1,115 @@
+"""
+一覧・詳細ルートのクエリ数のテスト
+ルートに宣言した query_budget を、ログインユーザーの読み込みを含むリクエスト全体のSQL数で確認します。
+キャッシュが空の状態と、2回目以降（キャッシュ・ETagが効く前の通常の取得）の両方を対象にします。
+"""
+
+import pytest
+
+from database import assert_max_queries, count_queries
+
+# 一覧・詳細の読み取りルート（エンドポイント名, URLの引数, 利用するクライアント）
+ROUTES = [
+    ('book_list', {}, ('anonymous_client', 'user_client', 'admin_client')),
+    ('book_detail', {'book_id': 'popular'}, ('anonymous_client', 'user_client', 'admin_client')),
+    ('reservation_list', {}, ('user_client', 'admin_client')),
+    ('loan_list', {}, ('user_client', 'admin_client')),
+    ('admin_dashboard', {}, ('admin_client',)),
+    ('admin_users', {}, ('admin_client',)),
+    ('api.books', {}, ('anonymous_client', 'user_client', 'admin_client')),
+    ('api.book', {'book_id': 'popular'}, ('anonymous_client', 'user_client', 'admin_client')),
+    ('api.reservations', {}, ('user_client', 'admin_client')),
+    ('api.loans', {}, ('user_client', 'admin_client')),
+]
+
+CASES = [pytest.param(endpoint, args, client, id=f'{endpoint}-{client}')
+         for endpoint, args, clients in ROUTES for client in clients]
+
+# 書籍管理は追加・編集と同じルートのため上限を宣言していない（一覧の表示のみここで確認）
+ADMIN_BOOKS_MAX_QUERIES = 3
+
+
+def _url(app, dataset, endpoint, args, **params):
+    from flask import url_for
+    values = {key: dataset.books[0] if value == 'popular' else value for key, value in args.items()}
+    with app.test_request_context():
+        return url_for(endpoint, **values, **params)
+
+
+def _budget(app, endpoint):
+    return app.view_functions[endpoint].query_budget
+
+
+def test_every_read_route_declares_budget(app):
+    for endpoint, _, _ in ROUTES:
+        assert hasattr(app.view_functions[endpoint], 'query_budget'), f'{endpoint} に query_budget がありません。'
+
+
+@pytest.mark.parametrize('endpoint, args, client_name', CASES)
+def test_cold_cache_within_budget(request, app, dataset, endpoint, args, client_name):
+    client = request.getfixturevalue(client_name)
+    # ログインで読み込んだユーザーもキャッシュから捨て、リクエストでの読み込みを含めて数える
+    request.getfixturevalue('cold_cache')
+    with count_queries() as counter:
+        response = client.get(_url(app, dataset, endpoint, args))
+    assert response.status_code == 200
+    assert counter.count <= _budget(app, endpoint), '\n'.join(counter.statements)
+
+
+@pytest.mark.parametrize('endpoint, args, client_name', CASES)
+def test_warm_cache_within_budget(request, app, dataset, endpoint, args, client_name):
+    client = request.getfixturevalue(client_name)
+    url = _url(app, dataset, endpoint, args)
+    client.get(url)
+    with assert_max_queries(_budget(app, endpoint)):
+        response = client.get(url)
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('endpoint', ['book_list', 'api.books'])
+def test_next_page_within_budget(app, dataset, anonymous_client, endpoint):
+    first = anonymous_client.get(_url(app, dataset, endpoint, {}))
+    cursor = first.get_json()['next_cursor'] if endpoint.startswith('api.') else None
+    if cursor is None:
+        import re
+        match = re.search(r'cursor=([\w\-=%]+)', first.get_data(as_text=True))
+        assert match, '次のページへのリンクがありません。'
+        cursor = match.group(1)
+    with assert_max_queries(_budget(app, endpoint)):
+        response = anonymous_client.get(_url(app, dataset, endpoint, {}) + f'?cursor={cursor}')
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('endpoint', ['api.books', 'api.reservations', 'api.loans'])
+def test_query_count_independent_of_page_size(app, dataset, admin_client, cold_cache, endpoint):
+    # N+1クエリがあれば件数に比例してSQLが増える（ログインユーザーは先にキャッシュに載せておく）
+    admin_client.get(_url(app, dataset, endpoint, {}, per_page=1))
+    counts = []
+    for per_page in (5, 50):
+        with count_queries() as counter:
+            response = admin_client.get(_url(app, dataset, endpoint, {}, per_page=per_page))
+        assert response.status_code == 200
+        assert len(response.get_json()['items']) == per_page
+        counts.append(counter.count)
+    assert counts[0] == counts[1]
+
+
+def test_admin_books_list(app, dataset, admin_client, cold_cache):
+    with assert_max_queries(ADMIN_BOOKS_MAX_QUERIES):
+        response = admin_client.get(_url(app, dataset, 'admin_books', {}))
+    assert response.status_code == 200
+
+
+def test_budget_exceeded_raises(app):
+    from database import query_budget
+
+    @query_budget(0)
+    def view():
+        from sqlalchemy import text
+        from database import get_session
+        get_session().execute(text('SELECT 1'))
+        return ''
+
+    with app.test_request_context():
+        with pytest.raises(AssertionError):
+            view()
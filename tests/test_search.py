@@ -0,0 +1,52 @@
+"""
+書籍検索（search.py）のテスト
+プロセス内の転置インデックスが、他のワーカー（別のインスタンス）での書籍の追加・編集・削除を
+版番号 catalog で検出して作り直し、貸出・返却では作り直さないことを確認します。
+"""
+
+import pytest
+
+from models import Book, UserRole
+from search import InvertedIndexSearch
+from versions import touch
+
+
+@pytest.fixture
+def workers():
+    """2つのワーカーのインデックス（1つ目のワーカーで更新し、2つ目のワーカーで検索する）"""
+    return InvertedIndexSearch(), InvertedIndexSearch()
+
+
+def _titles(db, backend, query):
+    db.expire_all()
+    return [book.title for book in backend.search(db, query, limit=10).books]
+
+
+def test_other_worker_sees_catalog_changes(db, make_user, login, workers):
+    admin = login(make_user(role=UserRole.ADMIN))
+    _, other = workers
+    assert _titles(db, other, '転置検索の本') == []
+
+    form = {'action': 'add', 'title': '転置検索の本', 'author': '検索著者', 'total_copies': 1}
+    assert admin.post('/admin/books', data=form).status_code == 200
+    assert _titles(db, other, '転置検索の本') == ['転置検索の本']
+
+    book = db.query(Book).filter_by(title='転置検索の本').one()
+    form = {'action': 'edit', 'book_id': book.id, 'title': '改題した本', 'author': '検索著者', 'total_copies': 1}
+    assert admin.post('/admin/books', data=form).status_code == 200
+    assert _titles(db, other, '転置検索の本') == []
+    assert _titles(db, other, '改題した本') == ['改題した本']
+
+    assert admin.post('/admin/books', data={'action': 'delete', 'book_id': book.id}).status_code == 200
+    assert _titles(db, other, '改題した本') == []
+
+
+def test_circulation_does_not_rebuild(db, workers):
+    backend, _ = workers
+    backend.search(db, '本', limit=1)
+    built = backend._postings
+    # 貸出・返却は books の版番号だけを増やす
+    touch(db, 'books', 'reservations', 'loans')
+    db.commit()
+    backend.search(db, '本', limit=1)
+    assert backend._postings is built
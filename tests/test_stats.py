@@ -0,0 +1,50 @@
+"""
+ダッシュボードの集計値（stats.py）のテスト
+増減がスロットに分かれて合計されること、再集計がずれの分だけを1番目のスロットに足し、
+他のスロットに残っている増減を消さないことを確認します。
+"""
+
+from sqlalchemy import func, select
+
+import stats
+from models import Book, LibraryStats
+
+
+def _slots(db, name):
+    db.expire_all()
+    return dict(db.execute(select(LibraryStats.id, getattr(LibraryStats, name))).all())
+
+
+def test_adjust_updates_one_slot_per_session(db):
+    from database import SessionLocal
+    before = stats.get_stats(db).total_users
+    slots = _slots(db, 'total_users')
+    for slot in (2, 5):
+        session = SessionLocal()
+        session.info['stats_slot'] = slot
+        stats.adjust(session, total_users=1)
+        stats.adjust(session, total_users=1)
+        session.commit()
+        session.close()
+
+    after = _slots(db, 'total_users')
+    assert {slot for slot in after if after[slot] != slots[slot]} == {2, 5}
+    assert after[2] - slots[2] == after[5] - slots[5] == 2
+    assert stats.get_stats(db).total_users == before + 4
+    stats.reconcile_stats()
+
+
+def test_reconcile_corrects_drift_in_first_slot(db):
+    db.info['stats_slot'] = 3
+    stats.adjust(db, total_books=7)
+    db.commit()
+    slots = _slots(db, 'total_books')
+
+    report = stats.reconcile_stats()
+    actual = db.execute(select(func.count(Book.id))).scalar()
+    assert report.changes()['total_books'] == (actual + 7, actual)
+    assert stats.get_stats(db).total_books == actual
+    after = _slots(db, 'total_books')
+    assert after[stats.STATS_ID] == slots[stats.STATS_ID] - 7
+    assert all(after[slot] == slots[slot] for slot in slots if slot != stats.STATS_ID)
+    assert len(after) == stats.STATS_SLOTS
@@ -0,0 +1,57 @@
+"""
+JSON API の ETag に使う版番号
+- 書籍ごと: books.version（在庫・順番待ち・書誌情報など書籍の行を更新するたびに+1）
+- 一覧ごと: collection_versions の books / reservations / loans（一覧の内容が変わる更新のたびに+1）
+- catalog: 書籍の追加・編集・削除・一括インポートのたびに+1（書名・著者の変更の検出用。search.py の転置インデックス）
+いずれもデータの更新と同じトランザクションで増やすため、版番号が同じであれば内容も同じです。
+条件付きGETでは版番号だけを読み、一致すれば行データを読まずに304を返します。
+"""
+
+from sqlalchemy import exc, insert, select, update
+
+from database import engine
+from models import Book, CollectionVersion
+
+COLLECTIONS = ('books', 'reservations', 'loans', 'catalog')
+
+
+def touch(db, *names):
+    """
+    一覧の版番号を増やす（例: touch(db, 'reservations', 'loans')）
+    呼び出し側のトランザクション内で実行し、コミットは呼び出し側で行います。
+    dbにはSessionとConnectionのどちらも渡せます。
+    """
+    db.execute(
+        update(CollectionVersion)
+        .where(CollectionVersion.name.in_(names))
+        .values(version=CollectionVersion.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def ensure_collections(bind=None):
+    """版番号の行を作成（既にあれば何もしない）"""
+    with (bind or engine).begin() as conn:
+        existing = set(conn.execute(select(CollectionVersion.name)).scalars())
+        missing = [name for name in COLLECTIONS if name not in existing]
+        if not missing:
+            return
+        try:
+            conn.execute(insert(CollectionVersion), [{'name': name, 'version': 1} for name in missing])
+        except exc.IntegrityError:
+            # 他のプロセスが同時に作成した
+            pass
+
+
+def collection_version(db, name: str):
+    """一覧の版番号（行がまだない場合は作成し、作成前の読み取りではNone）"""
+    version = db.execute(select(CollectionVersion.version).where(CollectionVersion.name == name)).scalar()
+    if version is None:
+        # 作成前に発行したETagはないため、作成時点の番号から数え始めればよい
+        ensure_collections()
+    return version
+
+
+def book_version(db, book_id: int):
+    """書籍の版番号（書籍がなければNone）"""
+    return db.execute(select(Book.version).where(Book.id == book_id)).scalar()